@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Per-request latency over the lifetime of a worker.
+
+Sends requests to a lightweight endpoint through the test client, one after
+the other, and compares the latency of the first batch with the last and the
+slowest ones. Any per-request state that keeps growing, like the decorators
+once appended to the resources on every request, shows up as a steady
+increase. Exits with status 1 if any batch is more than `--tolerance` times
+slower than the first one.
+
+Usage:
+    dispatch_latency.py [--requests=<n>] [--batch=<n>] [--tolerance=<x>]
+    dispatch_latency.py (-h | --help)
+
+Options:
+    -h --help         Show this help message and exit
+    --requests=<n>    Number of requests to send [default: 100000]
+    --batch=<n>       Requests in each measured batch [default: 2000]
+    --tolerance=<x>   Maximum slowdown of any batch [default: 1.5]
+"""
+from time import time
+import os
+import sys
+import tempfile
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shiva import app as shiva
+from shiva.models import db
+
+
+def median(values):
+    values = sorted(values)
+
+    return values[len(values) / 2]
+
+
+def run(client, requests, batch, tolerance):
+    print('%10s %10s' % ('requests', 'median'))
+    batches = []
+    latencies = []
+    for number in xrange(1, requests + 1):
+        begin = time()
+        response = client.get('/clients/')
+        latencies.append((time() - begin) * 1000)
+        assert response.status_code == 200
+
+        if number % batch == 0:
+            batches.append(median(latencies))
+            latencies = []
+            print('%10d %8.3fms' % (number, batches[-1]))
+
+    first, last, slowest = batches[0], batches[-1], max(batches)
+    print('Slowdown: %.2fx (slowest batch: %.2fx)' % (last / first,
+                                                      slowest / first))
+    if slowest > first * tolerance:
+        sys.exit(1)
+
+
+def main():
+    arguments = docopt(__doc__)
+    requests = int(arguments['--requests'])
+    batch = int(arguments['--batch'])
+    tolerance = float(arguments['--tolerance'])
+
+    db_fd, db_path = tempfile.mkstemp()
+    shiva.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % db_path
+    shiva.app.config['ALLOW_ANONYMOUS_ACCESS'] = True
+    shiva.app.config['SUGGEST_ENABLED'] = False
+    with shiva.app.app_context():
+        db.create_all()
+
+    try:
+        run(shiva.app.test_client(), requests, batch, tolerance)
+    finally:
+        os.close(db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
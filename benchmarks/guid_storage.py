@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Size and speed of keys stored as hex digits and as raw bytes on SQLite.
+
+Fills a temporary database for each storage with the same fake collection, and
+compares the size of the association tables and their indexes, and the time
+some joins take.
+
+Usage:
+    guid_storage.py [--tracks=<n>] [--runs=<n>]
+    guid_storage.py (-h | --help)
+
+Options:
+    -h --help       Show this help message and exit
+    --tracks=<n>    Number of tracks in the collection [default: 50000]
+    --runs=<n>      Times every query is run to time it [default: 10]
+"""
+from time import time
+import os
+import sys
+import tempfile
+
+from docopt import docopt
+from sqlalchemy import func
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shiva import app as shiva, dbtypes
+from shiva.models import Artist, db, get_related, Track, track_artist
+from query_plans import fill
+
+TABLES = ('trackartist', 'trackalbum')
+
+
+def get_sizes(connection):
+    """Returns the size in bytes of each table and index, by name."""
+
+    query = 'SELECT name, tbl_name FROM sqlite_master WHERE tbl_name IN (%s)'
+    names = connection.execute(query % ', '.join('?' * len(TABLES)), TABLES)
+
+    sizes = {}
+    for name, table in names:
+        size = connection.execute('SELECT SUM(pgsize) FROM dbstat '
+                                  'WHERE name = ?', (name,)).scalar()
+        sizes[name] = size or 0
+
+    return sizes
+
+
+def get_queries(runs):
+    track_pks = [pk for pk, in db.session.query(Track.pk).limit(500)]
+    joined = track_artist.join(Track.__table__,
+                               Track.pk == track_artist.c.track_pk)
+
+    return (
+        ('Artists of 500 tracks',
+         lambda: get_related(Artist, track_artist, track_pks)),
+        ('All track keys', lambda: db.session.query(Track.pk).all()),
+        ('Join all tracks', lambda: db.session.query(func.count()).select_from(
+            joined).scalar()),
+    )
+
+
+def run(binary, tracks, runs):
+    dbtypes.GUID.binary = binary
+
+    db_fd, db_path = tempfile.mkstemp()
+    shiva.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % db_path
+    ctx = shiva.app.test_request_context()
+    ctx.push()
+
+    try:
+        db.create_all()
+        fill(db.session.connection(), tracks)
+        db.session.commit()
+        db.session.connection().execute('ANALYZE')
+
+        print('%s keys\n' % ('Binary' if binary else 'Hex'))
+        for name, size in sorted(get_sizes(db.session.connection()).items()):
+            print('%-36s %8.1fKB' % (name, size / 1024.0))
+
+        print('')
+        for name, query in get_queries(runs):
+            started = time()
+            for _ in xrange(runs):
+                query()
+                db.session.expunge_all()
+            elapsed = (time() - started) / runs * 1000
+
+            print('%-36s %8.2fms' % (name, elapsed))
+        print('')
+    finally:
+        db.session.remove()
+        ctx.pop()
+        os.close(db_fd)
+        os.unlink(db_path)
+
+
+def main():
+    arguments = docopt(__doc__)
+    tracks = int(arguments['--tracks'])
+    runs = int(arguments['--runs'])
+
+    for binary in (False, True):
+        run(binary, tracks, runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Query plans and timings of the hottest lookups, before and after migrating.
+
+Fills a temporary SQLite database with a fake collection, turns it into one
+created before the lookup indexes existed, and shows how the queries run
+before and after `shiva-admin db upgrade`.
+
+Usage:
+    query_plans.py [--tracks=<n>] [--runs=<n>]
+    query_plans.py (-h | --help)
+
+Options:
+    -h --help       Show this help message and exit
+    --tracks=<n>    Number of tracks in the collection [default: 50000]
+    --runs=<n>      Times every query is run to time it [default: 20]
+"""
+from datetime import date, timedelta
+from time import time
+import os
+import sys
+import tempfile
+import uuid
+
+from docopt import docopt
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shiva import app as shiva, migrations
+from shiva.models import Album, Artist, db, Track, track_album, track_artist
+
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 5
+
+
+def fill(connection, tracks, start=0):
+    """
+    Inserts `tracks` tracks, with their albums and artists. Their names are
+    numbered from `start`.
+    """
+
+    today = date.today()
+    artists, albums, _tracks, artist_rels, album_rels = [], [], [], [], []
+    for index in xrange(start, start + tracks):
+        if index % (TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST) == 0:
+            artist_pk = uuid.uuid4()
+            artists.append({'pk': artist_pk, 'name': 'Artist %s' % index,
+                            'slug': 'artist-%s' % index,
+                            'date_added': today - timedelta(index % 1000)})
+
+        if index % TRACKS_PER_ALBUM == 0:
+            album_pk = uuid.uuid4()
+            albums.append({'pk': album_pk, 'name': 'Album %s' % index,
+                           'slug': 'album-%s' % index,
+                           'date_added': today - timedelta(index % 1000)})
+
+        pk = uuid.uuid4()
+        _tracks.append({'pk': pk, 'path': u'/music/%s.mp3' % index,
+                        'title': 'Track %s' % index,
+                        'slug': 'track-%s' % index,
+                        'hash': '%.32x' % uuid.uuid4().int,
+                        'date_added': today - timedelta(index % 1000)})
+        artist_rels.append({'track_pk': pk, 'artist_pk': artist_pk})
+        album_rels.append({'track_pk': pk, 'album_pk': album_pk})
+
+    for table, rows in ((Artist.__table__, artists),
+                        (Album.__table__, albums),
+                        (Track.__table__, _tracks),
+                        (track_artist, artist_rels),
+                        (track_album, album_rels)):
+        connection.execute(table.insert(), rows)
+
+    return artists[-1], albums[-1], _tracks[-1]
+
+
+def make_old(connection):
+    """Drops the indexes added by the migrations and the version table."""
+
+    for table in (Artist.__table__, Album.__table__, Track.__table__,
+                  track_artist, track_album):
+        for index in table.indexes:
+            index.drop(bind=connection)
+
+    migrations.schema_version.drop(bind=connection)
+
+
+def get_queries(artist, album, track):
+    since = date.today() - timedelta(7)
+
+    return (
+        ('Track by slug', Track.query.filter_by(slug=track['slug'])),
+        ('Artist by slug', Artist.query.filter_by(slug=artist['slug'])),
+        ('Album by name', Album.query.filter_by(name=album['name'])),
+        ('Track by hash', Track.query.filter_by(hash=track['hash'])),
+        ('New tracks', Track.query.filter(Track.date_added > since)),
+        ('Album tracks', Track.query.join(
+            track_album, track_album.c.track_pk == Track.pk).filter(
+            track_album.c.album_pk == album['pk'])),
+        ('Track artists', Artist.query.join(
+            track_artist, track_artist.c.artist_pk == Artist.pk).filter(
+            track_artist.c.track_pk == track['pk'])),
+    )
+
+
+def explain(connection, query):
+    """Returns the plan the database chooses to run `query`."""
+
+    prefix = ('EXPLAIN QUERY PLAN' if connection.dialect.name == 'sqlite'
+              else 'EXPLAIN')
+
+    # Prefixing the final statement keeps the parameters processed as usual.
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        return '%s %s' % (prefix, statement), parameters
+
+    event.listen(connection, 'before_cursor_execute', before_cursor_execute,
+                 retval=True)
+    try:
+        return [tuple(row) for row in connection.execute(query.statement)]
+    finally:
+        event.remove(connection, 'before_cursor_execute',
+                     before_cursor_execute)
+
+
+def report(connection, queries, runs):
+    for name, query in queries:
+        plan = explain(connection, query)
+
+        started = time()
+        for _ in xrange(runs):
+            query.all()
+        elapsed = (time() - started) / runs * 1000
+
+        print('%-16s %8.2fms' % (name, elapsed))
+        for row in plan:
+            print('    %s' % row[-1])
+
+
+def main():
+    arguments = docopt(__doc__)
+    tracks = int(arguments['--tracks'])
+    runs = int(arguments['--runs'])
+
+    db_fd, db_path = tempfile.mkstemp()
+    shiva.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % db_path
+    ctx = shiva.app.test_request_context()
+    ctx.push()
+
+    try:
+        db.create_all()
+        connection = db.session.connection()
+        rows = fill(connection, tracks)
+        make_old(connection)
+        db.session.commit()
+
+        queries = get_queries(*rows)
+
+        print('Before (schema version %s)\n' %
+              migrations.get_version(db.session.connection()))
+        report(db.session.connection(), queries, runs)
+
+        started = time()
+        migrations.upgrade()
+        print('\nUpgraded in %.1fs\n' % (time() - started))
+
+        connection = db.session.connection()
+        connection.execute('ANALYZE')
+        print('After (schema version %s)\n' %
+              migrations.get_version(connection))
+        report(connection, queries, runs)
+    finally:
+        db.session.remove()
+        ctx.pop()
+        os.close(db_fd)
+        os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    main()
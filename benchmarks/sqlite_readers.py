@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Latency of API reads on SQLite while the indexer is writing.
+
+A separate process inserts tracks in a single long transaction, like the
+indexer does, while this one keeps looking up tracks by slug, as the API
+would, ending its transaction after each lookup. This is done once with
+SQLite's default settings and once with the SQLITE_PRAGMAS setting.
+
+Usage:
+    sqlite_readers.py [--tracks=<n>] [--seconds=<n>]
+    sqlite_readers.py (-h | --help)
+
+Options:
+    -h --help       Show this help message and exit
+    --tracks=<n>    Number of tracks in the collection [default: 20000]
+    --seconds=<n>   Time the writer keeps its transaction open [default: 5]
+"""
+from multiprocessing import Event, Process
+from time import sleep, time
+import os
+import sys
+import tempfile
+
+from docopt import docopt
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shiva import app as shiva, engine
+from shiva.models import db, Track
+from query_plans import fill
+
+
+def write(uri, start, seconds, started):
+    """Inserts batches of tracks for `seconds` seconds, then commits."""
+
+    connection = create_engine(uri).connect()
+    transaction = connection.begin()
+    started.set()
+
+    deadline = time() + seconds
+    while time() < deadline:
+        fill(connection, 1000, start)
+        start += 1000
+        sleep(0.01)
+
+    transaction.commit()
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def run(uri, pragmas, tracks, seconds):
+    engine.set_sqlite_pragmas(pragmas)
+    shiva.app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    ctx = shiva.app.test_request_context()
+    ctx.push()
+
+    try:
+        db.create_all()
+        track = fill(db.session.connection(), tracks)[-1]
+        db.session.commit()
+        db.session.remove()
+
+        started = Event()
+        writer = Process(target=write, args=(uri, tracks, seconds, started))
+        writer.start()
+        started.wait()
+
+        latencies, errors = [], 0
+        while writer.is_alive():
+            begin = time()
+            try:
+                Track.query.filter_by(slug=track['slug']).first()
+            except OperationalError:
+                errors += 1
+            latencies.append((time() - begin) * 1000)
+            db.session.remove()
+
+        writer.join()
+    finally:
+        db.session.remove()
+        db.get_engine(shiva.app).dispose()
+        ctx.pop()
+
+    latencies.sort()
+    print('%-10s %7d %8.2fms %8.2fms %9.2fms %7d' % (
+        'tuned' if pragmas else 'defaults', len(latencies),
+        percentile(latencies, 50), percentile(latencies, 99), latencies[-1],
+        errors))
+
+
+def main():
+    arguments = docopt(__doc__)
+    tracks = int(arguments['--tracks'])
+    seconds = float(arguments['--seconds'])
+
+    print('%-10s %7s %10s %10s %11s %7s' % ('', 'reads', 'p50', 'p99', 'max',
+                                            'errors'))
+    for pragmas in ({}, shiva.app.config['SQLITE_PRAGMAS']):
+        db_fd, db_path = tempfile.mkstemp()
+        try:
+            run('sqlite:///%s' % db_path, pragmas, tracks, seconds)
+        finally:
+            os.close(db_fd)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.unlink(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
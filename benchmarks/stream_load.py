@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Many simultaneous listeners on the event driven file server.
+
+Starts shiva-fileserver-async in a child process, serving a generated file,
+and opens `--clients` connections to it at once. Each client asks for the
+whole file and reads it at `--rate` bytes per second, like a player that
+buffers a little ahead, for `--seconds` seconds. Reports the time to the
+first byte, the rate each client got and the memory and threads the server
+used. Exits with status 1 if any client got an error or fell behind.
+
+Usage:
+    stream_load.py [--clients=<n>] [--rate=<bytes>] [--seconds=<n>]
+                   [--size=<bytes>]
+    stream_load.py (-h | --help)
+
+Options:
+    -h --help         Show this help message and exit
+    --clients=<n>     Simultaneous connections [default: 1000]
+    --rate=<bytes>    Bytes per second read by each client [default: 40000]
+    --seconds=<n>     Duration of the test [default: 10]
+    --size=<bytes>    Size of the file served [default: 10000000]
+"""
+from multiprocessing import Process, Queue
+from time import sleep, time
+import errno
+import os
+import resource
+import select
+import shutil
+import socket
+import sys
+import tempfile
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shiva import asyncfileserver, fileserver
+from shiva.media import MediaDir
+
+# Clients are given their share of bytes this many times per second.
+TICKS = 10
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def serve(root, queue):
+    fileserver.app.config['MEDIA_DIRS'] = [MediaDir(root)]
+    server = asyncfileserver.FileServer('127.0.0.1', 0)
+    queue.put(server.port)
+    server.serve_forever()
+
+
+def get_process_status(pid, field):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return line.split(':', 1)[1].strip()
+
+
+class Client(object):
+    def __init__(self, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.connect_ex(('127.0.0.1', port))
+
+        self.start = time()
+        self.first_byte = None
+        self.received = 0
+        self.allowance = 0
+        self.error = None
+
+    def send_request(self):
+        self.sock.send('GET /track.flac HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+    def receive(self):
+        try:
+            data = self.sock.recv(min(self.allowance, 65536))
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            self.error = str(e)
+            return None
+
+        if not data:
+            self.error = 'Connection closed'
+            return None
+
+        if self.first_byte is None:
+            self.first_byte = time() - self.start
+        self.received += len(data)
+        self.allowance -= len(data)
+
+
+def run(port, clients, rate, seconds):
+    poll = select.poll()
+    by_fd = {}
+    for _ in xrange(clients):
+        client = Client(port)
+        by_fd[client.sock.fileno()] = client
+        poll.register(client.sock, select.POLLOUT)
+    print('%d clients connecting...' % clients)
+
+    start = time()
+    next_tick = start
+    while time() - start < seconds:
+        if time() >= next_tick:
+            next_tick += 1.0 / TICKS
+            for fd, client in by_fd.iteritems():
+                if client.error is None and client.first_byte is not None:
+                    # Clients behind catch up, up to a second of data.
+                    client.allowance = min(client.allowance + rate / TICKS,
+                                           rate)
+                    poll.modify(fd, select.POLLIN)
+
+        timeout = max(next_tick - time(), 0) * 1000
+        for fd, event in poll.poll(timeout):
+            client = by_fd[fd]
+            if event & select.POLLOUT:
+                client.send_request()
+                client.allowance = rate / TICKS
+                poll.modify(fd, select.POLLIN)
+                continue
+
+            client.receive()
+            if client.error is not None:
+                poll.unregister(fd)
+            elif client.allowance <= 0:
+                poll.modify(fd, 0)
+
+    elapsed = time() - start
+    for client in by_fd.itervalues():
+        client.sock.close()
+
+    return by_fd.values(), elapsed
+
+
+def main():
+    arguments = docopt(__doc__)
+    clients = int(arguments['--clients'])
+    rate = int(arguments['--rate'])
+    seconds = float(arguments['--seconds'])
+    size = int(arguments['--size'])
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < clients * 2 + 100:
+        sys.exit('Not enough file descriptors (%d) for %d clients.' %
+                 (hard, clients))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'track.flac'), 'wb') as f:
+        f.write(os.urandom(size))
+
+    queue = Queue()
+    server = Process(target=serve, args=(root, queue))
+    server.start()
+    try:
+        port = queue.get(timeout=10)
+        sleep(0.5)
+        results, elapsed = run(port, clients, rate, seconds)
+        rss = get_process_status(server.pid, 'VmHWM')
+        threads = get_process_status(server.pid, 'Threads')
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(root)
+
+    failed = [client for client in results if client.error is not None or
+              client.first_byte is None]
+    served = [client for client in results if client not in failed]
+    print('Clients served: %d of %d' % (len(served), len(results)))
+    for error in set(client.error for client in failed):
+        print('  %s' % error)
+    if not served:
+        sys.exit(1)
+
+    first_bytes = [client.first_byte * 1000 for client in served]
+    print('Time to first byte: median %.1fms, 99th percentile %.1fms, '
+          'max %.1fms' % (percentile(first_bytes, 0.5),
+                          percentile(first_bytes, 0.99), max(first_bytes)))
+
+    rates = [client.received / (elapsed - client.first_byte)
+             for client in served]
+    print('Rate per client: median %d bytes/s, slowest %d bytes/s '
+          '(asked for %d)' % (percentile(rates, 0.5), min(rates), rate))
+    print('Total: %.1f MB/s' % (sum(client.received for client in served) /
+                                elapsed / 1000000))
+    print('Server: %s peak memory, %s threads' % (rss, threads))
+
+    if failed or min(rates) < rate * 0.9:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
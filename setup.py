@@ -49,6 +49,7 @@ setup(
         'console_scripts': [
             'shiva-admin = shiva.bin:admin',
             'shiva-fileserver = shiva.bin:fileserver',
+            'shiva-fileserver-async = shiva.bin:async_fileserver',
             'shiva-indexer = shiva.bin:indexer',
             'shiva-server = shiva.bin:server',
         ]
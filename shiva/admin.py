@@ -6,6 +6,10 @@ Usage:
     shiva-admin user activate <email_or_id>
     shiva-admin user deactivate <email_or_id>
     shiva-admin user delete <email_or_id>
+    shiva-admin search rebuild
+    shiva-admin db upgrade
+    shiva-admin db version
+    shiva-admin db guids (binary | hex)
     shiva-admin (-h | --help)
 
 Options:
@@ -19,7 +23,10 @@ from docopt import docopt
 
 from shiva.app import app
 from shiva.auth import Roles
+from shiva.auth.cache import token_cache
 from shiva.models import db, User
+from shiva import migrations
+from shiva.search import rebuild
 from shiva.utils import get_logger
 
 log = get_logger()
@@ -43,6 +50,16 @@ def main():
             deactivate_user(arguments['<email_or_id>'])
         elif arguments['delete']:
             delete_user(arguments['<email_or_id>'])
+    elif arguments['search']:
+        if arguments['rebuild']:
+            rebuild_search_index()
+    elif arguments['db']:
+        if arguments['upgrade']:
+            upgrade_db()
+        elif arguments['version']:
+            print_db_version()
+        elif arguments['guids']:
+            convert_db_guids(binary=arguments['binary'])
 
     ctx.pop()
 
@@ -179,6 +196,7 @@ def activate_user(email_or_id):
 
     db.session.add(user)
     db.session.commit()
+    token_cache.invalidate(user.pk)
 
     log.info("User '%s' activated." % user.pk)
 
@@ -193,6 +211,7 @@ def deactivate_user(email_or_id):
 
     db.session.add(user)
     db.session.commit()
+    token_cache.invalidate(user.pk)
 
     log.info("User '%s' deactivated." % user.pk)
 
@@ -207,5 +226,54 @@ def delete_user(email_or_id):
 
     db.session.delete(user)
     db.session.commit()
+    token_cache.invalidate(_pk)
 
     log.info("User '%s' deleted." % _pk)
+
+
+def rebuild_search_index():
+    log.info('Rebuilding search index...')
+    rebuild()
+    log.info('Done.')
+
+
+def upgrade_db():
+    db.create_all()
+
+    try:
+        applied = migrations.upgrade()
+    except migrations.DowngradeError as e:
+        log.error(e)
+        sys.exit(1)
+
+    if applied:
+        log.info('Done, %s migration(s) applied.' % applied)
+    else:
+        log.info('The database is up to date.')
+
+
+def print_db_version():
+    connection = db.session.connection()
+    log.info('Schema version: %s (latest: %s)' % (
+        migrations.get_version(connection),
+        migrations.get_latest_version()))
+
+    if connection.dialect.name == 'sqlite':
+        log.info('Keys stored as: %s' % (
+            migrations.get_guid_storage(connection) or 'unknown, no data'))
+
+
+def convert_db_guids(binary):
+    log.info('Converting keys to %s...' % ('binary' if binary else 'hex'))
+
+    try:
+        columns = migrations.convert_guids(binary)
+    except migrations.UnsupportedDatabaseError as e:
+        log.error(e)
+        sys.exit(1)
+
+    log.info('Reclaiming space...')
+    db.engine.execute('VACUUM')
+
+    log.info('Done, %s columns converted. Remember to set BINARY_GUIDS = %s '
+             'in your config file.' % (columns, binary))
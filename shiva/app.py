@@ -2,20 +2,35 @@
 import sys
 
 from flask import Flask, g, request
-from flask.ext.restful import Api
 from flask.ext.compress import Compress
 
-from shiva import resources
+from shiva import (dbtypes, engine, metrics, profiling, resources,
+                   suggest)
+# Registers the schema_version table, created along with the others.
+from shiva import migrations  # noqa
 from shiva.auth import verify_credentials
+from shiva.auth.cache import token_cache
 from shiva.config import Configurator
+from shiva.http import Api
 from shiva.models import db
-from shiva.utils import randstr
+from shiva.routing import SAFE_METHODS
+from shiva.utils import queue_logging, randstr
 
 app = Flask(__name__)
 app.config.from_object(Configurator())
+dbtypes.GUID.binary = app.config.get('BINARY_GUIDS', False)
+engine.set_sqlite_pragmas(app.config.get('SQLITE_PRAGMAS', {}))
+token_cache.configure(app.config.get('AUTH_CACHE_SIZE', 1024),
+                      app.config.get('AUTH_CACHE_TTL', 60))
+if app.config.get('LOG_QUEUE'):
+    queue_logging()
 db.app = app
 db.init_app(app)
 
+# Go first, so they account for all the other request hooks
+profiling.init_app(app)
+metrics.init_app(app)
+
 # Serve all requests gzipped
 if app.config.get('USE_GZIP', True):
     Compress(app)
@@ -56,13 +71,22 @@ api.add_resource(resources.UserResource, '/users/', '/users/<id>/',
 api.add_resource(resources.RandomResource, '/random/<resource_name>/',
                  endpoint='random')
 api.add_resource(resources.WhatsNewResource, '/whatsnew/', endpoint='whatsnew')
+api.add_resource(resources.SearchResource, '/search/', endpoint='search')
+api.add_resource(resources.SuggestResource, '/suggest/', endpoint='suggest')
 api.add_resource(resources.ClientResource, '/clients/', endpoint='client')
 api.add_resource(resources.AboutResource, '/about/', endpoint='about')
 
 
+@app.before_first_request
+def build_suggest_index():
+    if app.config.get('SUGGEST_ENABLED'):
+        suggest.get_index()
+
+
 @app.before_request
 def before_request():
     g.db = db
+    db.session().use_replica(request.method in SAFE_METHODS)
 
     # auth
     verify_credentials(app)
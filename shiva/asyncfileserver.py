@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Event driven file server.
+
+Like shiva-fileserver, but meant for many simultaneous listeners. A single
+thread holds every connection in an event loop, so thousands of long lived
+streams don't need thousands of threads.
+
+Requests are answered by the same application as shiva-fileserver, so files
+are found, authorized, ranged and validated the same way. Only the sending of
+the files changes: they are written as each socket is ready to take more,
+with sendfile() if the pysendfile package is installed.
+
+Usage:
+    shiva-fileserver-async [<port>]
+
+Files are read from disk in the event loop, so it works best with local disks.
+"""
+from cStringIO import StringIO
+from time import time
+import asyncore
+import errno
+import socket
+import sys
+import urllib
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+from shiva.fileserver import (app, CHUNK_SIZE, FileRange, MultipartRanges,
+                              THROTTLED_CHUNK_SIZE)
+from shiva.utils import get_logger
+
+log = get_logger()
+
+# Largest request line and headers accepted, in bytes.
+MAX_REQUEST_SIZE = 16 * 1024
+# Seconds a connection can go without sending or receiving anything.
+IDLE_TIMEOUT = 60
+# Connections waiting to be accepted.
+BACKLOG = 1024
+# Seconds between turns of the loop while there are streams with a limited
+# rate waiting to send more.
+THROTTLE_INTERVAL = 0.05
+
+
+class FileBody(object):
+    """
+    The server's `wsgi.file_wrapper`. Lets the connection find the file of the
+    response, to send it on its own.
+    """
+
+    def __init__(self, filelike, blksize=CHUNK_SIZE):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), '')
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+class Connection(asyncore.dispatcher):
+    """
+    A client connection. Reads a request, answers it, and then waits for the
+    next one if the connection is kept alive.
+    """
+
+    def __init__(self, sock, addr, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+
+        self.server = server
+        self.addr = addr
+        self.input = ''
+        self.output = ''
+        self.keep_alive = False
+        self.last_activity = time()
+        # The response being sent: the iterable returned by the application,
+        # and either the file (a FileRange or MultipartRanges) to send or the
+        # iterator of the body.
+        self.response = None
+        self.file = None
+        self.chunks = None
+        # When the rate of the file is limited, time to send more of it.
+        self.resume_at = 0
+
+    def is_sending(self):
+        return bool(self.output) or self.response is not None
+
+    def readable(self):
+        # One request at a time, the next one is read once this one is sent.
+        return not self.is_sending()
+
+    def writable(self):
+        if not self.output and self.resume_at > time():
+            return False
+
+        return self.is_sending()
+
+    def handle_read(self):
+        data = self.recv(8192)
+        if not data:
+            return None
+
+        self.last_activity = time()
+        self.input += data
+        self.process_input()
+
+    def process_input(self):
+        end = self.input.find('\r\n\r\n')
+        if end < 0:
+            if len(self.input) > MAX_REQUEST_SIZE:
+                self.send_error('431 Request Header Fields Too Large')
+
+            return None
+
+        head, self.input = self.input[:end], self.input[end + 4:]
+        try:
+            environ = self.get_environ(head)
+        except ValueError:
+            return self.send_error('400 Bad Request')
+
+        self.respond(environ)
+
+    def get_environ(self, head):
+        """Parses the head of a request into a WSGI environ."""
+
+        lines = head.split('\r\n')
+        method, target, version = lines[0].split(' ')
+        if not version.startswith('HTTP/1.'):
+            raise ValueError('Unsupported protocol: %s' % version)
+
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.host,
+            'SERVER_PORT': str(self.server.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': self.addr[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileBody,
+        }
+
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise ValueError('Invalid header: %s' % line)
+
+            key = name.strip().upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_%s' % key
+            if key in environ:
+                environ[key] = '%s,%s' % (environ[key], value.strip())
+            else:
+                environ[key] = value.strip()
+
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+
+        # Request bodies are not read, so the connection can't be reused.
+        if environ.get('CONTENT_LENGTH', '0') != '0' or \
+                'HTTP_TRANSFER_ENCODING' in environ:
+            self.keep_alive = False
+
+        return environ
+
+    def respond(self, environ):
+        status_headers = []
+
+        def start_response(status, headers, exc_info=None):
+            status_headers[:] = [status, headers]
+
+        self.response = app(environ, start_response)
+        status, headers = status_headers
+
+        if not any(name.lower() == 'content-length' for name, _ in headers):
+            # The end of the body is told by closing the connection.
+            self.keep_alive = False
+
+        lines = ['HTTP/1.1 %s' % status]
+        lines.extend('%s: %s' % header for header in headers)
+        lines.append('Connection: %s' % ('keep-alive' if self.keep_alive
+                                         else 'close'))
+        self.output = '\r\n'.join(lines) + '\r\n\r\n'
+
+        if isinstance(self.response, FileBody) and isinstance(
+                self.response.filelike, (FileRange, MultipartRanges)):
+            self.file = self.response.filelike
+            if self.file.stream is not None:
+                self.server.throttled += 1
+        else:
+            self.chunks = iter(self.response)
+
+    def send_error(self, status):
+        self.keep_alive = False
+        self.input = ''
+        self.output = ('HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+                       'Connection: close\r\n\r\n' % status)
+
+    def handle_write(self):
+        self.last_activity = time()
+
+        if not self.output:
+            if sendfile is not None and isinstance(self.file, FileRange):
+                return self.send_file()
+
+            self.output = self.get_next_chunk()
+
+        if self.output:
+            sent = self.send(self.output)
+            self.output = self.output[sent:]
+
+        if not self.output and self.file is None and self.chunks is None:
+            self.end_response()
+
+    def get_next_chunk(self):
+        if self.file is not None:
+            stream = self.file.stream
+            if stream is None:
+                data = self.file.read(CHUNK_SIZE)
+            else:
+                data = self.file.read(THROTTLED_CHUNK_SIZE, wait=False)
+                if data:
+                    self.resume_at = time() + stream.reserve(len(data))
+            if data:
+                return data
+
+            self.end_file()
+        elif self.chunks is not None:
+            for chunk in self.chunks:
+                if chunk:
+                    return chunk
+
+            self.chunks = None
+
+        return ''
+
+    def send_file(self):
+        f = self.file
+        count = f.remaining
+        if f.stream is not None:
+            count = min(count, THROTTLED_CHUNK_SIZE)
+
+        try:
+            sent = sendfile(self.socket.fileno(), f.file.fileno(),
+                            f.file.tell(), count)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                return self.handle_close()
+            raise
+
+        f.file.seek(sent, 1)
+        f.remaining -= sent
+        if f.stream is not None:
+            self.resume_at = time() + f.stream.reserve(sent)
+
+        if not sent or f.remaining <= 0:
+            self.end_file()
+            self.end_response()
+
+    def end_file(self):
+        if self.file.stream is not None:
+            self.server.throttled -= 1
+        self.file = None
+
+    def end_response(self):
+        if self.response is not None and hasattr(self.response, 'close'):
+            self.response.close()
+        self.response = None
+        self.chunks = None
+        self.resume_at = 0
+
+        if not self.keep_alive:
+            return self.close()
+
+        if self.input:
+            # Pipelined request.
+            self.process_input()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        log.exception('Error serving %s' % (self.addr,))
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.end_file()
+        if self.response is not None and hasattr(self.response, 'close'):
+            self.response.close()
+        self.response = None
+
+        asyncore.dispatcher.close(self)
+
+
+class FileServer(asyncore.dispatcher):
+    """Accepts connections and runs the event loop."""
+
+    def __init__(self, host='0.0.0.0', port=8001):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(BACKLOG)
+
+        self.host = host
+        self.port = self.socket.getsockname()[1]
+        self.running = False
+        # Connections sending files with a limited rate.
+        self.throttled = 0
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], pair[1], self)
+
+    def handle_error(self):
+        # E.g. out of file descriptors, the connection is left waiting.
+        log.exception('Error accepting a connection')
+
+    def close_idle_connections(self):
+        deadline = time() - IDLE_TIMEOUT
+        for dispatcher in self.map.values():
+            if isinstance(dispatcher, Connection) and \
+                    dispatcher.last_activity < deadline:
+                dispatcher.close()
+
+    def serve_forever(self):
+        self.running = True
+        last_check = time()
+
+        while self.running:
+            timeout = THROTTLE_INTERVAL if self.throttled else 1
+            asyncore.loop(timeout=timeout, use_poll=True, map=self.map,
+                          count=1)
+
+            if time() - last_check >= 1:
+                self.close_idle_connections()
+                last_check = time()
+
+        for dispatcher in self.map.values():
+            dispatcher.close()
+
+    def stop(self):
+        """Stops the loop, closing every connection, after its next turn."""
+
+        self.running = False
+
+
+def main():
+    try:
+        port = int(sys.argv[1])
+    except:
+        port = 8001
+
+    server = FileServer(port=port)
+    log.info('Serving files on port %d%s.' % (
+        server.port, ' with sendfile()' if sendfile else ''))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
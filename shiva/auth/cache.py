@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of verified authentication tokens.
+
+Verifying a token means checking its signature and fetching its user from the
+database, for every request. Instead, the user is kept in memory for a few
+seconds, see the AUTH_CACHE_TTL setting, so most requests only need a dict
+lookup. Tokens are still rejected as soon as they expire, cached or not.
+
+The cache lives in each server process. Changes made to users, through the
+API or ``shiva-admin``, invalidate the entries of the process that made them
+and increment the version of the users kept in the database. Every other
+process looks at it at most once every VERSION_CHECK_INTERVAL seconds, and
+empties its cache when it changed, so users deactivated or deleted stop
+using their tokens about that soon.
+"""
+import time
+import uuid
+
+from flask import current_app as app
+from itsdangerous import (BadSignature,
+                          TimedJSONWebSignatureSerializer as Serializer)
+from sqlalchemy.sql.expression import func, select
+
+from shiva import metrics
+from shiva.models import db, User, users_version
+from shiva.utils import LRUCache
+
+# Seconds between looks at the version of the users in the database.
+VERSION_CHECK_INTERVAL = 1
+
+
+class UserSnapshot(object):
+    """
+    Copy of the attributes of a user, except for its password. Unlike the user
+    itself, it's not tied to any session and can be shared between requests.
+    """
+
+    excluded = ('password', 'salt')
+
+    def __init__(self, user):
+        for column in User.__table__.columns:
+            if column.key not in self.excluded:
+                setattr(self, column.key, getattr(user, column.key))
+
+    def __repr__(self):
+        return "<UserSnapshot ('%s')>" % self.email
+
+
+class TokenCache(object):
+
+    def __init__(self, size=1024, ttl=60):
+        self.configure(size, ttl)
+
+    def configure(self, size, ttl):
+        """Empties the cache, and caches `size` tokens for `ttl` seconds."""
+
+        self.cache = LRUCache(size, ttl) if ttl else None
+        # Version of the users the entries were cached at.
+        self.version = None
+        self.next_check = 0
+
+    def check_version(self):
+        """
+        Empties the cache if users were changed, by any process, since the
+        last look at their version.
+        """
+
+        now = time.time()
+        if now < self.next_check:
+            return None
+
+        self.next_check = now + VERSION_CHECK_INTERVAL
+        version = get_users_version()
+        if version != self.version:
+            self.cache.clear()
+            self.version = version
+
+    def get_user(self, token):
+        """
+        Returns a snapshot of the user the token belongs to, or None if the
+        token is not valid.
+        """
+
+        if self.cache is not None:
+            self.check_version()
+            expires, user = self.cache.get(token, (None, None))
+            if user is not None:
+                if expires > time.time():
+                    return user
+
+                self.cache.pop(token)
+
+                return None
+
+        user = User.verify_auth_token(token)
+        if user is None:
+            return None
+
+        user = UserSnapshot(user)
+        if self.cache is not None:
+            self.cache.set(token, (get_expiration(token), user))
+
+        return user
+
+    def invalidate(self, pk):
+        """
+        Forgets all the tokens of the user with the given primary key, and
+        tells the other processes to forget theirs. To be called once the
+        changes to the user are committed.
+        """
+
+        if self.cache is not None:
+            pk = uuid.UUID(str(pk))
+            self.cache.discard(lambda entry: entry[1].pk == pk)
+
+        increment_users_version()
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+
+def get_users_version():
+    version = db.session.execute(
+        select([func.max(users_version.c.version)])).scalar()
+
+    return version or 0
+
+
+def increment_users_version():
+    updated = db.session.execute(users_version.update().values(
+        version=users_version.c.version + 1)).rowcount
+    if not updated:
+        db.session.execute(users_version.insert().values(version=1))
+    db.session.commit()
+
+
+def get_expiration(token):
+    """Returns the time the token expires at, or 0 if it's not valid."""
+
+    try:
+        payload, header = Serializer(app.config['SECRET_KEY']).loads(
+            token, return_header=True)
+    except BadSignature:
+        return 0
+
+    return header['exp']
+
+
+token_cache = TokenCache()
+metrics.watch_cache('auth_tokens', lambda: token_cache.cache)
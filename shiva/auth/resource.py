@@ -2,6 +2,7 @@
 from flask import g, request
 from flask.ext.restful import abort, Resource
 
+from shiva.auth.cache import token_cache
 from shiva.constants import HTTP
 from shiva.models import User
 
@@ -9,14 +10,14 @@ from shiva.models import User
 def verify_credentials(app):
     g.user = None
 
-    if request.path == '/users/login/':
+    if request.path in ('/users/login/', '/metrics'):
         return None
 
     if app.config.get('ALLOW_ANONYMOUS_ACCESS', False):
         return None
 
     token = request.args.get('token', '')
-    user = User.verify_auth_token(token)
+    user = token_cache.get_user(token)
 
     if not user:
         abort(HTTP.UNAUTHORIZED)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from shiva.admin import main as admin
 from shiva.app import main as server
+from shiva.asyncfileserver import main as async_fileserver
 from shiva.fileserver import main as fileserver
 from shiva.indexer import main as indexer
 
-__all__ = [admin, server, fileserver, indexer]
+__all__ = [admin, server, async_fileserver, fileserver, indexer]
@@ -6,6 +6,30 @@ from shiva.media import MimeType
 DEBUG = True
 
 SQLALCHEMY_DATABASE_URI = 'sqlite:///shiva.db'
+# Keys of the SQLALCHEMY_BINDS that are read replicas of the database above.
+# Requests that don't change anything read from one of them, e.g.:
+# SQLALCHEMY_BINDS = {'replica': 'postgresql://shiva@replica/shiva'}
+# SQLALCHEMY_READ_BINDS = ('replica',)
+SQLALCHEMY_READ_BINDS = ()
+# Store primary and foreign keys as 16 raw bytes instead of 32 hex digits, on
+# databases other than PostgreSQL, which has a native type for them. Smaller
+# keys make for smaller indexes and faster joins. Existing SQLite databases
+# must be converted first with `shiva-admin db guids binary`.
+BINARY_GUIDS = False
+
+# Applied to every new SQLite connection. Write-ahead logging lets the API keep
+# reading while the indexer writes. With it, synchronous=NORMAL is still safe
+# from corruption, only the last transactions may be lost on a power failure.
+# mmap_size is in bytes, a negative cache_size in KiB and busy_timeout in
+# milliseconds. See https://www.sqlite.org/pragma.html
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16 * 1024,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
 ACCEPTED_FORMATS = (
     'mp3',
 )
@@ -23,6 +47,93 @@ DEFAULT_ARTIST_IMAGE = 'http://www.super8duncan.com/images/band_silhouette.jpg'
 # Compress all responses with gzip. Will be ignored in DEBUG mode.
 USE_GZIP = True
 
+# Large responses are serialized while they are being sent, instead of being
+# built in memory first. This applies to full trees and to lists requested with
+# a page_size of at least STREAMING_MIN_PAGE_SIZE items. When streaming, rows
+# are fetched from the database in batches of STREAMING_YIELD_PER.
+STREAM_RESPONSES = True
+STREAMING_MIN_PAGE_SIZE = 100
+STREAMING_YIELD_PER = 100
+
+# Maximum number of ids accepted in a single request for many objects, like
+# /tracks/?ids=<id>,<id>. Keep it below 999 when using SQLite, its limit of
+# parameters per query.
+MAX_IDS_PER_REQUEST = 500
+
+# Keep the names of artists, albums and tracks in memory to serve as-you-type
+# suggestions through /suggest/. Disable it to save memory on huge libraries.
+SUGGEST_ENABLED = True
+
+# Verified authentication tokens are cached for AUTH_CACHE_TTL seconds, saving
+# a query for every request. Changes to users, made by any process of the API
+# or shiva-admin, empty the caches within a second. Expired tokens are always
+# rejected. Set it to 0 to disable the cache.
+AUTH_CACHE_TTL = 60
+AUTH_CACHE_SIZE = 1024
+
+# Write the log from a background thread, so the indexer and the requests never
+# wait for the terminal or disk. Threads don't survive a fork, so leave it off
+# if the WSGI server forks its workers after loading Shiva.
+LOG_QUEUE = False
+
+# Adds a Server-Timing header to the responses, with the time spent on the
+# database and marshalling, and logs the requests slower than SLOW_REQUEST_MS
+# milliseconds or running SLOW_REQUEST_QUERIES SQL statements or more.
+PROFILE_REQUESTS = False
+SLOW_REQUEST_MS = 500
+SLOW_REQUEST_QUERIES = 50
+
+# Serve metrics in Prometheus' text format from /metrics, in both the API and
+# the file server, to the addresses in METRICS_ALLOWED_IPS (None for anyone).
+METRICS_ENABLED = False
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# Let the web server in front of shiva-fileserver send the files, once Shiva
+# has found them: 'x-accel-redirect' for nginx, 'x-sendfile' for Apache's
+# mod_xsendfile or lighttpd. With nginx the files are sent from the internal
+# location SENDFILE_PREFIX, which has to be an alias of the root directory.
+SENDFILE = None
+SENDFILE_PREFIX = '/_sendfile'
+
+# shiva-fileserver remembers where the last FILESERVER_PATH_CACHE_SIZE files
+# requested are (0 to disable it). Files not found are looked for again after
+# FILESERVER_PATH_CACHE_TTL seconds, and the ones found, if they are moved.
+FILESERVER_PATH_CACHE_SIZE = 4096
+FILESERVER_PATH_CACHE_TTL = 60
+
+# Limits of the bandwidth of the file server, in bytes per second (None for no
+# limit). Tracks are sent at STREAM_BITRATE_MULTIPLIER times their bitrate
+# (e.g. 2), and any other file at STREAM_RATE_LIMIT. USER_RATE_LIMIT is shared
+# by all the files sent at once to a user, or to an address, and can be set for
+# some users in USER_RATE_LIMITS, by email. EGRESS_RATE_LIMIT is the total,
+# shared fairly among the files being sent.
+STREAM_BITRATE_MULTIPLIER = None
+STREAM_RATE_LIMIT = None
+USER_RATE_LIMIT = None
+USER_RATE_LIMITS = {}
+EGRESS_RATE_LIMIT = None
+# The limits are signed into the URLs of the files, which are valid for
+# STREAM_TOKEN_MAX_AGE seconds. Changes to them reach the URLs already given
+# out once they expire, and expired URLs get the defaults above.
+STREAM_TOKEN_MAX_AGE = 24 * 60 * 60
+
+# Tracks are converted in the background, TRANSCODING_WORKERS at a time in each
+# process of the API. Conversions taking more than TRANSCODING_TIMEOUT seconds
+# are stopped, and failed ones are tried again when requested
+# TRANSCODING_RETRY_DELAY seconds later. With TRANSCODING_PROGRESSIVE, the
+# output of a conversion is sent while it's being converted, instead of asking
+# clients to come back when it's done.
+TRANSCODING_WORKERS = 2
+TRANSCODING_TIMEOUT = 3600
+TRANSCODING_RETRY_DELAY = 300
+TRANSCODING_PROGRESSIVE = False
+
+# Converted tracks are kept next to the originals, unless TRANSCODE_CACHE_DIR
+# is set. There, the ones played least recently are removed when they take more
+# than TRANSCODE_CACHE_SIZE bytes (None for no limit).
+TRANSCODE_CACHE_DIR = None
+TRANSCODE_CACHE_SIZE = None
+
 # https://en.wikipedia.org/wiki/Cross-origin_resource_sharing
 CORS_ENABLED = False
 # CORS_ALLOWED_ORIGINS accepts the following values:
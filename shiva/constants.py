@@ -9,3 +9,6 @@ class HTTP:
     METHOD_NOT_ALLOWED = 405
     CONFLICT = 409
     UNSUPPORTED_MEDIA_TYPE = 415
+    REQUESTED_RANGE_NOT_SATISFIABLE = 416
+    INTERNAL_SERVER_ERROR = 500
+    SERVICE_UNAVAILABLE = 503
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
+from calendar import timegm
+from time import sleep, time
 import os
 import subprocess
+import threading
 import urllib
 
 from flask import current_app as app
 
-from shiva.exceptions import InvalidMimeTypeError
+from shiva import metrics, throttle, transcodecache
+from shiva.exceptions import ConversionError, InvalidMimeTypeError
 from shiva.media import MimeType
+from shiva.utils import ignored
+
+# Bytes read at once from ffmpeg, and from the files being converted.
+CHUNK_SIZE = 64 * 1024
+# Seconds between checks for more output of a conversion being followed.
+POLL_INTERVAL = 0.05
+# Seconds without new output after which a conversion is no longer followed.
+STALL_TIMEOUT = 30
 
 
 def get_converter():
@@ -99,6 +111,10 @@ class Converter(object):
         if self.fullpath:
             return self.fullpath
 
+        cache = self.get_cache()
+        if cache is not None:
+            return cache.get_path(self.track.path, self.mimetype.extension)
+
         directory = self.get_dest_directory()
         filename = self.get_dest_filename()
 
@@ -110,8 +126,22 @@ class Converter(object):
 
         return ''.join((app.config.get('SERVER_URI') or '', uri))
 
+    def get_cache(self):
+        """
+        Returns the cache of converted tracks the track goes in (see
+        `shiva.transcodecache`), or None if it's kept next to the original.
+        """
+
+        # Tracks in their original format are not converted.
+        if self.track.path.endswith(self.mimetype.extension):
+            return None
+
+        return transcodecache.get_cache()
+
     def get_uri(self):
-        if self.converted_file_exists():
+        # Tracks in the cache may be removed from it at any time, so they are
+        # always asked for to the API, which also keeps track of their use.
+        if self.get_cache() is None and self.converted_file_exists():
             self.uri = self.get_file_uri()
         else:
             self.uri = self.get_conversion_uri()
@@ -119,23 +149,224 @@ class Converter(object):
         return self.uri
 
     def get_file_uri(self):
-        for mdir in app.config['MEDIA_DIRS']:
-            return mdir.urlize(self.get_dest_fullpath())
+        """
+        Returns the URL of the converted file in the file server of the media
+        directory it belongs to, which finds it and sends it (or lets the web
+        server send it, see the SENDFILE setting). The URL includes the limits
+        of its bandwidth, if any (see shiva.throttle).
+        """
 
-    def convert(self):
         path = self.get_dest_fullpath()
-        if self.converted_file_exists():
-            return path
+        media_dirs = app.config['MEDIA_DIRS']
+        mdirs = [mdir for mdir in media_dirs if mdir.allowed_to_stream(path)]
+        # Uploaded and cached tracks are served by the first media directory.
+        mdirs = mdirs or list(media_dirs)
+        if not mdirs:
+            return None
+
+        mdir = mdirs[0]
+        uri = mdir.urlize(path)
+        if not uri:
+            return uri
+
+        # The path the file server gets, the limits are only valid for it.
+        relative_path = uri
+        if mdir.url:
+            relative_path = urllib.unquote(uri[len(mdir.url.rstrip('/')):])
+        token = throttle.get_stream_token(relative_path.lstrip('/'),
+                                          self.track.bitrate)
+        if token:
+            uri = '%s?%s' % (uri, urllib.urlencode({'stream': token}))
+
+        return uri
+
+    def get_command(self, path):
+        """Returns the ffmpeg command that converts the track into `path`."""
 
         # Don't do app.config.get('FFMPEG_PATH', 'ffmpeg'). That will cause an
         # error when FFMPEG_PATH is set to None or empty string.
         ffmpeg = app.config.get('FFMPEG_PATH') or 'ffmpeg'
-        cmd = [ffmpeg, '-i', self.track.path, '-aq', '60', '-acodec',
-               self.mimetype.acodec, path]
 
-        proc = subprocess.call(cmd)
+        return [ffmpeg, '-i', self.track.path, '-aq', '60', '-acodec',
+                self.mimetype.acodec, '-f', self.mimetype.format, '-y', path]
+
+    def get_part_path(self):
+        """Returns the path of the converted file while it's being written."""
+
+        return '%s.part' % self.get_dest_fullpath()
+
+    def convert(self):
+        """
+        Converts the track, unless it's already converted, and returns the
+        path of the converted file. It's written under a temporary name, and
+        renamed when complete, so a file half converted is never served.
+        Raises ConversionError if ffmpeg fails or takes more than the
+        TRANSCODING_TIMEOUT setting.
+
+        With the TRANSCODING_PROGRESSIVE setting ffmpeg writes to a pipe,
+        copied to the file as it comes, so it can be sent while it's being
+        converted (see `open_partial_file()`). ffmpeg can't go back to fill in
+        the headers of a pipe, so what's sent is never changed afterwards.
+        """
+
+        path = self.get_dest_fullpath()
+        if self.converted_file_exists():
+            return path
+
+        part_path = self.get_part_path()
+        # Left by a conversion that didn't end. Removed rather than truncated,
+        # so whoever still follows it sees it end.
+        with ignored(OSError):
+            os.unlink(part_path)
+        timeout = app.config.get('TRANSCODING_TIMEOUT')
+        timed_out = threading.Event()
+        status = None
+        try:
+            with metrics.CONVERSION_DURATION.time(
+                    mimetype=str(self.mimetype)):
+                status = self.run_ffmpeg(part_path, timeout, timed_out)
+        finally:
+            if status != 0:
+                with ignored(OSError):
+                    os.unlink(part_path)
+
+        if status != 0:
+            if timed_out.is_set():
+                raise ConversionError('Conversion of %s to %s took more than '
+                                      '%s seconds' % (self.track.path,
+                                                      self.mimetype, timeout))
+
+            raise ConversionError('Conversion of %s to %s failed, ffmpeg '
+                                  'exited with status %s' % (
+                                      self.track.path, self.mimetype, status))
+
+        os.rename(part_path, path)
+
+        cache = self.get_cache()
+        if cache is not None:
+            cache.add(path)
 
         return path
 
+    def run_ffmpeg(self, part_path, timeout, timed_out):
+        """
+        Runs ffmpeg, killing it after `timeout` seconds and setting the
+        `timed_out` event if so, and returns its exit status.
+        """
+
+        output = None
+        if app.config.get('TRANSCODING_PROGRESSIVE'):
+            # Created before ffmpeg starts, for the listeners to find it.
+            output = open(part_path, 'wb')
+            proc = subprocess.Popen(self.get_command('pipe:1'),
+                                    stdout=subprocess.PIPE)
+        else:
+            proc = subprocess.Popen(self.get_command(part_path))
+
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            if output is not None:
+                with output:
+                    fd = proc.stdout.fileno()
+                    for chunk in iter(lambda: os.read(fd, CHUNK_SIZE), ''):
+                        output.write(chunk)
+                        output.flush()
+
+            return proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+
+    def open_partial_file(self, get_started, timeout=0):
+        """
+        Returns a PartialFile with the output of the conversion in progress,
+        waiting up to `timeout` seconds for it to start. Returns None if the
+        track isn't being converted.
+
+        `get_started()` returns when the conversion running was started (UTC),
+        or None if it isn't running. Files written before, left by conversions
+        that didn't end, are not followed.
+        """
+
+        part_path = self.get_part_path()
+        deadline = time() + timeout
+        while True:
+            started = get_started()
+            if started is not None:
+                try:
+                    f = open(part_path, 'rb')
+                except IOError:
+                    pass
+                else:
+                    if os.fstat(f.fileno()).st_mtime >= timegm(
+                            started.utctimetuple()):
+                        return PartialFile(f, part_path,
+                                           self.get_dest_fullpath())
+                    f.close()
+
+            if time() >= deadline:
+                return None
+
+            sleep(POLL_INTERVAL)
+
     def converted_file_exists(self):
         return os.path.exists(self.get_dest_fullpath())
+
+    def lookup(self):
+        """
+        Like `converted_file_exists()`, for the requests of the track, which
+        are counted, and mark it as used if it's in the cache.
+        """
+
+        cache = self.get_cache()
+        if cache is None:
+            return self.converted_file_exists()
+
+        return cache.lookup(self.get_dest_fullpath())
+
+
+class PartialFile(object):
+    """
+    Iterates over a file while it's being converted, from the beginning and as
+    it's written, until the conversion is over. Raises ConversionError if the
+    conversion fails, or after STALL_TIMEOUT seconds without new data, so the
+    response is cut off instead of ending as if it was complete.
+    """
+
+    def __init__(self, f, part_path, path):
+        self.f = f
+        self.part_path = part_path
+        self.path = path
+
+    def __iter__(self):
+        last_read = time()
+        while True:
+            chunk = self.f.read(CHUNK_SIZE)
+            if chunk:
+                last_read = time()
+                yield chunk
+            elif not os.path.exists(self.part_path):
+                # Renamed once complete, or removed if it failed, after being
+                # closed. Whatever is left was written already.
+                for chunk in iter(lambda: self.f.read(CHUNK_SIZE), ''):
+                    yield chunk
+
+                if not os.path.exists(self.path):
+                    raise ConversionError('Conversion to %s failed while '
+                                          'being sent' % self.path)
+
+                return
+            elif time() - last_read > STALL_TIMEOUT:
+                raise ConversionError('Conversion to %s stalled while being '
+                                      'sent' % self.path)
+            else:
+                sleep(POLL_INTERVAL)
+
+    def close(self):
+        self.f.close()
@@ -1,15 +1,41 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy.types import TypeDecorator, CHAR
+from binascii import hexlify, unhexlify
+from sqlalchemy.types import BINARY, CHAR, LargeBinary, TypeDecorator
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 
 
+def _make_uuid(integer, new=object.__new__, UUID=uuid.UUID):
+    """
+    Builds a UUID from its integer value. Equivalent to ``uuid.UUID(int=...)``
+    without the argument checks, which are most of its cost, as values coming
+    from the database are known to be valid.
+    """
+
+    guid = new(UUID)
+    guid.__dict__['int'] = integer
+
+    return guid
+
+
+def _to_uuid(value):
+    if isinstance(value, uuid.UUID):
+        return value
+
+    return uuid.UUID(value)
+
+
 class GUID(TypeDecorator):
     """
     Platform-independent GUID type.
 
     Uses Postgresql's UUID type, otherwise uses CHAR(32), storing as
-    stringified hex values.
+    stringified hex values. If ``GUID.binary`` is set, the 16 bytes of the
+    UUID are stored instead, in a BINARY(16) or BLOB column, which halves the
+    size of keys and of the indexes on them.
+
+    Values are always returned as ``uuid.UUID`` instances, and can be given as
+    such or as strings.
 
     From: http://docs.sqlalchemy.org/en/latest/core/types.html#backend-\
     agnostic-guid-type
@@ -18,26 +44,67 @@ class GUID(TypeDecorator):
 
     impl = CHAR
 
+    # Set from the BINARY_GUIDS setting. A database must be converted with
+    # `shiva-admin db guids` when changing it.
+    binary = False
+
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(UUID())
+        elif self.binary:
+            if dialect.name == 'sqlite':
+                return dialect.type_descriptor(LargeBinary())
+
+            return dialect.type_descriptor(BINARY(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
-    def process_bind_param(self, value, dialect):
-        if value is None:
-            return value
-        elif dialect.name == 'postgresql':
-            return str(value)
+    # The processors are built once per dialect, so the storage is chosen only
+    # once and not for every value.
+
+    def bind_processor(self, dialect):
+        if dialect.name == 'postgresql':
+            def process(value):
+                if value is None:
+                    return value
+
+                return str(value)
+        elif self.binary:
+            Binary = dialect.dbapi.Binary
+
+            def process(value):
+                if value is None:
+                    return value
+
+                # UUID.bytes builds the string one byte at a time.
+                return Binary(unhexlify('%032x' % _to_uuid(value).int))
         else:
-            if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value)
-            else:
-                # hexstring
-                return "%.32x" % value
-
-    def process_result_value(self, value, dialect):
-        if value is None:
-            return value
+            def process(value):
+                if value is None:
+                    return value
+
+                return '%032x' % _to_uuid(value).int
+
+        return process
+
+    def result_processor(self, dialect, coltype):
+        if dialect.name == 'postgresql':
+            def process(value):
+                if value is None:
+                    return value
+
+                return uuid.UUID(value)
+        elif self.binary:
+            def process(value):
+                if value is None:
+                    return value
+
+                return _make_uuid(int(hexlify(value), 16))
         else:
-            return uuid.UUID(value)
+            def process(value):
+                if value is None:
+                    return value
+
+                return _make_uuid(int(value, 16))
+
+        return process
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Tuning of the connections to the database, and timing of their statements.
+
+SQLite's defaults favour safety over concurrency: while a transaction is
+writing, like the indexer's, nobody else can read from the database. The
+pragmas in the SQLITE_PRAGMAS setting are applied to every new SQLite
+connection, and the default ones switch to write-ahead logging, where readers
+never wait for writers.
+
+Every statement is timed once, for all the functions registered with
+`on_query()`, like the profiler's and the metrics'.
+
+See https://www.sqlite.org/pragma.html
+"""
+from time import time
+import re
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from shiva.utils import get_logger
+
+log = get_logger()
+
+NAME_RE = re.compile(r'^[a-z_]+$')
+VALUE_RE = re.compile(r'^-?\w+$')
+
+# Applied first, as some of the others depend on it.
+FIRST = ('journal_mode',)
+
+_pragmas = []
+_query_listeners = []
+
+
+def set_sqlite_pragmas(pragmas):
+    """
+    Sets the pragmas applied to new SQLite connections, given as a dict of
+    names and values. Connections already open are not affected.
+    """
+
+    for name, value in pragmas.iteritems():
+        if not NAME_RE.match(name) or not VALUE_RE.match(str(value)):
+            raise ValueError('Invalid pragma: %s = %s' % (name, value))
+
+    _pragmas[:] = sorted(pragmas.iteritems(),
+                         key=lambda item: (item[0] not in FIRST, item[0]))
+
+
+def get_sqlite_pragmas():
+    return list(_pragmas)
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return None
+
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def on_query(listener):
+    """
+    Registers a function to be called with every SQL statement run, its
+    parameters and the seconds it took. Statements that fail are left out.
+    """
+
+    _query_listeners.append(listener)
+
+    return listener
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if _query_listeners:
+        conn.info.setdefault('query_start', []).append(time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return None
+
+    duration = time() - starts.pop()
+    for listener in _query_listeners:
+        listener(statement, parameters, duration)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _fail_query(context):
+    # Failed statements never reach _end_query.
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
@@ -36,5 +36,9 @@ class InvalidFileTypeError(Exception):
     pass
 
 
+class ConversionError(Exception):
+    pass
+
+
 class ObjectExistsError(Exception):
     pass
@@ -1,20 +1,59 @@
 # -*- coding: utf-8 -*-
+from collections import deque
+from datetime import datetime
 import mimetypes
 import os
 import re
 import sys
+import urllib
+import uuid
 
-from flask import abort, Flask, Response, request, send_file
+from flask import abort, Flask, Response, request
+from werkzeug.http import (is_resource_modified, parse_date, quote_etag,
+                           unquote_etag)
+from werkzeug.wsgi import wrap_file
 
+from shiva import metrics, throttle
 from shiva.config import Configurator
 from shiva.constants import HTTP
-from shiva.utils import get_logger
+from shiva.utils import get_logger, LRUCache
 
 app = Flask(__name__)
 app.config.from_object(Configurator())
 
+metrics.init_app(app)
+
 log = get_logger()
 RANGE_RE = re.compile(r'(\d*)-(\d*)')
+BYTE_RANGE_RE = re.compile(r'^(\d*)-(\d*)$')
+# Size, in bytes, of the chunks in which files are read, when the WSGI server
+# can't send them on its own.
+CHUNK_SIZE = 64 * 1024
+# Smaller chunks for the streams with a limited rate, so they flow evenly.
+THROTTLED_CHUNK_SIZE = 16 * 1024
+# Headers that hand the sending of a file over to the web server, by value of
+# the SENDFILE setting.
+SENDFILE_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+MISSING = object()
+
+
+def get_path_cache():
+    size = app.config.get('FILESERVER_PATH_CACHE_SIZE', 4096)
+    if not size:
+        return None
+
+    return LRUCache(size, ttl=app.config.get('FILESERVER_PATH_CACHE_TTL', 60))
+
+
+# Absolute path of the files requested, by relative path. See resolve_path().
+path_cache = get_path_cache()
+metrics.watch_cache('fileserver_paths', lambda: path_cache)
+
+# Shares the bandwidth among the files being sent. See shiva.throttle.
+scheduler = throttle.Scheduler(app.config.get('EGRESS_RATE_LIMIT'))
 
 
 @app.after_request
@@ -25,24 +64,68 @@ def after_request(response):
 
 
 def get_absolute_path(relative_path):
+    """
+    Returns the path of the file in the media directories, or in the uploads
+    or converted tracks directories, or None if it doesn't exist or is outside
+    of them.
+    """
+
     for mdir in app.config.get('MEDIA_DIRS', []):
-        full_path = os.path.join(mdir.root, relative_path)
+        full_path = os.path.normpath(os.path.join(mdir.root, relative_path))
+        if not mdir.allowed_to_stream(full_path):
+            continue
 
         for excluded in mdir.get_excluded_dirs():
-            if full_path.startswith(excluded):
+            if full_path.startswith(os.path.join(excluded, '')):
                 return None
 
         if os.path.exists(full_path):
             return full_path
 
-    upath = app.config.get('UPLOAD_PATH')
-    full_path = os.path.join(upath, relative_path)
-    if os.path.exists(full_path):
-        return full_path
+    for path in (app.config.get('UPLOAD_PATH'),
+                 app.config.get('TRANSCODE_CACHE_DIR')):
+        if path:
+            full_path = os.path.normpath(os.path.join(path, relative_path))
+            if full_path.startswith(os.path.join(path, '')) and \
+                    os.path.exists(full_path):
+                return full_path
 
     return None
 
 
+def resolve_path(relative_path):
+    """
+    Like get_absolute_path(), but remembers the result, found or not, for a
+    while. Returns a tuple with the absolute path of the file and the result of
+    os.stat() on it, which also makes sure it's still there, or (None, None).
+    """
+
+    for _ in range(2):
+        absolute_path = MISSING
+        if path_cache is not None:
+            absolute_path = path_cache.get(relative_path, MISSING)
+
+        cached = absolute_path is not MISSING
+        if not cached:
+            absolute_path = get_absolute_path(relative_path)
+            if path_cache is not None:
+                path_cache.set(relative_path, absolute_path)
+
+        if absolute_path is None:
+            return None, None
+
+        try:
+            return absolute_path, os.stat(absolute_path)
+        except OSError:
+            if not cached:
+                return None, None
+
+            # Moved or deleted since it was found, look for it again.
+            path_cache.pop(relative_path)
+
+    return None, None
+
+
 def get_range_bytes(range_header):
     """
     Returns a tuple of the form (start_byte, end_byte) with the information
@@ -70,33 +153,324 @@ def get_range_bytes(range_header):
     return (start_byte, end_byte)
 
 
-@app.route('/<path:relative_path>')
-def serve(relative_path):
-    absolute_path = get_absolute_path(relative_path)
-    if not absolute_path:
-        abort(HTTP.NOT_FOUND)
+def parse_range_header(range_header, size):
+    """
+    Returns the list of ranges asked for in a Range header, as tuples of the
+    first and last byte (both included), for a file of `size` bytes. Ranges
+    beyond the end of the file are left out, so an empty list means none can
+    be satisfied. Overlapping and adjacent ranges are merged.
+
+    Returns None if the header is not valid, and must then be ignored. See RFC
+    7233, section 2.1.
+    """
+
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs:
+        return None
+
+    for spec in specs:
+        match = BYTE_RANGE_RE.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            # The last `last` bytes.
+            first, last = max(size - int(last), 0), size - 1
+            if first > last:
+                continue
+        else:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            if first >= size:
+                continue
+            last = int(last) if last else size - 1
+
+        ranges.append((first, min(last, size - 1)))
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+
+    return merged
+
+
+class FileRange(object):
+    """
+    File-like object giving access to `length` bytes of the file `f`, starting
+    at `start`, for `wsgi.file_wrapper`.
+
+    WSGI servers able to send files on their own, with sendfile(), look for a
+    `fileno()` method and send from the current position of the file onwards.
+    It's only offered when the range reaches the end of the file, like the
+    `bytes=<start>-` ranges players ask for, as not every server stops after
+    Content-Length bytes, and the rate of the stream is not limited. Otherwise
+    the range is read in chunks.
+
+    With a `throttle.Stream`, read() waits until the stream can send the
+    data, unless `wait` is false, leaving it to the caller.
+
+    The bytes read are counted as sent, and the ones sent from `fileno()` when
+    closed, from the position the server left the file at, so ranges dropped
+    midway, as players do when seeking, only count what was sent.
+    """
+
+    def __init__(self, f, start, length, size, stream=None):
+        f.seek(start)
+
+        self.file = f
+        self.start = start
+        self.remaining = length
+        self.stream = stream
+        self.closed = False
+        # Bytes already counted in FILESERVER_BYTES.
+        self.counted = 0
+        if start + length == size and stream is None:
+            self.fileno = f.fileno
+
+        metrics.FILESERVER_STREAMS.inc()
+
+    def read(self, size=-1, wait=True):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        self.counted += len(data)
+        metrics.FILESERVER_BYTES.inc(len(data))
+        if wait and self.stream is not None:
+            self.stream.consume(len(data))
+
+        return data
+
+    def close(self):
+        if self.closed:
+            return None
+
+        self.closed = True
+        # Sent without being read, with sendfile().
+        unread = self.file.tell() - self.start - self.counted
+        if unread > 0:
+            metrics.FILESERVER_BYTES.inc(unread)
+        self.file.close()
+        if self.stream is not None:
+            self.stream.close()
+        metrics.FILESERVER_STREAMS.dec()
+
+
+def offload(absolute_path):
+    """
+    Returns an empty response telling the web server in front of Shiva to
+    send the file itself, ranges and all, as set by the SENDFILE setting.
+    nginx needs an internal location, SENDFILE_PREFIX, mapped to the root of
+    the filesystem.
+    """
 
-    range_header = request.headers.get('Range', None)
-    if not range_header:
-        return send_file(absolute_path)
+    mode = app.config.get('SENDFILE')
+    if mode not in SENDFILE_HEADERS:
+        raise ValueError('Unknown SENDFILE mode: %s' % mode)
 
-    size = os.path.getsize(absolute_path)
-    start_byte, end_byte = get_range_bytes(range_header)
-    length = (end_byte or size) - start_byte
+    path = absolute_path
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
 
-    content = None
-    with open(absolute_path, 'rb') as f:
-        f.seek(start_byte)
-        content = f.read(length)
+    if mode == 'x-accel-redirect':
+        prefix = app.config.get('SENDFILE_PREFIX', '/_sendfile').rstrip('/')
+        path = prefix + urllib.quote(path)
 
-    status_code = 206  # Partial Content
     mimetype = mimetypes.guess_type(absolute_path)[0]
-    response = Response(content, status_code, mimetype=mimetype,
-                        direct_passthrough=True)
+    response = Response(mimetype=mimetype or 'application/octet-stream')
+    response.headers[SENDFILE_HEADERS[mode]] = path
+    metrics.FILESERVER_OFFLOADS.inc()
+
+    return response
+
+
+class MultipartRanges(object):
+    """
+    File-like object giving the `ranges` of the file at `absolute_path` as a
+    multipart/byteranges body, for `wsgi.file_wrapper`. Like `FileRange`,
+    reads wait for `stream`, if given, unless `wait` is false.
+    """
+
+    def __init__(self, absolute_path, ranges, size, mimetype, boundary,
+                 stream=None):
+        self.file = open(absolute_path, 'rb')
+        self.stream = stream
+        self.closed = False
+        # Pieces of the body left: strings, or (start, length) of the file.
+        self.parts = deque()
+        for first, last in ranges:
+            self.parts.append(get_part_header(boundary, mimetype, first, last,
+                                              size))
+            self.parts.append((first, last - first + 1))
+        self.parts.append('\r\n--%s--\r\n' % boundary)
+
+        metrics.FILESERVER_STREAMS.inc()
+
+    def read(self, size=-1, wait=True):
+        """Returns up to `size` bytes, of one part of the body at most."""
+
+        while self.parts:
+            part = self.parts.popleft()
+            if isinstance(part, str):
+                return part
+
+            start, length = part
+            self.file.seek(start)
+            data = self.file.read(length if size < 0 else min(size, length))
+            if not data:
+                continue
+
+            if len(data) < length:
+                self.parts.appendleft((start + len(data), length - len(data)))
+            metrics.FILESERVER_BYTES.inc(len(data))
+            if wait and self.stream is not None:
+                self.stream.consume(len(data))
+
+            return data
+
+        return ''
+
+    def close(self):
+        if self.closed:
+            return None
+
+        self.closed = True
+        self.file.close()
+        if self.stream is not None:
+            self.stream.close()
+        metrics.FILESERVER_STREAMS.dec()
+
+
+def get_part_header(boundary, mimetype, first, last, size):
+    return ('\r\n--%s\r\nContent-Type: %s\r\n'
+            'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, mimetype, first, last, size))
+
+
+def get_ranges(etag, last_modified, size):
+    """
+    Returns the ranges of the file to send, or None if it has to be sent
+    whole, because the client didn't ask for a range, the range is not valid
+    or the file changed since the client got the rest (If-Range).
+    """
+
+    range_header = request.headers.get('Range')
+    if not range_header or request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if_range_date = parse_date(if_range)
+        if if_range_date is not None:
+            if if_range_date != last_modified:
+                return None
+        elif unquote_etag(if_range) != (etag, False):
+            return None
+
+    return parse_range_header(range_header, size)
+
+
+def get_stream_limits(relative_path):
+    """
+    Returns the arguments of `scheduler.open()` for the file requested, from
+    the limits signed in its URL, if any, or None if it's not limited.
+    """
+
+    limit, user, user_limit = throttle.load_stream_token(
+        request.args.get('stream'), relative_path) or (None, None, None)
+    if limit is None:
+        limit = app.config.get('STREAM_RATE_LIMIT')
+    if user is None:
+        user = request.remote_addr
+        user_limit = app.config.get('USER_RATE_LIMIT')
+
+    if limit is None and user_limit is None and scheduler.rate is None:
+        return None
+
+    return limit, user, user_limit
+
+
+@app.route('/<path:relative_path>')
+def serve(relative_path):
+    absolute_path, stat = resolve_path(relative_path)
+    if not absolute_path:
+        abort(HTTP.NOT_FOUND)
 
-    crange = 'bytes %d-%d/%d' % (start_byte, start_byte + length - 1, size)
-    response.headers.add('Content-Range', crange)
-    response.headers.add('Content-Length', size)
+    if app.config.get('SENDFILE'):
+        return offload(absolute_path)
+
+    size = stat.st_size
+    etag = '%x-%x' % (int(stat.st_mtime), size)
+    last_modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+    mimetype = mimetypes.guess_type(absolute_path)[0] or \
+        'application/octet-stream'
+
+    response = Response(mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+
+    if not is_resource_modified(request.environ, quote_etag(etag),
+                                last_modified=last_modified):
+        response.status_code = 304  # Not Modified
+        return response
+
+    ranges = get_ranges(etag, last_modified, size)
+    if ranges == []:
+        response.status_code = HTTP.REQUESTED_RANGE_NOT_SATISFIABLE
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if ranges is None:
+        ranges = [(0, size - 1)]
+    else:
+        response.status_code = 206  # Partial Content
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        length = last - first + 1
+        if response.status_code == 206:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                first, last, size)
+    else:
+        boundary = uuid.uuid4().hex
+        length = len('\r\n--%s--\r\n' % boundary)
+        for first, last in ranges:
+            length += len(get_part_header(boundary, mimetype, first, last,
+                                          size))
+            length += last - first + 1
+
+        response.mimetype = 'multipart/byteranges'
+        response.headers['Content-Type'] = \
+            'multipart/byteranges; boundary=%s' % boundary
+
+    response.content_length = length
+    if request.method == 'HEAD':
+        # The file is not even opened.
+        return response
+
+    limits = get_stream_limits(relative_path)
+    stream = scheduler.open(*limits) if limits else None
+    if len(ranges) == 1:
+        f = open(absolute_path, 'rb')
+        body = FileRange(f, first, length, size, stream)
+    else:
+        body = MultipartRanges(absolute_path, ranges, size, mimetype,
+                               boundary, stream)
+    response.response = wrap_file(
+        request.environ, body,
+        buffer_size=CHUNK_SIZE if stream is None else THROTTLED_CHUNK_SIZE)
+    response.direct_passthrough = True
 
     return response
 
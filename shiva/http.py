@@ -1,14 +1,137 @@
 # -*- coding: utf-8 -*-
+from collections import Iterator
 from math import ceil
 import json
+import uuid
+import zlib
 
-from flask import current_app as app, Response, request, g
+from flask import (current_app as app, Response, request, g,
+                   stream_with_context)
 from flask.ext import restful
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import HTTPException
 
 from shiva.constants import HTTP
 from shiva.decorators import allow_origins, allow_method
+from shiva.profiling import timed, timed_iter
+from shiva.serializer import compile_fields
 from shiva.utils import parse_bool, unpack
 
+# Maximum number of serializers (one for each combination of the `fields` and
+# `embed` parameters) kept in memory for each resource.
+MAX_SERIALIZERS = 64
+# Size, in bytes, of the chunks in which streamed responses are sent.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+_encoder = json.JSONEncoder()
+
+
+def get_list_param(name):
+    """
+    Returns a set of the comma separated values given in the `name` GET
+    parameter, or None if the parameter is not present.
+
+    """
+
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    return frozenset(item.strip() for item in value.split(',') if item.strip())
+
+
+def materialize(obj):
+    """
+    Function meant to be used as the `default` parameter of `json.dumps()`.
+    Converts iterators (e.g., generators) into lists.
+
+    """
+
+    if isinstance(obj, Iterator):
+        return list(obj)
+
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def iterencode(data):
+    """
+    Generator that yields the JSON representation of `data` in pieces.
+    Iterators found in `data` are encoded as arrays as they are consumed, so
+    the whole structure never needs to be in memory at once.
+
+    """
+
+    if isinstance(data, Iterator):
+        yield '['
+        for index, item in enumerate(data):
+            if index:
+                yield ', '
+
+            for chunk in iterencode(item):
+                yield chunk
+
+        yield ']'
+    elif isinstance(data, dict) and any(isinstance(value, Iterator)
+                                        for value in data.itervalues()):
+        yield '{'
+        for index, (key, value) in enumerate(data.iteritems()):
+            if index:
+                yield ', '
+
+            yield '%s: ' % _encoder.encode(key)
+            for chunk in iterencode(value):
+                yield chunk
+
+        yield '}'
+    else:
+        yield _encoder.encode(data)
+
+
+def buffered(chunks, size=STREAM_CHUNK_SIZE):
+    """ Groups small chunks of data into others of at least `size` bytes. """
+
+    buf = []
+    buf_len = 0
+
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_len += len(chunk)
+
+        if buf_len >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_len = 0
+
+    if buf:
+        yield ''.join(buf)
+
+
+def gzip_chunks(chunks, level=6):
+    """ Compresses a stream of data on the fly, in gzip format. """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def accepts_gzip():
+    """
+    Checks if a streamed response should be gzipped, following the same rules
+    as Flask-Compress, which can't compress streamed responses.
+
+    """
+
+    if app.debug or not app.config.get('USE_GZIP', True):
+        return False
+
+    return 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
 
 class JSONResponse(restful.Response):
     """
@@ -34,22 +157,105 @@ class JSONResponse(restful.Response):
             params['status'] = 204
 
         if isinstance(params['response'], dict):
-            params['response'] = json.dumps(params['response'])
+            params['response'] = json.dumps(params['response'],
+                                            default=materialize)
 
         super(JSONResponse, self).__init__(**params)
 
 
+class StreamingJSONResponse(restful.Response):
+    """
+    A response that serializes its data to JSON while it's being sent, instead
+    of building the whole document in memory first. Iterators in the data,
+    like generators or database cursors, are consumed lazily. Must be created
+    inside a request context.
+    """
+
+    def __init__(self, data, status=200, headers=None):
+        headers = dict(headers or {})
+        chunks = timed_iter(buffered(iterencode(data)), 'marshal')
+
+        if accepts_gzip():
+            level = app.config.get('COMPRESS_LEVEL', 6)
+            chunks = gzip_chunks(chunks, level)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+
+        super(StreamingJSONResponse, self).__init__(
+            stream_with_context(chunks), status=status, headers=headers,
+            mimetype='application/json')
+
+
+class Api(restful.Api):
+    """
+    ``flask.ext.restful.Api`` that builds the method decorators of Shiva's
+    resources once, when they are registered, instead of on every request.
+    """
+
+    def add_resource(self, resource, *urls, **kwargs):
+        if issubclass(resource, Resource):
+            cors_enabled = self.app.config.get('CORS_ENABLED') is True
+            resource.build_pipeline(cors_enabled)
+
+        super(Api, self).add_resource(resource, *urls, **kwargs)
+
+
 class Resource(restful.Resource):
     Response = JSONResponse
 
-    def __new__(cls, *args, **kwargs):
-        cls.method_decorators.append(allow_method)
+    @classmethod
+    def build_pipeline(cls, cors_enabled=False):
+        """
+        Wraps the handler of each HTTP method of the class in `allow_method`,
+        `allow_origins` if `cors_enabled` is true and then the class' own
+        `method_decorators`. Unlike in flask-restful, decorators receive the
+        unbound function, which takes the resource as its first argument.
+        """
 
-        if app.config.get('CORS_ENABLED') is True:
+        decorators = [allow_method]
+        if cors_enabled:
             # Applies to all inherited resources
-            cls.method_decorators.append(allow_origins)
+            decorators.append(allow_origins)
+        decorators.extend(cls.method_decorators)
+
+        pipeline = {}
+        for method in cls.methods or ():
+            handler = getattr(cls, method.lower()).__func__
+            for decorator in decorators:
+                handler = decorator(handler)
+
+            pipeline[method] = handler
+
+        cls._pipeline = pipeline
+
+        return pipeline
+
+    def dispatch_request(self, *args, **kwargs):
+        cls = type(self)
+        if '_pipeline' not in cls.__dict__:
+            # Not registered through `shiva.http.Api`.
+            cls.build_pipeline(app.config.get('CORS_ENABLED') is True)
+
+        handler = cls._pipeline.get(request.method)
+        if handler is None and request.method == 'HEAD':
+            handler = cls._pipeline.get('GET')
+        assert handler is not None, 'Unimplemented method %r' % request.method
 
-        return super(Resource, cls).__new__(cls, *args, **kwargs)
+        resp = handler(self, *args, **kwargs)
+
+        if isinstance(resp, Response):
+            return resp
+
+        representations = self.representations or {}
+        for mediatype in self.mediatypes():
+            if mediatype in representations:
+                data, code, headers = restful.utils.unpack(resp)
+                resp = representations[mediatype](data, code, headers)
+                resp.headers['Content-Type'] = mediatype
+
+                return resp
+
+        return resp
 
     # Without this the shiva.decorator.allow_origins method won't get called
     # when issuing an OPTIONS request.
@@ -77,7 +283,10 @@ class Resource(restful.Resource):
             if not hasattr(self, 'db_model'):
                 restful.abort(HTTP.METHOD_NOT_ALLOWED)
 
-            result = self._all()
+            if 'ids' in request.args:
+                result = self._by_ids(request.args['ids'])
+            else:
+                result = self._all()
 
         return result
 
@@ -115,6 +324,8 @@ class Resource(restful.Resource):
     def _by_id(self, id):
         try:
             result = self.get_by_id(id)
+        except HTTPException:
+            raise
         except:
             restful.abort(HTTP.NOT_FOUND)
 
@@ -124,7 +335,53 @@ class Resource(restful.Resource):
         return result
 
     def get_by_id(self, id):
-        return self.db_model.query.get(id)
+        return self.load_only(self.db_model.query).get(id)
+
+    def _by_ids(self, ids):
+        """
+        Retrieves many objects at once, given a comma separated list of ids
+        (e.g. /tracks/?ids=<id>,<id>,<id>). The objects are returned in the
+        same order in which they were requested, the ids not found are listed
+        under the `missing` key.
+        """
+
+        ids = [id.strip() for id in ids.split(',') if id.strip()]
+        if not ids or len(ids) > app.config.get('MAX_IDS_PER_REQUEST', 500):
+            restful.abort(HTTP.BAD_REQUEST)
+
+        pks = {}
+        for id in ids:
+            try:
+                pks[id] = uuid.UUID(id)
+            except ValueError:
+                # Not a valid id, it will be reported as missing.
+                pass
+
+        objects = {}
+        if pks:
+            column = inspect(self.db_model).primary_key[0]
+            queryset = self.load_only(self.get_all())
+            for obj in queryset.filter(column.in_(set(pks.values()))):
+                objects[getattr(obj, column.key)] = obj
+
+        items = []
+        missing = []
+        seen = set()
+        for id in ids:
+            if id in seen:
+                continue
+
+            seen.add(id)
+            obj = objects.get(pks.get(id))
+            if obj is None:
+                missing.append(id)
+            else:
+                items.append(obj)
+
+        return {
+            'items': self.marshal(items),
+            'missing': missing,
+        }
 
     def _all(self):
         result = self.get_all()
@@ -162,6 +419,13 @@ class Resource(restful.Resource):
         return queryset
 
     def full_tree(self, result):
+        """
+        Returns the full tree of the object if the `fulltree` parameter is
+        set. The tree has its own representation, so combining it with the
+        `fields` or `embed` parameters will cause a 400 (Bad Request) status
+        code instead of silently ignoring them.
+        """
+
         if not hasattr(self, 'get_full_tree'):
             return result
 
@@ -169,19 +433,182 @@ class Resource(restful.Resource):
         full_tree = parse_bool(options.get('fulltree', ''))
 
         if full_tree:
-            return self.get_full_tree(result)
+            if 'fields' in options or 'embed' in options:
+                restful.abort(HTTP.BAD_REQUEST)
+
+            tree = self.get_full_tree(result)
+            if app.config.get('STREAM_RESPONSES'):
+                return StreamingJSONResponse(tree)
+
+            return self.Response(tree)
 
         return result
 
+    @classmethod
+    def get_fields(cls):
+        """
+        Returns the fields defined by `get_resource_fields()`. They are built
+        only once per class, the first time they are needed.
+        """
+
+        if '_resource_fields' not in cls.__dict__:
+            cls._resource_fields = cls.get_resource_fields()
+
+        return cls._resource_fields
+
+    @classmethod
+    def get_embeddable_fields(cls):
+        """
+        This method is supposed to be overriden by its children, to define the
+        related objects that can be expanded through the `embed` parameter.
+        The format is as follows:
+
+        {
+            'artists': ManyToManyField(Artist, ArtistResource.get_fields()),
+        }
+
+        """
+
+        return {}
+
+    @classmethod
+    def get_embeddable(cls):
+        """
+        Returns the fields defined by `get_embeddable_fields()`, built only
+        once per class.
+        """
+
+        if '_embeddable_fields' not in cls.__dict__:
+            cls._embeddable_fields = cls.get_embeddable_fields()
+
+        return cls._embeddable_fields
+
+    @classmethod
+    def get_serializer(cls, only=None, embed=None):
+        """
+        Returns a function that marshals objects (or lists of objects) of this
+        resource. See `shiva.serializer.compile_fields`.
+
+        If `only` is given, a set of field names, just those fields will be
+        included. The names in `embed`, if any, will be replaced by their
+        expanded version, defined in `get_embeddable_fields()`. Serializers are
+        compiled once for every combination.
+        """
+
+        if '_serializers' not in cls.__dict__:
+            cls._serializers = {}
+
+        key = (only, embed)
+        if key not in cls._serializers:
+            if len(cls._serializers) >= MAX_SERIALIZERS:
+                cls._serializers.clear()
+
+            cls._serializers[key] = cls.compile_serializer(only, embed)
+
+        return cls._serializers[key]
+
+    @classmethod
+    def compile_serializer(cls, only=None, embed=None):
+        resource_fields = dict(cls.get_fields())
+
+        if embed:
+            embeddable = cls.get_embeddable()
+            for name in embed:
+                resource_fields[name] = embeddable[name]
+
+        if only is not None:
+            only = only.union(embed or ())
+            resource_fields = dict((name, field) for name, field
+                                   in resource_fields.iteritems()
+                                   if name in only)
+
+        return compile_fields(resource_fields)
+
+    def get_sparse_fields(self):
+        """
+        Returns the set of field names requested through the `fields`
+        parameter (e.g. /tracks/?fields=id,title), or None if all of them were
+        requested. Unknown names will cause a 400 (Bad Request) status code.
+        """
+
+        names = get_list_param('fields')
+        if names is None:
+            return None
+
+        if not names.issubset(self.get_fields()):
+            restful.abort(HTTP.BAD_REQUEST)
+
+        return names
+
+    def get_embeds(self):
+        """
+        Returns the set of related objects requested to be expanded through
+        the `embed` parameter (e.g. /tracks/?embed=artists,albums).
+        """
+
+        names = get_list_param('embed')
+        if names is None:
+            return None
+
+        if not names.issubset(self.get_embeddable()):
+            restful.abort(HTTP.BAD_REQUEST)
+
+        return names
+
+    def load_only(self, queryset):
+        """
+        If the client asked only for some fields, avoids loading the columns
+        that are not needed to compute them. Fields other than the plain ones
+        can list the columns they depend on in a `columns` attribute.
+        """
+
+        names = self.get_sparse_fields()
+        if names is None or not hasattr(self, 'db_model'):
+            return queryset
+
+        model_columns = inspect(self.db_model).column_attrs.keys()
+        columns = set()
+        for name in names:
+            field = self.get_fields()[name]
+            attribute = getattr(field, 'attribute', None) or name
+            for column in getattr(field, 'columns', (attribute,)):
+                if column in model_columns:
+                    columns.add(column)
+
+        if not columns:
+            # Only the primary key, which is always loaded, is needed.
+            columns.add(inspect(self.db_model).primary_key[0].key)
+
+        return queryset.options(load_only(*columns))
+
+    def get_request_serializer(self):
+        """
+        Returns the serializer for the fields requested in the current request.
+        """
+
+        return self.get_serializer(self.get_sparse_fields(), self.get_embeds())
+
     def marshal(self, result):
-        if isinstance(result, dict):
+        if isinstance(result, (dict, Response)):
             return result
 
-        return restful.marshal(result, self.get_resource_fields())
+        with timed('marshal'):
+            return self.get_request_serializer()(result)
+
+    def should_stream(self, page_size):
+        """
+        Large pages are streamed, instead of being serialized in memory. The
+        threshold is set by the STREAMING_MIN_PAGE_SIZE setting.
+        """
+
+        if not app.config.get('STREAM_RESPONSES'):
+            return False
+
+        return page_size >= app.config.get('STREAMING_MIN_PAGE_SIZE', 100)
 
     def paginate(self, queryset):
         options = request.args.to_dict()
-        queryset = self.filter(queryset, options)
+        queryset = self.load_only(self.filter(queryset, options))
 
         try:
             page_number = int(options.get('page', 1))
@@ -195,12 +622,26 @@ class Resource(restful.Resource):
 
         count = queryset.count()
         total_pages = max(int(ceil(float(count) / float(limit))), 1)
-        items = queryset.limit(limit).offset(offset).all()
+        items = queryset.limit(limit).offset(offset)
 
-        return {
+        response = {
             'item_count': count,
-            'items': self.marshal(items),
             'page': page_number,
             'page_size': limit,
             'pages': total_pages,
         }
+
+        if self.should_stream(limit):
+            # Rows are fetched from a server side cursor, when the DB supports
+            # it, and marshalled one by one while the response is sent.
+            yield_per = app.config.get('STREAMING_YIELD_PER', 100)
+            rows = items.yield_per(yield_per).execution_options(
+                stream_results=True)
+            serialize = self.get_request_serializer()
+            response['items'] = (serialize(row) for row in rows)
+
+            return StreamingJSONResponse(response)
+
+        response['items'] = self.marshal(items.all())
+
+        return response
@@ -27,7 +27,7 @@ class LastFM(object):
         artist = self.cache.get(name, {}).get('object')
 
         if not artist:
-            log.debug('[ Last.FM ] Retrieving artist "%s"' % name)
+            log.debug('[ Last.FM ] Retrieving artist "%s"', name)
             with ignored(Exception, print_traceback=True):
                 artist = self.lib.get_artist(name)
             if artist and self.use_cache:
@@ -42,7 +42,7 @@ class LastFM(object):
     def get_artist_image(self, name):
         image = None
 
-        log.debug('[ Last.FM ] Retrieving artist image for "%s"' % name)
+        log.debug('[ Last.FM ] Retrieving artist image for "%s"', name)
         with ignored(Exception, print_traceback=True):
             image = self.get_artist(name).get_cover_image()
 
@@ -53,8 +53,8 @@ class LastFM(object):
 
         if not album:
             artist = self.get_artist(artist_name)
-            log.debug('[ Last.FM ] Retrieving album "%s" by "%s"' % (
-                      name, artist.name))
+            log.debug('[ Last.FM ] Retrieving album "%s" by "%s"', name,
+                      artist.name)
             with ignored(Exception, print_traceback=True):
                 album = self.lib.get_album(artist, name)
 
@@ -76,8 +76,8 @@ class LastFM(object):
         if not album:
             return None
 
-        log.debug('[ Last.FM ] album "%s" by "%s" release date' % (
-                  album_name, artist_name))
+        log.debug('[ Last.FM ] album "%s" by "%s" release date', album_name,
+                  artist_name)
         with ignored(Exception, print_traceback=True):
             rdate = album.get_release_date()
             rdate = datetime.strptime(rdate, '%d %b %Y, %H:%M')
@@ -91,8 +91,8 @@ class LastFM(object):
         if not album:
             return None
 
-        log.debug('[ Last.FM ] Retrieving album "%s" by "%s" cover image' % (
-                  album_name, artist_name))
+        log.debug('[ Last.FM ] Retrieving album "%s" by "%s" cover image',
+                  album_name, artist_name)
         with ignored(Exception, print_traceback=True):
             cover = album.get_cover_image(size=self.pylast.COVER_EXTRA_LARGE)
 
@@ -33,7 +33,7 @@ from docopt import docopt
 from sqlalchemy import func
 from sqlalchemy.exc import OperationalError
 
-from shiva import models as m
+from shiva import migrations, models as m, search
 from shiva.app import app, db
 from shiva.exceptions import MetadataManagerReadError
 from shiva.indexer.cache import CacheManager
@@ -175,14 +175,15 @@ class Indexer(object):
         ext = self.get_extension()
         self.count_by_extension[ext] += 1
 
-        log.info('[ OK ] %s' % track.path)
+        if log.isEnabledFor(logging.INFO):
+            log.info('[ OK ] %s' % track.path)
 
         return True
 
     def skip(self, reason=None, print_traceback=None):
         self.skipped_tracks += 1
 
-        if log.getEffectiveLevel() <= logging.INFO:
+        if log.isEnabledFor(logging.INFO):
             _reason = ' (%s)' % reason if reason else ''
             log.info('[ SKIPPED ] %s%s' % (self.file_path, _reason))
             if print_traceback:
@@ -288,12 +289,15 @@ class Indexer(object):
 
         ext = self.get_extension()
         if ext not in self.VALID_FILE_EXTENSIONS:
-            log.debug('[ SKIPPED ] %s (Unrecognized extension)' %
-                      self.file_path)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('[ SKIPPED ] %s (Unrecognized extension)' %
+                          self.file_path)
 
             return False
         elif ext not in self.allowed_extensions:
-            log.debug('[ SKIPPED ] %s (Ignored extension)' % self.file_path)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('[ SKIPPED ] %s (Ignored extension)' %
+                          self.file_path)
 
             return False
 
@@ -417,16 +421,33 @@ def main():
 
     # Generate database
     db.create_all()
+    if migrations.get_pending(db.session.connection()):
+        log.warn('The database schema is outdated, run `shiva-admin db '
+                 'upgrade` to get the latest improvements.')
+
+    if not migrations.is_guid_storage_consistent(db.session.connection()):
+        log.error('The keys in the database are not stored as BINARY_GUIDS '
+                  'says. Convert them with `shiva-admin db guids` or change '
+                  'the setting.')
+        sys.exit(1)
 
     lola = Indexer(app.config, **kwargs)
-    lola.run()
 
-    lola.print_stats()
+    # Filling an empty database, it's faster to build the search index in one
+    # go at the end than to update it for every track.
+    with search.suspended(lola.empty_db):
+        lola.run()
+
+        lola.print_stats()
+
+        # Petit performance hack: Every track will be added to the session but
+        # they will be written down to disk only once, at the end. Unless the
+        # --write-every flag is set, then tracks are persisted in batch.
+        lola.commit(force=True)
 
-    # Petit performance hack: Every track will be added to the session but they
-    # will be written down to disk only once, at the end. Unless the
-    # --write-every flag is set, then tracks are persisted in batch.
-    lola.commit(force=True)
+    if lola.empty_db:
+        log.debug('Building search index...')
+        search.rebuild()
 
     log.debug('Checking for duplicated tracks...')
     lola.make_slugs_unique()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Conversions in the background.
+
+Converting a track takes as long as ffmpeg needs, minutes for the long ones,
+so requests don't wait for it. /tracks/<id>/convert/ queues a job, stored in
+the `conversion_jobs` table, and answers with 202 Accepted and the URL to ask
+again, until the converted file is ready. There's a single job for each track
+and format, shared by all the requests for it.
+
+Jobs are run by a pool of TRANSCODING_WORKERS threads, each one waiting for an
+ffmpeg process, started by every process of the API on its first conversion.
+Jobs left pending by a process that stopped are run by the next one to start
+its pool, and the ones still running a minute after TRANSCODING_TIMEOUT
+seconds are taken as abandoned and run again, when they are requested or by
+the next process to start its pool. A job only records its end if it wasn't
+run again meanwhile. Failed jobs are tried again when requested
+TRANSCODING_RETRY_DELAY seconds after failing.
+"""
+from datetime import datetime, timedelta
+import Queue
+import threading
+
+from flask import current_app as app
+from sqlalchemy.exc import IntegrityError
+
+from shiva import metrics
+from shiva.converter import get_converter
+from shiva.models import ConversionJob, db
+from shiva.utils import get_logger
+
+log = get_logger()
+
+
+class JobQueue(object):
+    """Pool of threads running the conversion jobs."""
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.app = None
+
+    def start(self, app):
+        """
+        Starts the workers, unless they are running already, and queues the
+        jobs left unfinished. Must be called inside an application context.
+        """
+
+        with self.lock:
+            if self.threads:
+                return None
+
+            self.app = app
+            for number in xrange(app.config.get('TRANSCODING_WORKERS', 2)):
+                thread = threading.Thread(target=self.work,
+                                          name='shiva-transcoder-%d' % number)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        for pk in get_unfinished_jobs():
+            self.put(pk)
+
+    def put(self, pk):
+        metrics.CONVERSION_QUEUE.inc()
+        self.queue.put(pk)
+
+    def join(self):
+        """Waits until every job queued is finished."""
+
+        self.queue.join()
+
+    def stop(self):
+        """Stops the workers, once the jobs queued are finished."""
+
+        with self.lock:
+            threads, self.threads = self.threads, []
+
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def work(self):
+        while True:
+            pk = self.queue.get()
+            if pk is None:
+                self.queue.task_done()
+                return None
+
+            try:
+                with self.app.app_context():
+                    try:
+                        run_job(pk)
+                    finally:
+                        db.session.remove()
+            except Exception:
+                log.exception('Error running the conversion job %s' % pk)
+            finally:
+                metrics.CONVERSION_QUEUE.dec()
+                self.queue.task_done()
+
+
+job_queue = JobQueue()
+
+# Seconds after TRANSCODING_TIMEOUT a running job is taken as abandoned. Leaves
+# the time to the process running it to stop ffmpeg and record the failure.
+ABANDONED_MARGIN = 60
+
+
+def get_abandoned_deadline():
+    """
+    Returns the time before which the jobs still running were abandoned, or
+    None if conversions have no timeout.
+    """
+
+    timeout = app.config.get('TRANSCODING_TIMEOUT')
+    if not timeout:
+        return None
+
+    return datetime.utcnow() - timedelta(seconds=timeout + ABANDONED_MARGIN)
+
+
+def get_unfinished_jobs():
+    """
+    Returns the keys of the pending jobs, after setting back to pending the
+    abandoned ones (see `get_abandoned_deadline()`).
+    """
+
+    deadline = get_abandoned_deadline()
+    if deadline is not None:
+        ConversionJob.query.filter(
+            ConversionJob.status == ConversionJob.RUNNING,
+            ConversionJob.started < deadline).update(
+                {'status': ConversionJob.PENDING},
+                synchronize_session=False)
+        db.session.commit()
+
+    query = db.session.query(ConversionJob.pk).filter_by(
+        status=ConversionJob.PENDING)
+
+    return [pk for (pk,) in query]
+
+
+def set_status(pk, current, status, if_started=None, **values):
+    """
+    Changes the status of a job, if it's still `current`, and was started at
+    `if_started` if given. Tells whether it was, as it may have been changed by
+    another process meanwhile.
+    """
+
+    query = ConversionJob.query.filter_by(pk=pk, status=current)
+    if if_started is not None:
+        query = query.filter_by(started=if_started)
+
+    values['status'] = status
+    updated = query.update(values, synchronize_session=False)
+    db.session.commit()
+
+    return updated == 1
+
+
+def run_job(pk):
+    # Without microseconds, as not every database keeps them.
+    started = datetime.utcnow().replace(microsecond=0)
+    if not set_status(pk, ConversionJob.PENDING, ConversionJob.RUNNING,
+                      started=started, error=None):
+        return None
+
+    job = ConversionJob.query.get(pk)
+    if job is None:
+        # The track was deleted.
+        return None
+
+    status, error = ConversionJob.DONE, None
+    try:
+        ConverterClass = get_converter()
+        ConverterClass(job.track, job.mimetype).convert()
+    except Exception, e:
+        log.error(e)
+        status, error = ConversionJob.FAILED, unicode(e)
+
+    # Unless it was taken as abandoned and run again meanwhile.
+    if not set_status(pk, ConversionJob.RUNNING, status, if_started=started,
+                      finished=datetime.utcnow(), error=error):
+        log.warning('The conversion job %s was run again meanwhile' % pk)
+
+
+def get_running_start(pk):
+    """Returns when the job was started, or None if it isn't running."""
+
+    return db.session.query(ConversionJob.started).filter_by(
+        pk=pk, status=ConversionJob.RUNNING).scalar()
+
+
+def should_retry(job, converter):
+    if job.status == ConversionJob.DONE:
+        # The converted file was removed.
+        return not converter.converted_file_exists()
+
+    if job.status == ConversionJob.FAILED:
+        delay = timedelta(seconds=app.config.get('TRANSCODING_RETRY_DELAY',
+                                                 300))
+        return job.finished is None or job.finished + delay < datetime.utcnow()
+
+    if job.status == ConversionJob.RUNNING:
+        # Abandoned by a process that stopped, as in `get_unfinished_jobs()`.
+        deadline = get_abandoned_deadline()
+        if deadline is None:
+            return False
+
+        return job.started is None or job.started < deadline
+
+    return False
+
+
+def get_job(converter):
+    """
+    Returns the job converting the track of `converter` to its mimetype.
+    Queues one if there's none yet, or if it's time to run it again.
+    """
+
+    job_queue.start(app._get_current_object())
+
+    track_pk = converter.track.pk
+    mimetype = str(converter.mimetype)
+    job = ConversionJob.query.filter_by(track_pk=track_pk,
+                                        mimetype=mimetype).first()
+    if job is None:
+        job = ConversionJob(track_pk=track_pk, mimetype=mimetype)
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Created by another request meanwhile.
+            db.session.rollback()
+            return ConversionJob.query.filter_by(track_pk=track_pk,
+                                                 mimetype=mimetype).one()
+
+        job_queue.put(job.pk)
+
+        return job
+
+    if should_retry(job, converter):
+        if set_status(job.pk, job.status, ConversionJob.PENDING, error=None,
+                      started=None, finished=None):
+            job_queue.put(job.pk)
+        db.session.refresh(job)
+
+    return job
@@ -1,5 +1,6 @@
 from flask import g, current_app as app
 
+from shiva import metrics
 from shiva.models import LyricsCache
 from shiva.utils import _import
 
@@ -29,7 +30,15 @@ def get_lyrics(track):
         if issubclass(Scraper, LyricScraper):
             scraper = Scraper(track.artist.name.encode('utf-8'),
                               track.title.encode('utf-8'))
-            if scraper.fetch():
+            try:
+                found = scraper.fetch()
+            except:
+                metrics.LYRICS_LOOKUPS.inc(scraper=scraper_cls, result='error')
+                raise
+
+            metrics.LYRICS_LOOKUPS.inc(scraper=scraper_cls,
+                                       result='hit' if found else 'miss')
+            if found:
                 lyrics = LyricsCache(source=scraper.source, track=track)
                 g.db.session.add(lyrics)
                 g.db.session.commit()
@@ -200,11 +200,15 @@ class MediaDir(object):
         # `/uploads/dir/flip/keep-rockin/track.mp3` will both be urlized to
         # `http://127.0.0.1:8001/flip/keep-rockin/track.mp3`. Maybe the track's
         # id could be included in the URL to discriminate them.
-        dirs.append(app.config.get('UPLOAD_PATH'))
+        if app.config.get('UPLOAD_PATH'):
+            dirs.append(app.config['UPLOAD_PATH'])
+        if app.config.get('TRANSCODE_CACHE_DIR'):
+            dirs.append(os.path.join(app.config['TRANSCODE_CACHE_DIR'], ''))
 
         for mdir in dirs:
+            mdir = os.path.join(mdir, '')
             if path.startswith(mdir):
-                # Remove trailing slash to avoid double-slashed URL.
+                # Keep the slash, the beginning of the URL's path.
                 url = path[(len(mdir) - 1):]
                 url = str(url.encode('utf-8'))
 
@@ -215,10 +219,12 @@ class MediaDir(object):
 
     def allowed_to_stream(self, path):
         """
+        Tells whether `path` is inside one of the directories. Paths must be
+        normalized, without any `..` left.
         """
 
         for mdir in self.get_dirs():
-            if path.startswith(mdir):
+            if path.startswith(os.path.join(mdir, '')):
                 return True
 
         return False
@@ -236,6 +242,8 @@ class MimeType(object):
         self.extension = extension
         self.acodec = kwargs.get('acodec')
         self.vcodec = kwargs.get('vcodec')
+        # Name of the container for ffmpeg, usually the same as the extension.
+        self.format = kwargs.get('format', extension)
 
     def is_audio(self):
         return self.type == 'audio'
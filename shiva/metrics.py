@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics in Prometheus' text format.
+
+When the METRICS_ENABLED setting is true the API, and the file server, answer
+to `/metrics` with the figures collected by the process since it started:
+request latency per endpoint, SQL statements run, bytes served, conversions,
+lyrics lookups and the hit ratio of the caches. Every process (e.g. every
+worker of a WSGI server) keeps its own figures.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import time
+import threading
+
+from flask import (abort, current_app as app, g, has_app_context, request,
+                   Response)
+
+from shiva import engine
+from shiva.constants import HTTP
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def escape(value):
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in zip(names, values))
+
+
+class Registry(object):
+    """Set of metrics exposed together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labelnames, labels, value in metric.collect():
+                lines.append('%s%s %s' % (name,
+                                          format_labels(labelnames, labels),
+                                          format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """
+    Base class for the metrics. Values are kept for each combination of the
+    labels listed in `labelnames`, given as keyword arguments when updating
+    them. Alternatively, a `callback` returning a dict of labels (as tuples)
+    and values can compute them when the metrics are rendered.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), callback=None,
+                 registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.values = {}
+        if not self.labelnames:
+            self.values[()] = 0
+
+        if registry is not None:
+            registry.register(self)
+
+    def get_key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('Expected labels: %s' %
+                             ', '.join(self.labelnames))
+
+        return tuple(labels[name] for name in self.labelnames)
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+
+    def collect(self):
+        values = self.callback() if self.callback else self.values
+        for labels, value in sorted(values.items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """Increments the gauge while the block runs."""
+
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                                        registry=registry)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.values:
+                # Count of each bucket, sum and count.
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+
+            counts = self.values[key]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the time the block takes to run."""
+
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), [None, 0, 0])[2]
+
+    def collect(self):
+        labelnames = self.labelnames + ('le',)
+        with self.lock:
+            values = sorted((labels, [list(counts[0]), counts[1], counts[2]])
+                            for labels, counts in self.values.iteritems())
+
+        for labels, (counts, _sum, count) in values:
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield ('%s_bucket' % self.name, labelnames,
+                       labels + (format_value(bucket),), cumulative)
+            yield ('%s_bucket' % self.name, labelnames, labels + ('+Inf',),
+                   count)
+            yield '%s_sum' % self.name, self.labelnames, labels, _sum
+            yield '%s_count' % self.name, self.labelnames, labels, count
+
+
+# Caches watched, by name. See `watch_cache()`.
+_caches = {}
+
+
+def watch_cache(name, get_cache):
+    """
+    Reports the hits and misses of a `shiva.utils.LRUCache`, or of anything
+    with `hits`, `misses` and a length. `get_cache` is a function returning
+    the cache, or None if it's disabled.
+    """
+
+    _caches[name] = get_cache
+
+
+def _get_cache_stats(attribute):
+    def callback():
+        values = {}
+        for name, get_cache in _caches.iteritems():
+            cache = get_cache()
+            if cache is not None:
+                values[(name,)] = attribute(cache)
+
+        return values
+
+    return callback
+
+
+def _get_hit_ratio(cache):
+    lookups = cache.hits + cache.misses
+
+    return float(cache.hits) / lookups if lookups else 0
+
+
+REQUEST_DURATION = Histogram(
+    'shiva_request_duration_seconds', 'Time spent serving requests.',
+    ('endpoint', 'method'))
+REQUESTS = Counter(
+    'shiva_requests_total', 'Requests served.',
+    ('endpoint', 'method', 'status'))
+DB_QUERIES = Counter(
+    'shiva_db_queries_total', 'SQL statements run by requests.')
+DB_QUERY_SECONDS = Counter(
+    'shiva_db_query_seconds_total', 'Time requests spent running SQL.')
+FILESERVER_BYTES = Counter(
+    'shiva_fileserver_bytes_total', 'Bytes of files sent by the file server.')
+FILESERVER_OFFLOADS = Counter(
+    'shiva_fileserver_offloads_total', 'Files handed over to the web server.')
+FILESERVER_STREAMS = Gauge(
+    'shiva_fileserver_active_streams', 'Files being sent by the file server.')
+CONVERSION_QUEUE = Gauge(
+    'shiva_converter_queue_depth', 'Conversions waiting or in progress.')
+CONVERSION_DURATION = Histogram(
+    'shiva_conversion_duration_seconds', 'Time spent converting tracks.',
+    ('mimetype',), buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+TRANSCODE_CACHE_BYTES = Gauge(
+    'shiva_transcode_cache_bytes', 'Bytes taken by the converted tracks.')
+LYRICS_LOOKUPS = Counter(
+    'shiva_lyrics_lookups_total', 'Lyrics looked up by each scraper.',
+    ('scraper', 'result'))
+CACHE_HITS = Counter(
+    'shiva_cache_hits_total', 'Lookups of cached items found in the cache.',
+    ('cache',), callback=_get_cache_stats(lambda cache: cache.hits))
+CACHE_MISSES = Counter(
+    'shiva_cache_misses_total', 'Lookups of cached items not in the cache.',
+    ('cache',), callback=_get_cache_stats(lambda cache: cache.misses))
+CACHE_HIT_RATIO = Gauge(
+    'shiva_cache_hit_ratio', 'Ratio of lookups found in the cache.',
+    ('cache',), callback=_get_cache_stats(_get_hit_ratio))
+CACHE_SIZE = Gauge(
+    'shiva_cache_size', 'Items in the cache.', ('cache',),
+    callback=_get_cache_stats(len))
+
+
+def is_enabled():
+    return app.config.get('METRICS_ENABLED', False)
+
+
+@engine.on_query
+def _count_query(statement, parameters, duration):
+    if has_app_context() and getattr(g, 'metrics_start', None) is not None:
+        DB_QUERIES.inc()
+        DB_QUERY_SECONDS.inc(duration)
+
+
+def start_request():
+    g.metrics_start = None
+    if is_enabled():
+        g.metrics_start = time()
+
+
+def end_request(response):
+    start = getattr(g, 'metrics_start', None)
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or 'none'
+    method = request.method
+    REQUESTS.inc(endpoint=endpoint, method=method,
+                 status=response.status_code)
+
+    def finish():
+        if has_app_context() and getattr(g, 'metrics_start', None) == start:
+            g.metrics_start = None
+        REQUEST_DURATION.observe(time() - start, endpoint=endpoint,
+                                 method=method)
+
+    if response.is_streamed:
+        # Measured until the body is sent, along with its queries.
+        response.call_on_close(finish)
+    else:
+        finish()
+
+    return response
+
+
+def serve_metrics():
+    if not is_enabled():
+        abort(HTTP.NOT_FOUND)
+
+    allowed = app.config.get('METRICS_ALLOWED_IPS')
+    if allowed is not None and request.remote_addr not in allowed:
+        abort(HTTP.FORBIDDEN)
+
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """
+    Collects the metrics of the requests to `app`, and serves them from
+    `/metrics`, while the METRICS_ENABLED setting is true.
+    """
+
+    app.before_request(start_request)
+    app.after_request(end_request)
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Schema migrations, to upgrade databases created by older versions in place.
+
+``db.create_all()`` creates the tables that don't exist yet, but it never
+changes existing ones. Every change to existing tables is made by a migration:
+a function receiving a connection, registered with the version of the schema
+it leads to. The version of each database is kept in the ``schema_version``
+table, and the pending migrations are applied, in order, with:
+
+    shiva-admin db upgrade
+
+Databases created from scratch already have the latest schema.
+
+The storage of primary and foreign keys, see ``shiva.dbtypes.GUID``, depends
+on the BINARY_GUIDS setting instead of on the schema version. SQLite databases
+are converted from one storage to the other with:
+
+    shiva-admin db guids (binary | hex)
+
+"""
+from binascii import unhexlify
+
+from sqlalchemy import event, inspect
+
+from shiva import dbtypes, search
+from shiva.models import (Album, Artist, ConversionJob, db, Track, track_album,
+                          track_artist, users_version)
+from shiva.utils import get_logger
+
+log = get_logger()
+
+schema_version = db.Table('schema_version',
+    db.Column('version', db.Integer, nullable=False),
+)
+
+# (version, function) tuples, sorted by version.
+MIGRATIONS = []
+
+
+class DowngradeError(Exception):
+    pass
+
+
+class UnsupportedDatabaseError(Exception):
+    def __init__(self, dialect):
+        msg = "Not supported on %s databases, only on SQLite." % dialect.name
+
+        super(UnsupportedDatabaseError, self).__init__(msg)
+
+
+def migration(version):
+    """Registers a function as the migration to the given schema version."""
+
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort()
+
+        return func
+
+    return decorator
+
+
+def get_latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def get_version(connection):
+    """
+    Returns the schema version of the database. Databases created before
+    migrations existed are at version 0.
+    """
+
+    if not schema_version.exists(bind=connection):
+        return 0
+
+    version = connection.execute(schema_version.select()).scalar()
+
+    return version or 0
+
+
+def set_version(connection, version):
+    schema_version.create(bind=connection, checkfirst=True)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert(), version=version)
+
+
+def get_pending(connection):
+    """Returns the migrations not yet applied to the database."""
+
+    version = get_version(connection)
+    if version > get_latest_version():
+        raise DowngradeError('The database is at version %s, newer than this '
+                             'version of Shiva.' % version)
+
+    return [(_version, func) for _version, func in MIGRATIONS
+            if _version > version]
+
+
+def upgrade():
+    """Applies the pending migrations, returning how many were applied."""
+
+    connection = db.session.connection()
+    pending = get_pending(connection)
+    for version, func in pending:
+        log.info('Migrating to version %s (%s)...' % (version, func.__name__))
+        func(connection)
+        set_version(connection, version)
+
+    db.session.commit()
+
+    return len(pending)
+
+
+def create_missing_indexes(connection, tables):
+    """
+    Creates the indexes declared in the models that don't exist yet in the
+    given tables.
+    """
+
+    inspector = inspect(connection)
+    for table in tables:
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                log.debug('Creating index %s' % index.name)
+                index.create(bind=connection)
+
+
+@migration(1)
+def add_lookup_indexes(connection):
+    """
+    Adds indexes on slugs, album names, track hashes and dates, and on both
+    columns of the association tables.
+    """
+
+    create_missing_indexes(connection, (Artist.__table__, Album.__table__,
+                                        Track.__table__, track_artist,
+                                        track_album))
+
+
+@migration(2)
+def add_conversion_jobs(connection):
+    """Adds the table of the conversions run in the background."""
+
+    ConversionJob.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(3)
+def add_users_version(connection):
+    """Adds the version of the users, for the caches of tokens."""
+
+    users_version.create(bind=connection, checkfirst=True)
+
+
+def get_guid_columns(connection):
+    """Returns all the GUID columns in the database."""
+
+    tables = list(db.metadata.sorted_tables)
+    backend = search.get_backend(connection)
+    if backend is not None:
+        tables.append(backend.documents)
+
+    return [column for table in tables for column in table.c
+            if isinstance(column.type, dbtypes.GUID) and
+            table.exists(bind=connection)]
+
+
+def get_guid_storage(connection):
+    """
+    Returns how the keys are stored in a SQLite database, 'binary' or 'hex', or
+    None if there are no keys yet.
+    """
+
+    if connection.dialect.name != 'sqlite':
+        raise UnsupportedDatabaseError(connection.dialect)
+
+    for column in get_guid_columns(connection):
+        query = 'SELECT typeof(%s) FROM %s WHERE %s IS NOT NULL LIMIT 1' % (
+            column.name, column.table.name, column.name)
+        storage = connection.execute(query).scalar()
+        if storage is not None:
+            return 'binary' if storage == 'blob' else 'hex'
+
+    return None
+
+
+def is_guid_storage_consistent(connection):
+    """
+    Tells whether the keys in the database are stored the way the BINARY_GUIDS
+    setting says. Always true for databases other than SQLite.
+    """
+
+    if connection.dialect.name != 'sqlite':
+        return True
+
+    storage = get_guid_storage(connection)
+    if storage is None:
+        return True
+
+    return (storage == 'binary') == dbtypes.GUID.binary
+
+
+def _unhex(value):
+    return buffer(unhexlify(value))
+
+
+def convert_guids(binary):
+    """
+    Converts all the keys in a SQLite database to 16 raw bytes if `binary` is
+    True, or to 32 hex digits otherwise. Returns the number of converted
+    columns. The declared types of the columns are left as they are, SQLite
+    doesn't enforce them.
+    """
+
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        raise UnsupportedDatabaseError(connection.dialect)
+
+    connection.connection.create_function('shiva_unhex', 1, _unhex)
+    # Keys referencing converted keys are only checked on commit, when both
+    # are converted.
+    connection.execute('PRAGMA defer_foreign_keys = ON')
+
+    columns = get_guid_columns(connection)
+    for column in columns:
+        if binary:
+            value = "shiva_unhex(%s)" % column.name
+            storage = 'text'
+        else:
+            value = "lower(hex(%s))" % column.name
+            storage = 'blob'
+
+        log.debug('Converting %s.%s' % (column.table.name, column.name))
+        connection.execute("UPDATE %s SET %s = %s WHERE typeof(%s) = '%s'" % (
+            column.table.name, column.name, value, column.name, storage))
+
+    db.session.commit()
+
+    return len(columns)
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _set_version(target, connection, tables=(), **kwargs):
+    if schema_version not in tables:
+        return None
+
+    # Tables created along with this one have the latest schema. Otherwise,
+    # this is a database older than the migrations, at version 0.
+    if Track.__table__ in tables:
+        set_version(connection, get_latest_version())
@@ -6,7 +6,6 @@ import os
 import uuid
 
 from flask import current_app as app
-from flask.ext.sqlalchemy import SQLAlchemy
 from itsdangerous import (BadSignature, SignatureExpired,
                           TimedJSONWebSignatureSerializer as Serializer)
 from sqlalchemy.exc import OperationalError
@@ -15,11 +14,13 @@ from slugify import slugify
 
 from shiva import dbtypes
 from shiva.auth import Roles
+from shiva.routing import RoutingSQLAlchemy
 from shiva.utils import MetadataManager
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
-__all__ = ('db', 'Artist', 'Album', 'Track', 'LyricsCache', 'User')
+__all__ = ('db', 'Artist', 'Album', 'Track', 'LyricsCache', 'ConversionJob',
+           'User')
 
 
 def random_row(model):
@@ -35,15 +36,66 @@ def random_row(model):
     return instance
 
 
+def get_related(model, association, pks, order_by=None):
+    """
+    Returns a dict mapping each one of the given primary keys to the list of
+    `model` instances related to it through the `association` table. `pks` can
+    be a list or a query selecting primary keys, this way the relationships of
+    a whole set of objects are retrieved with a single query.
+    """
+
+    remote = model.__table__.c.pk
+    for column in association.c:
+        if column.references(remote):
+            model_fk = column
+        else:
+            local_fk = column
+
+    query = db.session.query(local_fk, model).join(model, model_fk == remote)
+    query = query.filter(local_fk.in_(pks))
+    if order_by is not None:
+        query = query.order_by(*order_by)
+
+    related = {}
+    for pk, instance in query:
+        related.setdefault(pk, []).append(instance)
+
+    return related
+
+
+def get_album_artists(pks):
+    """
+    Like `get_related`, maps the primary keys of albums to their artists, which
+    are calculated through the albums' tracks, sorted by name.
+    """
+
+    query = db.session.query(track_album.c.album_pk, Artist).join(
+        track_artist, track_artist.c.track_pk == track_album.c.track_pk).join(
+        Artist, Artist.pk == track_artist.c.artist_pk)
+    query = query.filter(track_album.c.album_pk.in_(pks)).distinct()
+    query = query.order_by(Artist.name, Artist.pk)
+
+    artists = {}
+    for pk, artist in query:
+        artists.setdefault(pk, []).append(artist)
+
+    return artists
+
+
 # Table relationships
 track_artist = db.Table('trackartist',
     db.Column('track_pk', dbtypes.GUID, db.ForeignKey('tracks.pk')),
     db.Column('artist_pk', dbtypes.GUID, db.ForeignKey('artists.pk')),
+    # Joins go both ways, from tracks to artists and from artists to tracks.
+    db.Index('ix_trackartist_track_pk_artist_pk', 'track_pk', 'artist_pk'),
+    db.Index('ix_trackartist_artist_pk_track_pk', 'artist_pk', 'track_pk'),
 )
 
 track_album = db.Table('trackalbum',
     db.Column('track_pk', dbtypes.GUID, db.ForeignKey('tracks.pk')),
     db.Column('album_pk', dbtypes.GUID, db.ForeignKey('albums.pk')),
+    db.Index('ix_trackalbum_track_pk_album_pk', 'track_pk', 'album_pk'),
+    db.Index('ix_trackalbum_album_pk_track_pk', 'album_pk', 'track_pk'),
 )
 
 
@@ -53,10 +105,10 @@ class Artist(db.Model):
     pk = db.Column(dbtypes.GUID, default=uuid.uuid4, primary_key=True)
     # TODO: Update the files' Metadata when changing this info.
     name = db.Column(db.String(128), unique=True, nullable=False)
-    slug = db.Column(db.String(128))
+    slug = db.Column(db.String(128), index=True)
     image = db.Column(db.String(256))
     events = db.Column(db.String(256))
-    date_added = db.Column(db.Date(), nullable=False)
+    date_added = db.Column(db.Date(), nullable=False, index=True)
 
     def __init__(self, *args, **kwargs):
         if 'date_added' not in kwargs:
@@ -66,15 +118,19 @@ class Artist(db.Model):
 
     @property
     def albums(self):
-        # FIXME: Optimize. Check comments for Album.artists method.
-        albums = []
+        """
+        Calculates the albums for this artist through its tracks, oldest
+        first.
+        """
 
-        for track in self.tracks:
-            for album in track.albums:
-                if album not in albums:
-                    albums.append(album)
+        query = Album.query.join(
+            track_album, track_album.c.album_pk == Album.pk).join(
+            track_artist, track_artist.c.track_pk == track_album.c.track_pk)
 
-        return albums
+        query = query.filter(track_artist.c.artist_pk == self.pk)
+        query = query.order_by(Album.year, Album.name, Album.pk)
+
+        return query.distinct().all()
 
     @classmethod
     def random(cls):
@@ -94,11 +150,11 @@ class Album(db.Model):
     __tablename__ = 'albums'
 
     pk = db.Column(dbtypes.GUID, default=uuid.uuid4, primary_key=True)
-    name = db.Column(db.String(128), nullable=False)
-    slug = db.Column(db.String(128))
+    name = db.Column(db.String(128), nullable=False, index=True)
+    slug = db.Column(db.String(128), index=True)
     year = db.Column(db.Integer)
     cover = db.Column(db.String(256))
-    date_added = db.Column(db.Date(), nullable=False)
+    date_added = db.Column(db.Date(), nullable=False, index=True)
 
     def __init__(self, *args, **kwargs):
         if 'date_added' not in kwargs:
@@ -108,22 +164,9 @@ class Album(db.Model):
 
     @property
     def artists(self):
-        """
-        Calculates the artists for this album by traversing the list of tracks.
-        This is a terrible way of doing this, but we assume that the worst case
-        will still be good enough to defer the optimization of this method for
-        the future.
-        """
+        """Calculates the artists for this album through its tracks."""
 
-        artists = []
-
-        # FIXME: Optimize
-        for track in self.tracks:
-            for artist in track.artists:
-                if artist not in artists:
-                    artists.append(artist)
-
-        return artists
+        return get_album_artists([self.pk]).get(self.pk, [])
 
     @classmethod
     def random(cls):
@@ -145,13 +188,13 @@ class Track(db.Model):
     pk = db.Column(dbtypes.GUID, default=uuid.uuid4, primary_key=True)
     path = db.Column(db.Unicode(256), unique=True, nullable=False)
     title = db.Column(db.String(128))
-    slug = db.Column(db.String(128))
+    slug = db.Column(db.String(128), index=True)
     bitrate = db.Column(db.Integer)
     file_size = db.Column(db.Integer)
     length = db.Column(db.Integer)
     ordinal = db.Column(db.Integer)
-    date_added = db.Column(db.Date(), nullable=False)
-    hash = db.Column(db.String(32))
+    date_added = db.Column(db.Date(), nullable=False, index=True)
+    hash = db.Column(db.String(32), index=True)
 
     lyrics = db.relationship('LyricsCache', backref='tracks', uselist=False)
     albums = db.relationship('Album', secondary=track_album, lazy='dynamic',
@@ -420,6 +463,39 @@ class LyricsCache(db.Model):
         return "<LyricsCache ('%s')>" % self.track.title
 
 
+class ConversionJob(db.Model):
+    """
+    Conversion of a track to another format, run in the background. See
+    `shiva.jobs`. There's only one for each track and mimetype.
+    """
+
+    __tablename__ = 'conversion_jobs'
+    __table_args__ = (db.UniqueConstraint('track_pk', 'mimetype'),)
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    pk = db.Column(dbtypes.GUID, default=uuid.uuid4, primary_key=True)
+    track_pk = db.Column(dbtypes.GUID, db.ForeignKey('tracks.pk'),
+                         nullable=False)
+    mimetype = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=PENDING)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    track = db.relationship('Track', backref=db.backref(
+        'conversion_jobs', lazy='dynamic', cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return "<ConversionJob ('%s', '%s', %s)>" % (self.track_pk,
+                                                     self.mimetype,
+                                                     self.status)
+
+
 class User(db.Model):
     __tablename__ = 'users'
 
@@ -492,3 +568,10 @@ class User(db.Model):
 
     def __repr__(self):
         return "<User ('%s')>" % self.email
+
+
+# Incremented every time users change, for every process of the API to empty
+# its cache of tokens (see shiva.auth.cache), whoever changed them.
+users_version = db.Table('users_version',
+    db.Column('version', db.Integer, nullable=False),
+)
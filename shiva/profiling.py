@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the requests.
+
+When the PROFILE_REQUESTS setting is enabled every request keeps track of its
+wall time, the SQL statements it runs and the time spent on them, and the time
+spent marshalling the results. The figures are sent back in a Server-Timing
+header, which browsers show along with the rest of the timing of the request:
+
+    Server-Timing: db;dur=12.41;desc="7 queries", marshal;dur=3.02,
+                   total;dur=21.83
+
+Requests slower than SLOW_REQUEST_MS milliseconds, or running
+SLOW_REQUEST_QUERIES statements or more, are logged along with their slowest
+statements.
+
+Streamed responses are profiled until they are sent, as that's when their
+rows are fetched and serialized. Their headers are gone by then, so they
+have no Server-Timing header, but they are logged all the same.
+
+See https://www.w3.org/TR/server-timing/
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+
+from flask import current_app as app, g, has_app_context, request
+
+from shiva import engine
+from shiva.utils import get_logger
+
+log = get_logger()
+
+# Number of statements included in the log of a slow request, slowest first.
+MAX_LOGGED_QUERIES = 10
+
+
+class RequestProfile(object):
+    """Figures collected during a request."""
+
+    def __init__(self):
+        self.start = time()
+        # (statement, parameters, seconds) of every SQL statement run.
+        self.queries = []
+        self.timings = OrderedDict()
+
+    @property
+    def db_time(self):
+        return sum(duration for _, _, duration in self.queries)
+
+    def get_elapsed(self):
+        return time() - self.start
+
+    def add_timing(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def get_server_timing(self, total):
+        db_time = self.db_time * 1000
+        metrics = ['db;dur=%.2f;desc="%d queries"' % (db_time,
+                                                     len(self.queries))]
+        for name, seconds in self.timings.iteritems():
+            metrics.append('%s;dur=%.2f' % (name, seconds * 1000))
+        metrics.append('total;dur=%.2f' % (total * 1000))
+
+        return ', '.join(metrics)
+
+
+def get_profile():
+    """Returns the profile of the current request, or None if not profiled."""
+
+    if not has_app_context():
+        return None
+
+    return getattr(g, 'profile', None)
+
+
+@contextmanager
+def timed(name):
+    """
+    Adds the time spent running the block to the `name` timing of the current
+    request, if it's being profiled.
+    """
+
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+
+    start = time()
+    try:
+        yield
+    finally:
+        profile.add_timing(name, time() - start)
+
+
+@engine.on_query
+def _record_query(statement, parameters, duration):
+    profile = get_profile()
+    if profile is not None:
+        profile.queries.append((statement, parameters, duration))
+
+
+def timed_iter(iterable, name):
+    """
+    Like `timed()`, for the time spent producing the items of `iterable`, like
+    the chunks of a streamed response. SQL statements run meanwhile are left
+    out, as they are accounted for already.
+    """
+
+    profile = get_profile()
+    if profile is None:
+        return iterable
+
+    return _timed_iter(iterable, name, profile)
+
+
+def _timed_iter(iterable, name, profile):
+    iterator = iter(iterable)
+    while True:
+        start = time()
+        db_time = profile.db_time
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            profile.add_timing(name, time() - start -
+                               (profile.db_time - db_time))
+
+        yield item
+
+
+def log_slow_request(profile, total, size, description):
+    lines = ['Slow request: %s (%.2fms, %d queries in %.2fms, %d bytes)' % (
+        description, total * 1000, len(profile.queries),
+        profile.db_time * 1000, size)]
+
+    queries = sorted(profile.queries, key=lambda query: query[2],
+                     reverse=True)
+    for statement, parameters, duration in queries[:MAX_LOGGED_QUERIES]:
+        lines.append('  [%8.2fms] %s %r' % (duration * 1000,
+                                            ' '.join(statement.split()),
+                                            parameters))
+    if len(queries) > MAX_LOGGED_QUERIES:
+        lines.append('  ... and %d more' % (len(queries) - MAX_LOGGED_QUERIES))
+
+    log.warning('\n'.join(lines))
+
+
+def start_profile():
+    g.profile = None
+    if app.config.get('PROFILE_REQUESTS'):
+        g.profile = RequestProfile()
+
+
+def end_profile(response):
+    profile = get_profile()
+    if profile is None:
+        return response
+
+    # Read now, streamed responses end outside of the request.
+    description = '%s %s' % (request.method, request.full_path)
+    slow_ms = app.config.get('SLOW_REQUEST_MS', 500)
+    slow_queries = app.config.get('SLOW_REQUEST_QUERIES', 50)
+
+    def finish(size):
+        total = profile.get_elapsed()
+        if total * 1000 >= slow_ms or len(profile.queries) >= slow_queries:
+            log_slow_request(profile, total, size, description)
+
+        return total
+
+    if not response.is_streamed:
+        g.profile = None
+        total = finish(response.content_length or 0)
+        response.headers['Server-Timing'] = profile.get_server_timing(total)
+
+        return response
+
+    # The profile goes on while the body is produced, and ends once it's sent.
+    sent = [0]
+
+    def count(chunks):
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+
+    def close():
+        if get_profile() is profile:
+            g.profile = None
+        finish(sent[0])
+
+    response.response = count(response.response)
+    response.call_on_close(close)
+
+    return response
+
+
+def init_app(app):
+    """
+    Registers the hooks that profile the requests of `app`. Must be called
+    before any other request hook is registered, so everything the others do
+    is accounted for.
+    """
+
+    app.before_request(start_profile)
+    app.after_request(end_profile)
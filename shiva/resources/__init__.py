@@ -5,5 +5,5 @@ from shiva.resources.base import (
     PlaylistResource, PlaylistTrackResource)
 from shiva.resources.static import AboutResource, ClientResource
 from shiva.resources.dynamic import (
-    ConvertResource, LyricsResource, RandomResource, ShowsResource,
-    WhatsNewResource)
+    ConvertResource, LyricsResource, RandomResource, SearchResource,
+    ShowsResource, SuggestResource, WhatsNewResource)
@@ -1,25 +1,109 @@
 # -*- coding: utf-8 -*-
 from flask import current_app as app, g, request, url_for
-from flask.ext.restful import abort, fields, marshal
+from flask.ext.restful import abort, fields
 from werkzeug.exceptions import NotFound
 
 from shiva.auth import Roles
+from shiva.auth.cache import token_cache
 from shiva.constants import HTTP
 from shiva.exceptions import (InvalidFileTypeError, IntegrityError,
                               ObjectExistsError)
 from shiva.http import Resource
-from shiva.models import Album, Artist, db, Track, User, Playlist
+from shiva.models import (Album, Artist, db, Track, User, Playlist,
+                          get_album_artists, get_related, track_album,
+                          track_artist)
 from shiva.resources.fields import (ForeignKeyField, InstanceURI, TrackFiles,
                                     ManyToManyField, PlaylistField)
 from shiva.utils import parse_bool, get_list, get_by_name
 
 
+class TrackRelations(object):
+    """
+    The artists and albums of a set of tracks, along with the artists of those
+    albums. They are fetched with a fixed number of queries, no matter how many
+    tracks there are, so full trees can be assembled in memory instead of
+    querying the relationships of every track on its own.
+    """
+
+    def __init__(self, track_pks):
+        """
+        `track_pks` is a list, or a query selecting the primary keys, of the
+        tracks to fetch relations for.
+        """
+
+        self.artists = get_related(Artist, track_artist, track_pks)
+        self.albums = get_related(Album, track_album, track_pks)
+
+        album_pks = db.session.query(track_album.c.album_pk).filter(
+            track_album.c.track_pk.in_(track_pks))
+        self.album_artists = get_album_artists(album_pks)
+
+        track_fields = TrackResource.get_fields()
+        album_fields = AlbumResource.get_fields()
+
+        self.serialize_track = TrackResource.get_serializer(
+            frozenset(track_fields).difference(TrackResource.related))
+        self.serialize_album = AlbumResource.get_serializer(
+            frozenset(album_fields).difference(('artists',)))
+        self.serialize_artist = ArtistResource.get_serializer()
+
+        self.nested_artist = track_fields['artists'].serialize
+        self.nested_album = track_fields['albums'].serialize
+        self.album_artist = album_fields['artists'].serialize
+
+        # Albums and artists are shared by many tracks, only serialize them
+        # once.
+        self._albums = {}
+        self._artists = {}
+
+    def get_album(self, album):
+        """Serializes an album with the fields of `AlbumResource`."""
+
+        if album.pk not in self._albums:
+            _album = self.serialize_album(album)
+            _album['artists'] = [self.album_artist(artist) for artist
+                                 in self.album_artists.get(album.pk, ())]
+            self._albums[album.pk] = _album
+
+        return self._albums[album.pk]
+
+    def get_artist(self, artist):
+        """Serializes an artist with the fields of `ArtistResource`."""
+
+        if artist.pk not in self._artists:
+            self._artists[artist.pk] = self.serialize_artist(artist)
+
+        return self._artists[artist.pk]
+
+    def get_track(self, track, embed=False):
+        """
+        Serializes a track with the fields of `TrackResource`. If `embed` is
+        set, its artists and albums will be fully serialized, instead of just
+        their ids and URIs.
+        """
+
+        _track = self.serialize_track(track)
+        artists = self.artists.get(track.pk, ())
+        albums = self.albums.get(track.pk, ())
+
+        if embed:
+            _track['artists'] = [self.get_artist(artist) for artist in artists]
+            _track['albums'] = [self.get_album(album) for album in albums]
+        else:
+            _track['artists'] = [self.nested_artist(artist)
+                                 for artist in artists]
+            _track['albums'] = [self.nested_album(album) for album in albums]
+
+        return _track
+
+
 class ArtistResource(Resource):
     """ The resource responsible for artists. """
 
     db_model = Artist
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.String(attribute='pk'),
             'name': fields.String,
@@ -29,6 +113,12 @@ class ArtistResource(Resource):
             'events_uri': fields.String(attribute='events'),
         }
 
+    @classmethod
+    def get_embeddable_fields(cls):
+        return {
+            'albums': ManyToManyField(Album, AlbumResource.get_fields()),
+        }
+
     def post(self):
         name = request.form.get('name', '').strip()
         if not name:
@@ -41,7 +131,7 @@ class ArtistResource(Resource):
         except (IntegrityError, ObjectExistsError):
             abort(HTTP.CONFLICT)
 
-        response = marshal(artist, self.get_resource_fields())
+        response = self.marshal(artist)
         headers = {'Location': url_for('artists', id=artist.pk)}
 
         return response, 201, headers
@@ -68,17 +158,33 @@ class ArtistResource(Resource):
         return artist
 
     def get_full_tree(self, artist):
-        _artist = marshal(artist, self.get_resource_fields())
-        _artist['albums'] = []
-
-        albums = AlbumResource()
-
-        for album in artist.albums:
-            _artist['albums'].append(albums.get_full_tree(album))
+        """
+        Retrieves the full tree for an artist, all its albums with all their
+        tracks. The whole tree is built from a fixed set of queries.
+        """
 
-        no_album = artist.tracks.filter_by(albums=None).all()
-        track_fields = TrackResource().get_resource_fields()
-        _artist['no_album_tracks'] = marshal(no_album, track_fields)
+        _artist = self.get_serializer()(artist)
+
+        albums = artist.albums
+        album_pks = db.session.query(track_album.c.album_pk).join(
+            track_artist,
+            track_artist.c.track_pk == track_album.c.track_pk).filter(
+            track_artist.c.artist_pk == artist.pk)
+        album_tracks = get_related(Track, track_album, album_pks,
+                                   order_by=(Track.ordinal, Track.title))
+
+        no_album = artist.tracks.filter_by(albums=None)
+        track_pks = db.session.query(track_album.c.track_pk).filter(
+            track_album.c.album_pk.in_(album_pks)).union(
+            no_album.with_entities(Track.pk))
+        relations = TrackRelations(track_pks)
+
+        album_resource = AlbumResource()
+        _artist['albums'] = (album_resource.get_full_tree(album, relations,
+                                 album_tracks.get(album.pk, ()))
+                             for album in albums)
+        _artist['no_album_tracks'] = [relations.get_track(track)
+                                      for track in no_album]
 
         return _artist
 
@@ -88,7 +194,8 @@ class AlbumResource(Resource):
 
     db_model = Album
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.String(attribute='pk'),
             'name': fields.String,
@@ -102,6 +209,13 @@ class AlbumResource(Resource):
             'cover': fields.String(default=app.config['DEFAULT_ALBUM_COVER']),
         }
 
+    @classmethod
+    def get_embeddable_fields(cls):
+        return {
+            'artists': ManyToManyField(Artist, ArtistResource.get_fields()),
+            'tracks': ManyToManyField(Track, TrackResource.get_fields()),
+        }
+
     def post(self):
         params = {
             'name': request.form.get('name', '').strip(),
@@ -114,7 +228,7 @@ class AlbumResource(Resource):
 
         album = self.create(**params)
 
-        response = marshal(album, self.get_resource_fields())
+        response = self.marshal(album)
         headers = {'Location': url_for('albums', id=album.pk)}
 
         return response, 201, headers
@@ -162,14 +276,25 @@ class AlbumResource(Resource):
 
         return queryset.join(Album.artists).filter(Artist.pk == pk)
 
-    def get_full_tree(self, album):
-        _album = marshal(album, self.get_resource_fields())
-        _album['tracks'] = []
+    def get_full_tree(self, album, relations=None, tracks=None):
+        """
+        Retrieves the full tree for an album, including all its tracks. The
+        `relations` of the tracks and the `tracks` themselves are fetched
+        unless given, as in the case of an artist's full tree.
+        """
+
+        if tracks is None:
+            tracks = album.tracks.order_by(Track.ordinal, Track.title).all()
 
-        tracks = TrackResource()
+        if relations is None:
+            relations = TrackRelations([track.pk for track in tracks])
 
-        for track in album.tracks.order_by(Track.ordinal, Track.title):
-            _album['tracks'].append(tracks.get_full_tree(track))
+        _album = relations.get_album(album).copy()
+
+        track_resource = TrackResource()
+        _album['tracks'] = (track_resource.get_full_tree(track,
+                                relations=relations)
+                            for track in tracks)
 
         return _album
 
@@ -178,8 +303,10 @@ class TrackResource(Resource):
     """ The resource responsible for tracks. """
 
     db_model = Track
+    related = frozenset(('artists', 'albums'))
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.String(attribute='pk'),
             'uri': InstanceURI('tracks'),
@@ -199,6 +326,13 @@ class TrackResource(Resource):
             'ordinal': fields.Integer,
         }
 
+    @classmethod
+    def get_embeddable_fields(cls):
+        return {
+            'artists': ManyToManyField(Artist, ArtistResource.get_fields()),
+            'albums': ManyToManyField(Album, AlbumResource.get_fields()),
+        }
+
     def post(self):
         params = {
             'title': request.form.get('title', '').strip(),
@@ -215,7 +349,7 @@ class TrackResource(Resource):
         except (IntegrityError, ObjectExistsError):
             abort(HTTP.CONFLICT)
 
-        response = marshal(track, self.get_resource_fields())
+        response = self.marshal(track)
         headers = {'Location': url_for('tracks', id=track.pk)}
 
         return response, 201, headers
@@ -318,7 +452,7 @@ class TrackResource(Resource):
         return queryset.filter_by(album_pk=pk)
 
     def get_full_tree(self, track, include_scraped=False,
-                      include_related=True):
+                      include_related=True, relations=None):
         """
         Retrives the full tree for a track. If the include_related option is
         not set then a normal track structure will be retrieved. If its set
@@ -329,20 +463,17 @@ class TrackResource(Resource):
         This is disabled by default to avois DoS'ing lyrics' websites when
         requesting many tracks at once.
 
-        """
+        When building the tree of many tracks their `relations` should be
+        fetched beforehand, all at once.
 
-        resource_fields = self.get_resource_fields()
-        if include_related:
-            artist = ArtistResource()
-            resource_fields['artists'] = ManyToManyField(
-                Artist,
-                artist.get_resource_fields())
-            album = AlbumResource()
-            resource_fields['albums'] = ManyToManyField(
-                Album,
-                album.get_resource_fields())
+        """
 
-        _track = marshal(track, resource_fields)
+        if relations is not None:
+            _track = relations.get_track(track, embed=include_related)
+        elif include_related:
+            _track = self.get_serializer(embed=self.related)(track)
+        else:
+            _track = self.get_serializer()(track)
 
         if include_scraped:
             lyrics = LyricsResource()
@@ -370,7 +501,8 @@ class PlaylistResource(Resource):
 
     db_model = Playlist
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.String(attribute='pk'),
             'name': fields.String,
@@ -397,9 +529,11 @@ class PlaylistResource(Resource):
 
         read_only = request.form.get('read_only', True)
 
-        playlist = self.create(name=name, read_only=read_only, user=g.user)
+        # g.user is a snapshot, see shiva.auth.cache
+        user = User.query.get(g.user.pk)
+        playlist = self.create(name=name, read_only=read_only, user=user)
 
-        response = marshal(playlist, self.get_resource_fields())
+        response = self.marshal(playlist)
         headers = {'Location': url_for('playlists', id=playlist.pk)}
 
         return response, 201, headers
@@ -482,7 +616,8 @@ class UserResource(Resource):
 
     db_model = User
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.String(attribute='pk'),
             'display_name': fields.String,
@@ -491,7 +626,7 @@ class UserResource(Resource):
 
     def get(self, id=None):
         if id == 'me':
-            return marshal(g.user, self.get_resource_fields())
+            return self.marshal(g.user)
 
         return super(UserResource, self).get(id)
 
@@ -524,7 +659,7 @@ class UserResource(Resource):
         except (IntegrityError, ObjectExistsError):
             abort(HTTP.CONFLICT)
 
-        response = marshal(user, self.get_resource_fields())
+        response = self.marshal(user)
         headers = {'Location': url_for('users', id=user.pk)}
 
         return response, 201, headers
@@ -543,7 +678,11 @@ class UserResource(Resource):
         if id == 'me':
             abort(HTTP.METHOD_NOT_ALLOWED)
 
-        return super(UserResource, self).put(id)
+        response = super(UserResource, self).put(id)
+        # Once committed, so the old data is not cached again.
+        token_cache.invalidate(id)
+
+        return response
 
     def update(self, user):
         if 'email' in request.form:
@@ -575,4 +714,7 @@ class UserResource(Resource):
         if id == 'me':
             abort(HTTP.METHOD_NOT_ALLOWED)
 
-        return super(UserResource, self).delete(id)
+        response = super(UserResource, self).delete(id)
+        token_cache.invalidate(id)
+
+        return response
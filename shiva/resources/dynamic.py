@@ -3,22 +3,43 @@ from datetime import datetime
 import urllib2
 import traceback
 
-from flask import request, current_app as app, g
-from flask.ext.restful import abort, fields, marshal
+from flask import request, current_app as app, g, Response
+from flask.ext.restful import abort, fields
 import requests
 
+from shiva import jobs, search, suggest
 from shiva.constants import HTTP
 from shiva.converter import get_converter
 from shiva.exceptions import InvalidMimeTypeError
-from shiva.http import Resource, JSONResponse
+from shiva.http import Resource, JSONResponse, get_list_param
 from shiva.lyrics import get_lyrics
 from shiva.mocks import ShowModel
-from shiva.models import Artist, Album, Track, LyricsCache
+from shiva.models import Artist, Album, ConversionJob, Track, LyricsCache
+from shiva.resources.base import (AlbumResource, ArtistResource,
+                                  TrackRelations, TrackResource)
 from shiva.resources.fields import (Boolean, ForeignKeyField, InstanceURI,
                                     ManyToManyField)
+from shiva.serializer import compile_fields
 from shiva.utils import get_logger
 
 log = get_logger()
+_uri_serializers = {}
+
+
+def get_uri_serializer(resource_name):
+    """
+    Returns a serializer that outputs only the id and the URI of an object,
+    compiled only once per resource name.
+
+    """
+
+    if resource_name not in _uri_serializers:
+        _uri_serializers[resource_name] = compile_fields({
+            'id': fields.Integer(attribute='pk'),
+            'uri': InstanceURI(resource_name),
+        })
+
+    return _uri_serializers[resource_name]
 
 
 def paginate(queryset):
@@ -56,7 +77,8 @@ class LyricsResource(Resource):
 
     """
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.Integer(attribute='pk'),
             'uri': InstanceURI('lyrics'),
@@ -81,7 +103,7 @@ class LyricsResource(Resource):
 
     def get_for(self, track):
         if track.lyrics:
-            return marshal(track.lyrics, self.get_resource_fields())
+            return self.marshal(track.lyrics)
 
         try:
             lyrics = get_lyrics(track)
@@ -92,7 +114,7 @@ class LyricsResource(Resource):
         if not lyrics:
             abort(HTTP.NOT_FOUND)
 
-        return marshal(lyrics, self.get_resource_fields())
+        return self.marshal(lyrics)
 
     def post(self, id):
         text = request.form.get('text', None)
@@ -116,7 +138,17 @@ class LyricsResource(Resource):
 
 
 class ConvertResource(Resource):
-    """ Resource in charge of converting tracks from one format to another. """
+    """
+    Resource in charge of converting tracks from one format to another. Tracks
+    are converted in the background (see `shiva.jobs`), meanwhile clients are
+    told to ask again later, or sent the output of the conversion as it comes
+    with the TRANSCODING_PROGRESSIVE setting.
+    """
+
+    # Seconds clients are asked to wait before asking again.
+    RETRY_AFTER = 2
+    # Seconds to wait for a conversion to start, to send its output instead.
+    PROGRESSIVE_WAIT = 1
 
     def get(self, id):
         track = Track.query.get(id)
@@ -131,8 +163,30 @@ class ConvertResource(Resource):
             log.error(e)
             abort(HTTP.NOT_FOUND)
 
-        converter.convert()
-        uri = converter.get_uri()
+        if not converter.lookup():
+            job = jobs.get_job(converter)
+            if job.status == ConversionJob.FAILED:
+                return JSONResponse(status=HTTP.INTERNAL_SERVER_ERROR)
+
+            if job.status != ConversionJob.DONE:
+                if app.config.get('TRANSCODING_PROGRESSIVE'):
+                    partial_file = converter.open_partial_file(
+                        lambda: jobs.get_running_start(job.pk),
+                        self.PROGRESSIVE_WAIT)
+                    if partial_file is not None:
+                        return Response(partial_file,
+                                        mimetype=str(converter.mimetype),
+                                        direct_passthrough=True)
+
+                return JSONResponse({
+                    'id': str(job.pk),
+                    'status': job.status,
+                }, status=202, headers={
+                    'Location': request.url,
+                    'Retry-After': str(self.RETRY_AFTER),
+                })
+
+        uri = converter.get_file_uri()
 
         return JSONResponse(status=301, headers={'Location': uri})
 
@@ -141,7 +195,8 @@ class ShowsResource(Resource):
     """
     """
 
-    def get_resource_fields(self):
+    @classmethod
+    def get_resource_fields(cls):
         return {
             'id': fields.String,
             'artists': ManyToManyField(Artist, {
@@ -209,8 +264,7 @@ class ShowsResource(Resource):
             return
 
         for event in response.json():
-            yield marshal(ShowModel(artist_name, event),
-                          self.get_resource_fields())
+            yield self.marshal(ShowModel(artist_name, event))
 
 
 class RandomResource(Resource):
@@ -220,12 +274,9 @@ class RandomResource(Resource):
         get_resource = getattr(self, 'get_%s' % resource_name)
 
         if get_resource and callable(get_resource):
-            resource_fields = {
-                'id': fields.Integer(attribute='pk'),
-                'uri': InstanceURI(resource_name),
-            }
+            serialize = get_uri_serializer(resource_name)
 
-            return marshal(get_resource(), resource_fields)
+            return serialize(get_resource())
 
         abort(HTTP.NOT_FOUND)
 
@@ -270,9 +321,123 @@ class WhatsNewResource(Resource):
         """
 
         query = model.query.filter(model.date_added > self.since)
-        resource_fields = {
-            'id': fields.Integer(attribute='pk'),
-            'uri': InstanceURI(resource_name),
-        }
+        serialize = get_uri_serializer(resource_name)
+
+        return serialize(query.all())
+
+
+class SearchResource(Resource):
+    """
+    Full-text search over artists, albums and tracks, including the cached
+    lyrics of the latter:
+
+        /search/?q=<terms>[&type=artists,albums,tracks][&limit=<int>]
+
+    """
+
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 100
+
+    # Type of result: (resource, kinds of indexed documents)
+    types = {
+        'artists': (ArtistResource, ('artist',)),
+        'albums': (AlbumResource, ('album',)),
+        'tracks': (TrackResource, ('track', 'lyrics')),
+    }
+
+    def get(self):
+        terms = search.get_terms(request.args.get('q', ''))
+        if not terms:
+            abort(HTTP.BAD_REQUEST)
 
-        return [marshal(row, resource_fields) for row in query.all()]
+        types = get_list_param('type') or frozenset(self.types)
+        if not types.issubset(self.types):
+            abort(HTTP.BAD_REQUEST)
+
+        try:
+            limit = int(request.args.get('limit', self.DEFAULT_LIMIT))
+        except ValueError:
+            abort(HTTP.BAD_REQUEST)
+
+        limit = min(max(limit, 1), self.MAX_LIMIT)
+
+        results = {}
+        for name in types:
+            resource, kinds = self.types[name]
+            try:
+                pks = search.search(terms, kinds, limit)
+            except search.IndexNotFoundError, e:
+                log.error(e)
+                abort(HTTP.SERVICE_UNAVAILABLE)
+
+            results[name] = self.get_results(resource, pks)
+
+        return results
+
+    def get_results(self, resource, pks):
+        """Serializes the objects with the given pks, in the same order."""
+
+        if not pks:
+            return []
+
+        model = resource.db_model
+        objects = dict((obj.pk, obj) for obj
+                       in model.query.filter(model.pk.in_(pks)))
+
+        if resource is TrackResource:
+            serialize = TrackRelations(pks).get_track
+        else:
+            serialize = resource.get_serializer()
+
+        return [serialize(objects[pk]) for pk in pks if pk in objects]
+
+
+class SuggestResource(Resource):
+    """
+    As-you-type suggestions for artists, albums and tracks, served from memory:
+
+        /suggest/?q=<text>[&type=artists,albums,tracks][&limit=<int>]
+
+    """
+
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    # Type of result: kind of suggestion
+    types = {
+        'artists': 'artist',
+        'albums': 'album',
+        'tracks': 'track',
+    }
+    uris = dict((name, InstanceURI(name)) for name in types)
+
+    def get(self):
+        if not app.config.get('SUGGEST_ENABLED'):
+            abort(HTTP.NOT_FOUND)
+
+        query = request.args.get('q', '')
+        if not query.strip():
+            abort(HTTP.BAD_REQUEST)
+
+        types = get_list_param('type') or frozenset(self.types)
+        if not types.issubset(self.types):
+            abort(HTTP.BAD_REQUEST)
+
+        try:
+            limit = int(request.args.get('limit', self.DEFAULT_LIMIT))
+        except ValueError:
+            abort(HTTP.BAD_REQUEST)
+
+        limit = min(max(limit, 1), self.MAX_LIMIT)
+        kinds = frozenset(self.types[name] for name in types)
+
+        index = suggest.get_index()
+        suggestions = index.suggest(query, kinds=kinds, limit=limit)
+
+        return [{
+            'id': str(suggestion.pk),
+            'type': '%ss' % suggestion.kind,
+            'name': suggestion.name,
+            'uri': self.uris['%ss' % suggestion.kind].output('uri',
+                                                             suggestion),
+        } for suggestion in suggestions]
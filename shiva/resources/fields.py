@@ -1,16 +1,30 @@
 # -*- coding: utf-8 -*-
 from flask import current_app as app
-from flask.ext.restful import fields, marshal
+from flask.ext.restful import fields
 
 from shiva.converter import get_converter
 from shiva.media import get_mimetypes
 from shiva.models import TrackPlaylistRelationship
+from shiva.serializer import compile_fields
 
 
 class InstanceURI(fields.String):
-    def __init__(self, base_uri):
-        server_uri = app.config.get('SERVER_URI') or ''
-        self.base_uri = '/'.join((server_uri, base_uri))
+    """
+    URI of an object under the `resource` path. The SERVER_URI setting is only
+    read the first time, so fields can be built once, outside of requests.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        self._base_uri = None
+
+    @property
+    def base_uri(self):
+        if self._base_uri is None:
+            server_uri = app.config.get('SERVER_URI') or ''
+            self._base_uri = '/'.join((server_uri, self.resource))
+
+        return self._base_uri
 
     def output(self, key, obj):
         return '/'.join((self.base_uri, str(obj.pk)))
@@ -23,6 +37,9 @@ class TrackFiles(fields.Raw):
 
     """
 
+    # The columns this field needs to be loaded in order to be computed.
+    columns = ('path', 'bitrate')
+
     def output(self, key, track):
         ConverterClass = get_converter()
         paths = {}
@@ -38,15 +55,12 @@ class ManyToManyField(fields.Raw):
     def __init__(self, foreign_obj, nested):
         self.foreign_obj = foreign_obj
         self.nested = nested
+        self.serialize = compile_fields(nested)
 
         super(ManyToManyField, self).__init__()
 
     def output(self, key, obj):
-        items = list()
-        for item in getattr(obj, key):
-            items.append(marshal(item, self.nested))
-
-        return items
+        return [self.serialize(item) for item in getattr(obj, key)]
 
 
 class PlaylistField(fields.Raw):
@@ -58,6 +72,7 @@ class PlaylistField(fields.Raw):
 
     def __init__(self, nested):
         self.nested = nested
+        self.serialize = compile_fields(nested)
 
         super(PlaylistField, self).__init__()
 
@@ -82,7 +97,7 @@ class PlaylistField(fields.Raw):
         return output
 
     def marshal(self, r_track, index):
-        item = marshal(r_track, self.nested)
+        item = self.serialize(r_track)
         item['index'] = index
 
         return item
@@ -91,13 +106,14 @@ class PlaylistField(fields.Raw):
 class ForeignKeyField(fields.Raw):
     def __init__(self, foreign_obj, nested):
         self.nested = nested
+        self.serialize = compile_fields(nested)
 
         super(ForeignKeyField, self).__init__()
 
     def output(self, key, obj):
         _obj = getattr(obj, '%s' % key)
 
-        return marshal(_obj, self.nested)
+        return self.serialize(_obj)
 
 
 class Boolean(fields.Raw):
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Routing of reads to database replicas.
+
+Replicas are configured as regular Flask-SQLAlchemy binds, and listed by key in
+the SQLALCHEMY_READ_BINDS setting:
+
+    SQLALCHEMY_BINDS = {
+        'replica': 'postgresql://shiva@replica/shiva',
+    }
+    SQLALCHEMY_READ_BINDS = ('replica',)
+
+During requests that don't change anything (GET, HEAD and OPTIONS) the queries
+of the session go to one of the replicas, picked at random for every request.
+Everything else goes to the primary database, the one in
+SQLALCHEMY_DATABASE_URI. As soon as the session writes something, even during
+a GET, it sticks to the primary until the end of the request, so it always
+reads its own writes.
+"""
+from functools import partial
+import random
+
+from flask.ext.sqlalchemy import _SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import SelectBase
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingSession(_SignallingSession):
+    """Session sending its reads to a replica, if told to."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.read_bind = None
+
+        super(RoutingSession, self).__init__(db, **options)
+
+    def use_replica(self, use=True):
+        """
+        Sends the following reads to one of the replicas, if there are any and
+        `use` is true, or to the primary database otherwise.
+        """
+
+        read_binds = self.app.config.get('SQLALCHEMY_READ_BINDS') or ()
+        if use and read_binds:
+            self.read_bind = random.choice(read_binds)
+        else:
+            self.read_bind = None
+
+    def is_read(self, mapper, clause):
+        if self._flushing:
+            return False
+
+        if mapper is not None and \
+                getattr(mapper.mapped_table, 'info', {}).get('bind_key'):
+            return False
+
+        # Plain connections, asked for with `session.connection()`, are only
+        # used for reads while serving safe requests.
+        return clause is None or isinstance(clause, SelectBase)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.read_bind is not None:
+            if self.is_read(mapper, clause):
+                return self.db.get_engine(self.app, bind=self.read_bind)
+
+            # Read your own writes.
+            self.read_bind = None
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """``SQLAlchemy`` with a `RoutingSession` and replica aware DDL."""
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def get_write_binds(self, bind='__all__', app=None):
+        """
+        Like the `bind` argument of `create_all()`, but `'__all__'` doesn't
+        include the replicas, which get their schema from the primary.
+        """
+
+        if bind != '__all__':
+            return bind
+
+        app = self.get_app(app)
+        read_binds = app.config.get('SQLALCHEMY_READ_BINDS') or ()
+
+        binds = app.config.get('SQLALCHEMY_BINDS') or ()
+
+        return [None] + [key for key in binds if key not in read_binds]
+
+    def create_all(self, bind='__all__', app=None):
+        super(RoutingSQLAlchemy, self).create_all(
+            self.get_write_binds(bind, app), app)
+
+    def drop_all(self, bind='__all__', app=None):
+        super(RoutingSQLAlchemy, self).drop_all(
+            self.get_write_binds(bind, app), app)
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search over artist names, album names, track titles and cached
+lyrics.
+
+The texts are kept in an index living in the same database as the rest of the
+models, using the best tool each database offers: an FTS5 virtual table on
+SQLite, a GIN-indexed tsvector on PostgreSQL and, on any other database, a
+plain table queried with LIKE.
+
+The index is created along with the rest of the tables by ``db.create_all()``
+and it's kept up to date on every write made through the ORM. It can be built
+from scratch, for example for databases created before it existed, with:
+
+    shiva-admin search rebuild
+
+"""
+from contextlib import contextmanager
+import re
+import weakref
+
+from sqlalchemy import (Column, event, Index, Integer, MetaData, String,
+                        Table, Text, UniqueConstraint, and_, case, func,
+                        inspect, literal, literal_column, select)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import OperationalError
+
+from shiva import dbtypes
+from shiva.models import Album, Artist, db, LyricsCache, Track
+from shiva.utils import get_logger
+
+log = get_logger()
+
+# Maximum number of words taken into account from a query.
+MAX_TERMS = 8
+# Shorter terms only match whole words. A single letter is a prefix of too many
+# of them, which makes ranking the results slow.
+MIN_PREFIX_LENGTH = 2
+# Results found in lyrics, which are long and match almost anything, are worth
+# less than those found in names and titles.
+WEIGHTS = {'lyrics': 0.5}
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+_backends = weakref.WeakKeyDictionary()
+_suspended = [0]
+
+
+class IndexNotFoundError(Exception):
+    def __init__(self):
+        msg = ("The search index doesn't exist. Please run 'shiva-admin "
+               "search rebuild' to create it.")
+
+        super(IndexNotFoundError, self).__init__(msg)
+
+
+def get_sources():
+    """
+    Returns the columns to index, as tuples of the kind of document, the
+    primary key it refers to and the column holding the text.
+    """
+
+    return (
+        ('artist', Artist.__table__.c.pk, Artist.__table__.c.name),
+        ('album', Album.__table__.c.pk, Album.__table__.c.name),
+        ('track', Track.__table__.c.pk, Track.__table__.c.title),
+        ('lyrics', LyricsCache.__table__.c.track_pk,
+         LyricsCache.__table__.c.text),
+    )
+
+
+def get_terms(query):
+    """Splits a query into a list of lowercase words."""
+
+    return TERM_RE.findall(query.lower())[:MAX_TERMS]
+
+
+def is_prefix(term):
+    return len(term) >= MIN_PREFIX_LENGTH
+
+
+def get_weight(kind_column):
+    whens = [(kind_column == kind, weight)
+             for kind, weight in WEIGHTS.iteritems()]
+
+    return case(whens, else_=1.0)
+
+
+class SearchBackend(object):
+    """
+    Base class for search backends. Every indexed text is represented by a row
+    in the `search_documents` table, identified by its kind and the primary key
+    of the object it belongs to. Each backend decides where and how the text
+    itself is stored.
+    """
+
+    def __init__(self):
+        self.metadata = MetaData()
+        self.documents = Table('search_documents', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('kind', String(16), nullable=False),
+            Column('pk', dbtypes.GUID, nullable=False),
+            UniqueConstraint('kind', 'pk'),
+            *self.get_columns())
+
+    def get_columns(self):
+        """Extra columns and indexes for the `search_documents` table."""
+
+        return ()
+
+    def exists(self, connection):
+        return connection.dialect.has_table(connection, 'search_documents')
+
+    def create(self, connection):
+        self.metadata.create_all(connection)
+
+    def drop(self, connection):
+        self.metadata.drop_all(connection)
+
+    def get_id(self, connection, kind, pk):
+        documents = self.documents
+        query = select([documents.c.id]).where(and_(
+            documents.c.kind == kind, documents.c.pk == pk))
+
+        return connection.execute(query).scalar()
+
+    def add(self, connection, kind, pk, content):
+        """Indexes a text, replacing the previous one for the same object."""
+
+        raise NotImplementedError
+
+    def remove(self, connection, kind, pk):
+        documents = self.documents
+        connection.execute(documents.delete().where(and_(
+            documents.c.kind == kind, documents.c.pk == pk)))
+
+    def search(self, connection, terms, kinds, limit):
+        """
+        Returns the (kind, pk) pairs of the documents of the given `kinds`
+        matching all the `terms`, most relevant first. The last word of a
+        text being typed is usually incomplete, so terms match as prefixes
+        (see `MIN_PREFIX_LENGTH`).
+        """
+
+        raise NotImplementedError
+
+    def rebuild(self, connection):
+        """Empties the index and fills it again with all the sources."""
+
+        raise NotImplementedError
+
+
+class SQLiteBackend(SearchBackend):
+    """
+    Stores the texts in an FTS5 virtual table, whose rowids are the ids of the
+    `search_documents` table. Results are ranked with BM25.
+    """
+
+    def __init__(self):
+        super(SQLiteBackend, self).__init__()
+
+        # Only used to build queries, the virtual table is created with raw
+        # SQL.
+        self.index = Table('search_index', MetaData(),
+            Column('rowid', Integer),
+            Column('text', Text))
+
+    def exists(self, connection):
+        return connection.dialect.has_table(connection, 'search_index')
+
+    def create(self, connection):
+        # Will fail if SQLite was compiled without FTS5.
+        connection.execute("CREATE VIRTUAL TABLE search_index USING fts5("
+                           "text, tokenize = 'unicode61 remove_diacritics 1')")
+
+        super(SQLiteBackend, self).create(connection)
+
+    def drop(self, connection):
+        connection.execute('DROP TABLE IF EXISTS search_index')
+
+        super(SQLiteBackend, self).drop(connection)
+
+    def add(self, connection, kind, pk, content):
+        id = self.get_id(connection, kind, pk)
+        if id is None:
+            result = connection.execute(self.documents.insert(), kind=kind,
+                                        pk=pk)
+            id = result.inserted_primary_key[0]
+        else:
+            connection.execute(self.index.delete().where(
+                self.index.c.rowid == id))
+
+        connection.execute(self.index.insert(), rowid=id, text=content)
+
+    def remove(self, connection, kind, pk):
+        id = self.get_id(connection, kind, pk)
+        if id is None:
+            return None
+
+        connection.execute(self.index.delete().where(self.index.c.rowid == id))
+        connection.execute(self.documents.delete().where(
+            self.documents.c.id == id))
+
+    def search(self, connection, terms, kinds, limit):
+        documents = self.documents
+        table = literal_column('search_index')
+
+        # Every term is quoted so words like AND or NEAR are not taken as
+        # operators. The trailing asterisk makes them prefixes.
+        match = ' '.join(('"%s"*' if is_prefix(term) else '"%s"') % term
+                         for term in terms)
+        rank = func.bm25(table) * get_weight(documents.c.kind)
+
+        query = select([documents.c.kind, documents.c.pk]).select_from(
+            self.index.join(documents, documents.c.id == self.index.c.rowid))
+        query = query.where(table.match(match)).where(
+            documents.c.kind.in_(kinds))
+
+        # BM25 scores are negative, the lower the better.
+        return connection.execute(query.order_by(rank).limit(limit))
+
+    def rebuild(self, connection):
+        documents = self.documents
+        connection.execute(self.index.delete())
+        connection.execute(documents.delete())
+
+        for kind, pk, content in get_sources():
+            query = select([literal(kind), pk]).where(content.isnot(None))
+            connection.execute(documents.insert().from_select(
+                ('kind', 'pk'), query))
+
+            query = select([documents.c.id, content]).select_from(
+                documents.join(pk.table, documents.c.pk == pk)).where(
+                documents.c.kind == kind)
+            connection.execute(self.index.insert().from_select(
+                ('rowid', 'text'), query))
+
+
+class PostgreSQLBackend(SearchBackend):
+    """
+    Stores a tsvector for every text, with a GIN index on top. The 'simple'
+    configuration is used, as names and titles in a music collection come in
+    any language. Results are ranked with ts_rank.
+    """
+
+    config = 'simple'
+
+    def get_columns(self):
+        return (
+            Column('document', TSVECTOR, nullable=False),
+            Index('search_documents_document', 'document',
+                  postgresql_using='gin'),
+        )
+
+    def add(self, connection, kind, pk, content):
+        self.remove(connection, kind, pk)
+
+        document = func.to_tsvector(self.config, content)
+        connection.execute(self.documents.insert().values(
+            kind=kind, pk=pk, document=document))
+
+    def search(self, connection, terms, kinds, limit):
+        documents = self.documents
+
+        tsquery = ' & '.join(('%s:*' if is_prefix(term) else '%s') % term
+                             for term in terms)
+        tsquery = func.to_tsquery(self.config, tsquery)
+        rank = func.ts_rank(documents.c.document, tsquery) * get_weight(
+            documents.c.kind)
+
+        query = select([documents.c.kind, documents.c.pk]).where(
+            documents.c.document.op('@@')(tsquery)).where(
+            documents.c.kind.in_(kinds))
+
+        return connection.execute(query.order_by(rank.desc()).limit(limit))
+
+    def rebuild(self, connection):
+        documents = self.documents
+        connection.execute(documents.delete())
+
+        for kind, pk, content in get_sources():
+            query = select([literal(kind), pk,
+                            func.to_tsvector(self.config, content)]).where(
+                content.isnot(None))
+            connection.execute(documents.insert().from_select(
+                ('kind', 'pk', 'document'), query))
+
+
+class LikeBackend(SearchBackend):
+    """
+    Fallback for databases without full-text search support, or for SQLite
+    builds without FTS5. Texts are stored lowercased and every term is looked
+    up with LIKE, which doesn't make use of indexes. Shorter texts rank first.
+    """
+
+    def get_columns(self):
+        return (Column('text', Text),)
+
+    def add(self, connection, kind, pk, content):
+        self.remove(connection, kind, pk)
+        connection.execute(self.documents.insert(), kind=kind, pk=pk,
+                           text=content.lower())
+
+    def search(self, connection, terms, kinds, limit):
+        documents = self.documents
+
+        query = select([documents.c.kind, documents.c.pk]).where(
+            documents.c.kind.in_(kinds))
+        for term in terms:
+            # `\w` matches the underscore, a wildcard for LIKE.
+            pattern = '%%%s%%' % term.replace('_', '\\_')
+            query = query.where(documents.c.text.like(pattern, escape='\\'))
+
+        query = query.order_by(func.length(documents.c.text))
+
+        return connection.execute(query.limit(limit))
+
+    def rebuild(self, connection):
+        documents = self.documents
+        connection.execute(documents.delete())
+
+        for kind, pk, content in get_sources():
+            query = select([literal(kind), pk, func.lower(content)]).where(
+                content.isnot(None))
+            connection.execute(documents.insert().from_select(
+                ('kind', 'pk', 'text'), query))
+
+
+# Backends to try for each database, in order of preference.
+BACKENDS = {
+    'postgresql': (PostgreSQLBackend,),
+    'sqlite': (SQLiteBackend, LikeBackend),
+}
+
+
+def get_backend_classes(connection):
+    return BACKENDS.get(connection.dialect.name, (LikeBackend,))
+
+
+def get_backend(connection):
+    """
+    Returns the backend of the index present in the database, or None if there
+    isn't one.
+    """
+
+    engine = connection.engine
+    if engine not in _backends:
+        for Backend in get_backend_classes(connection):
+            backend = Backend()
+            if backend.exists(connection):
+                _backends[engine] = backend
+                break
+        else:
+            # Not cached, so the index is found once it gets created.
+            return None
+
+    return _backends[engine]
+
+
+def create_index(connection):
+    """Creates the index with the best backend available and fills it."""
+
+    for Backend in get_backend_classes(connection):
+        backend = Backend()
+        try:
+            backend.create(connection)
+        except OperationalError:
+            log.debug('%s not available' % Backend.__name__)
+            continue
+
+        backend.rebuild(connection)
+        _backends[connection.engine] = backend
+
+        return backend
+
+
+def drop_index(connection):
+    backend = get_backend(connection)
+    if backend is not None:
+        backend.drop(connection)
+        del _backends[connection.engine]
+
+
+def rebuild():
+    """
+    Builds the index from scratch, creating it first if it doesn't exist yet.
+    """
+
+    connection = db.session.connection()
+    backend = get_backend(connection)
+    if backend is None:
+        create_index(connection)
+    else:
+        backend.rebuild(connection)
+
+    db.session.commit()
+
+
+def search(terms, kinds, limit):
+    """
+    Returns the primary keys of the objects matching all the `terms`, most
+    relevant first. See `SearchBackend.search()`.
+    """
+
+    connection = db.session.connection()
+    backend = get_backend(connection)
+    if backend is None:
+        raise IndexNotFoundError
+
+    pks = []
+    for kind, pk in backend.search(connection, terms, kinds, limit):
+        # The same track may be found by its title and by its lyrics.
+        if pk not in pks:
+            pks.append(pk)
+
+    return pks
+
+
+@contextmanager
+def suspended(condition=True):
+    """
+    Stops keeping the index up to date while inside the block, if `condition`
+    is true. Useful for bulk inserts, followed by a `rebuild()`.
+    """
+
+    if not condition:
+        yield
+        return
+
+    _suspended[0] += 1
+    try:
+        yield
+    finally:
+        _suspended[0] -= 1
+
+
+def _watch(model, kind, pk_attr, text_attr, also_remove=()):
+    """
+    Keeps the index up to date with the changes made to the `text_attr`
+    attribute of `model` instances.
+    """
+
+    def update(connection, target, force=False):
+        if _suspended[0]:
+            return None
+
+        backend = get_backend(connection)
+        if backend is None:
+            return None
+
+        if not force:
+            history = inspect(target).attrs[text_attr].history
+            if not history.has_changes():
+                return None
+
+        content = getattr(target, text_attr)
+        if content:
+            backend.add(connection, kind, getattr(target, pk_attr), content)
+        else:
+            backend.remove(connection, kind, getattr(target, pk_attr))
+
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        update(connection, target, force=True)
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, target):
+        update(connection, target)
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        if _suspended[0]:
+            return None
+
+        backend = get_backend(connection)
+        if backend is not None:
+            pk = getattr(target, pk_attr)
+            for _kind in (kind,) + also_remove:
+                backend.remove(connection, _kind, pk)
+
+
+_watch(Artist, 'artist', 'pk', 'name')
+_watch(Album, 'album', 'pk', 'name')
+_watch(Track, 'track', 'pk', 'title', also_remove=('lyrics',))
+_watch(LyricsCache, 'lyrics', 'track_pk', 'text')
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_index(target, connection, **kwargs):
+    if get_backend(connection) is None:
+        create_index(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_index(target, connection, **kwargs):
+    drop_index(connection)
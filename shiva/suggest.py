@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+As-you-type suggestions for artist names, album names and track titles.
+
+The names are kept in memory, in an index built with a scan of just the
+primary key and name columns, so every keystroke can be answered without
+touching the database. Words of the query match words of the names as
+prefixes. Query words that no indexed word starts with are taken as typos, and
+words within a small edit distance of them are accepted instead.
+
+Changes committed through this process' sessions are applied to the index as
+they happen. Changes made by other processes, like the indexer, are picked up
+the next time the server starts.
+"""
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import chain
+import heapq
+import re
+import threading
+import unicodedata
+import weakref
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from shiva.models import Album, Artist, db, Track
+
+# Maximum number of objects considered for each query before ranking them,
+# besides the ones whose name starts with the query.
+MAX_CANDIDATES = 5000
+# Words shorter than this are not corrected, too many words are one or two
+# edits away from them.
+MIN_FUZZY_LENGTH = 3
+# Maximum number of words, those sharing more trigrams with a misspelled one,
+# whose edit distance to it is computed.
+MAX_FUZZY_CANDIDATES = 200
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+Suggestion = namedtuple('Suggestion', ('kind', 'pk', 'name'))
+
+_indexes = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_sources():
+    """Returns the (kind, model, attribute) tuples to index."""
+
+    return (
+        ('artist', Artist, 'name'),
+        ('album', Album, 'name'),
+        ('track', Track, 'title'),
+    )
+
+
+def tokenize(text):
+    """
+    Splits a text into lowercase words, without accents, so 'Björk' can be
+    found typing 'bjork'.
+    """
+
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'ignore')
+
+    try:
+        # Most names are plain ASCII, with nothing to strip.
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        pass
+    else:
+        return WORD_RE.findall(text.lower())
+
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+
+    return WORD_RE.findall(text)
+
+
+def trigrams(word):
+    """
+    Returns the set of trigrams of a word. It's padded only at the beginning,
+    as query words are usually prefixes of the indexed ones.
+    """
+
+    word = u'  ' + word
+
+    return set(word[i:i + 3] for i in xrange(len(word) - 2))
+
+
+def prefix_distance(word, other, max_distance):
+    """
+    Returns the edit distance between `word` and the closest prefix of `other`,
+    or None if it's greater than `max_distance`.
+    """
+
+    previous = range(len(other) + 1)
+    for i, char in enumerate(word, 1):
+        current = [i]
+        for j, other_char in enumerate(other, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char != other_char)))
+
+        if min(current) > max_distance:
+            return None
+
+        previous = current
+
+    distance = min(previous)
+
+    return distance if distance <= max_distance else None
+
+
+class SuggestIndex(object):
+    """
+    In-memory index of names. Every distinct word points to the objects whose
+    names contain it, shortest names first, and words are kept sorted so all
+    the words starting with a prefix can be found with a binary search. A
+    trigram index over the words gives the candidates for typo correction.
+
+    Objects are identified by their primary key alone, which is assumed to be
+    unique across kinds, as UUIDs are. Internally they are numbered, and their
+    data kept in lists, to keep the index small. The numbers of removed objects
+    are given to the next ones added, so the lists don't grow with renames.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ids = {}
+        self.kinds = []
+        self.pks = []
+        self.names = []
+        self.words = []
+        # Numbers of the removed objects, free to reuse.
+        self.free = []
+        self.postings = {}
+        self.sorted_words = []
+        self.trigrams = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _append(self, kind, pk, name, words):
+        """Stores a new object, returning its number."""
+
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+
+        if self.free:
+            id = self.free.pop()
+            self.kinds[id] = kind
+            self.pks[id] = pk
+            self.names[id] = name
+            self.words[id] = words
+        else:
+            id = len(self.pks)
+            self.kinds.append(kind)
+            self.pks.append(pk)
+            self.names.append(name)
+            self.words.append(words)
+        self.ids[pk] = id
+
+        return id
+
+    def load(self, rows):
+        """
+        Fills an empty index with (kind, pk, name) rows. Faster than adding
+        them one by one, as words are sorted only once.
+        """
+
+        with self.lock:
+            shared = {}
+            for kind, pk, name in rows:
+                words = tokenize(name or '')
+                if not words:
+                    continue
+
+                # Shares the word strings among all the names containing them.
+                words = tuple(shared.setdefault(word, word) for word in words)
+                id = self._append(kind, pk, name, words)
+                for word in set(words):
+                    self.postings.setdefault(word, []).append(id)
+
+            for ids in self.postings.itervalues():
+                ids.sort(key=self.get_order)
+            self.sorted_words = sorted(self.postings)
+            for word in self.sorted_words:
+                for trigram in trigrams(word):
+                    self.trigrams.setdefault(trigram, set()).add(word)
+
+    def add(self, kind, pk, name):
+        """Adds an object to the index, replacing its previous name."""
+
+        with self.lock:
+            self.remove(kind, pk)
+
+            words = tokenize(name or '')
+            if not words:
+                return None
+
+            id = self._append(kind, pk, name, tuple(words))
+            for word in set(words):
+                if word not in self.postings:
+                    self.postings[word] = []
+                    self.sorted_words.insert(
+                        bisect_left(self.sorted_words, word), word)
+                    for trigram in trigrams(word):
+                        self.trigrams.setdefault(trigram, set()).add(word)
+
+                self.insert(self.postings[word], id)
+
+    def get_order(self, id):
+        """Returns the key objects are sorted by, shortest names first."""
+
+        return len(self.names[id]), self.names[id]
+
+    def insert(self, ids, id):
+        """Inserts an object in a list of them, keeping it sorted."""
+
+        key = self.get_order(id)
+        low, high = 0, len(ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_order(ids[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        ids.insert(low, id)
+
+    def remove(self, kind, pk):
+        with self.lock:
+            id = self.ids.pop(pk, None)
+            if id is None:
+                return None
+
+            words = set(self.words[id])
+            self.kinds[id] = self.pks[id] = self.names[id] = None
+            self.words[id] = ()
+            self.free.append(id)
+
+            for word in words:
+                ids = self.postings[word]
+                ids.remove(id)
+                if ids:
+                    continue
+
+                del self.postings[word]
+                del self.sorted_words[bisect_left(self.sorted_words, word)]
+                for trigram in trigrams(word):
+                    self.trigrams[trigram].discard(word)
+                    if not self.trigrams[trigram]:
+                        del self.trigrams[trigram]
+
+    def get_prefixed(self, term):
+        """Returns the set of indexed words starting with `term`."""
+
+        start = bisect_left(self.sorted_words, term)
+        end = bisect_left(self.sorted_words, term + u'\U0010ffff')
+
+        return set(self.sorted_words[start:end])
+
+    def get_similar(self, term):
+        """
+        Returns the set of indexed words starting with something close enough
+        to `term`: 1 edit away for words up to 5 characters, 2 for longer ones.
+        """
+
+        if len(term) < MIN_FUZZY_LENGTH:
+            return set()
+
+        max_distance = 1 if len(term) <= 5 else 2
+        term_trigrams = trigrams(term)
+
+        # Every edit changes at most 3 trigrams.
+        min_shared = max(1, len(term_trigrams) - 3 * max_distance)
+
+        shared = {}
+        for trigram in term_trigrams:
+            for word in self.trigrams.get(trigram, ()):
+                shared[word] = shared.get(word, 0) + 1
+
+        candidates = heapq.nlargest(MAX_FUZZY_CANDIDATES, (
+            (count, word) for word, count in shared.iteritems()
+            if count >= min_shared))
+
+        return set(word for count, word in candidates
+                   if prefix_distance(term, word, max_distance) is not None)
+
+    def starts_with(self, id, terms):
+        """Tells whether the name of an object starts with the terms."""
+
+        words = self.words[id]
+        last = len(terms) - 1
+
+        return (len(words) > last and words[last].startswith(terms[last]) and
+                all(words[i] == terms[i] for i in xrange(last)))
+
+    def match(self, terms, kinds, limit):
+        """
+        Returns the numbers of the objects of `kinds` with, for every term, a
+        word starting with it. Terms no word starts with are taken as
+        misspelled, and words similar to them are accepted instead.
+
+        Objects are looked at shortest names first, so the search stops once
+        `limit` names starting with the terms are found, as no other can rank
+        higher. Only up to MAX_CANDIDATES of the rest are kept.
+        """
+
+        accepted = [self.get_prefixed(term) or self.get_similar(term)
+                    for term in terms]
+        if not all(accepted):
+            return []
+
+        # The smallest set of words narrows the search the most.
+        accepted.sort(key=len)
+        postings = heapq.merge(*[((self.get_order(id), id) for id in ids)
+                                 for ids in (self.postings[word]
+                                             for word in accepted[0])])
+        starting, others = [], []
+        seen = set()
+        for _, id in postings:
+            if id in seen:
+                continue
+            seen.add(id)
+
+            if kinds is not None and self.kinds[id] not in kinds:
+                continue
+
+            if self.starts_with(id, terms):
+                starting.append(id)
+                if len(starting) >= limit:
+                    break
+            elif len(others) < MAX_CANDIDATES and all(
+                    any(word in words for word in self.words[id])
+                    for words in accepted[1:]):
+                others.append(id)
+
+        return starting + others
+
+    def suggest(self, query, kinds=None, limit=10):
+        """
+        Returns up to `limit` suggestions for `query`, optionally restricted to
+        some `kinds` ('artist', 'album' or 'track'). Names starting with the
+        query come first, then the rest, shortest first.
+        """
+
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        def rank(id):
+            return not self.starts_with(id, terms), self.get_order(id)
+
+        with self.lock:
+            # Names are stored UTF-8 encoded, to keep them small.
+            ids = heapq.nsmallest(limit, self.match(terms, kinds, limit),
+                                  key=rank)
+
+            return [Suggestion(self.kinds[id], self.pks[id],
+                               self.names[id].decode('utf-8'))
+                    for id in ids]
+
+
+def build_index():
+    """Builds an index with all the names in the database."""
+
+    def rows():
+        for kind, model, attribute in get_sources():
+            query = db.session.query(model.pk, getattr(model, attribute))
+            for pk, name in query.yield_per(1000):
+                yield kind, str(pk), name
+
+    index = SuggestIndex()
+    index.load(rows())
+
+    return index
+
+
+def get_index():
+    """
+    Returns the index for the current database, building it the first time.
+    """
+
+    engine = db.engine
+    if engine not in _indexes:
+        with _lock:
+            if engine not in _indexes:
+                _indexes[engine] = build_index()
+
+    return _indexes[engine]
+
+
+def get_changes(session):
+    """
+    Returns the changes to the indexed names in a session being flushed, as
+    (engine, kind, pk, name) tuples. The name is None for deleted objects.
+    Changes to databases with no index in this process are ignored, so bulk
+    inserts like the indexer's don't pay for them.
+    """
+
+    sources = dict((model, (kind, attribute))
+                   for kind, model, attribute in get_sources())
+
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if type(obj) not in sources:
+            continue
+
+        kind, attribute = sources[type(obj)]
+        state = inspect(obj)
+        engine = session.get_bind(state.mapper)
+        if engine not in _indexes:
+            continue
+
+        if obj in session.deleted:
+            yield engine, kind, str(obj.pk), None
+        elif obj in session.new or \
+                state.attrs[attribute].history.has_changes():
+            yield engine, kind, str(obj.pk), getattr(obj, attribute)
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    # Only applied on commit, in case the transaction is rolled back.
+    changes = list(get_changes(session))
+    if changes:
+        session.info.setdefault('suggest_changes', []).extend(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for engine, kind, pk, name in session.info.pop('suggest_changes', ()):
+        index = _indexes[engine]
+        if name is None:
+            index.remove(kind, pk)
+        else:
+            index.add(kind, pk, name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('suggest_changes', None)
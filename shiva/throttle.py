@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Bandwidth shaping of the file server.
+
+Every file sent is a stream, limited to a number of bytes per second by a
+token bucket. The limits, all in bytes per second, come from:
+
+* The URL of the file, as given out by the API. Tracks are sent at
+  STREAM_BITRATE_MULTIPLIER times their bitrate, enough to play them without
+  waiting, and the user they were given to is limited to USER_RATE_LIMIT, or
+  its value in USER_RATE_LIMITS, for all of the files it's sent at once. These
+  limits are signed along with the path of the file, so they can't be changed
+  by the clients nor moved to other files, and they expire after
+  STREAM_TOKEN_MAX_AGE seconds.
+* STREAM_RATE_LIMIT, for every other file (and for URLs stripped of their
+  limits), and USER_RATE_LIMIT for everything sent to the same address.
+* EGRESS_RATE_LIMIT, which caps all of them together. It's shared fairly: the
+  streams below their fair share of it get all they can take, and the rest is
+  split evenly among the others. This way a handful of downloads can't slow
+  down the listeners.
+
+Limits are kept by each process of the file server.
+"""
+from time import sleep, time
+import threading
+
+from flask import current_app as app, g
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Seconds worth of data a stream can send at once, after a pause.
+BURST_SECONDS = 1
+
+
+def get_fair_shares(rate, limits):
+    """
+    Splits `rate` among the keys of `limits`, max-min fairly. No key gets more
+    than its limit (None for no limit), and the ones below their limit get the
+    same share.
+    """
+
+    shares = {}
+    remaining = rate
+    # Lowest limits first, no limit last.
+    pending = sorted(limits.iteritems(),
+                     key=lambda item: (item[1] is None, item[1]))
+    for index, (key, limit) in enumerate(pending):
+        share = float(remaining) / (len(pending) - index)
+        if limit is not None and limit < share:
+            share = limit
+        shares[key] = share
+        remaining -= share
+
+    return shares
+
+
+class TokenBucket(object):
+    """
+    Lets through `rate` bytes per second, and up to `burst` bytes at once.
+    Bytes are taken from it before sending them, and the bucket says how long
+    to wait before doing so.
+    """
+
+    def __init__(self, rate, burst=None, timer=time):
+        self.rate = float(rate)
+        self.fixed_burst = burst
+        self.burst = burst or max(self.rate * BURST_SECONDS, 1)
+        self.tokens = self.burst
+        self.timer = timer
+        self.updated = timer()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.timer()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+            self.burst = self.fixed_burst or max(self.rate * BURST_SECONDS, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, amount):
+        """
+        Takes `amount` bytes from the bucket, and returns the seconds to wait
+        before sending them. The ones taken in advance are paid by whoever
+        comes next, so the rate is kept even if they don't wait.
+        """
+
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate if self.rate else float('inf')
+
+
+class Stream(object):
+    """A file being sent, see `Scheduler.open()`."""
+
+    def __init__(self, scheduler, limit, user, user_limit):
+        self.scheduler = scheduler
+        self.limit = limit
+        self.user = user
+        self.user_limit = user_limit
+        self.bucket = None
+        self.closed = False
+
+    @property
+    def rate(self):
+        return self.bucket.rate if self.bucket is not None else None
+
+    def set_rate(self, rate):
+        if rate is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate, timer=self.scheduler.timer)
+        else:
+            self.bucket.set_rate(rate)
+
+    def reserve(self, amount):
+        """Non blocking version of `consume()`, returns the time to wait."""
+
+        bucket = self.bucket
+        if bucket is None:
+            return 0
+
+        return bucket.reserve(amount)
+
+    def consume(self, amount):
+        """Waits until `amount` bytes can be sent."""
+
+        delay = self.reserve(amount)
+        if delay:
+            sleep(delay)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.scheduler.close(self)
+
+
+class Scheduler(object):
+    """
+    Keeps track of the streams, and sets the rate of each one from its limits
+    and its share of the total `rate` (None for no limit).
+    """
+
+    def __init__(self, rate=None, timer=time):
+        self.rate = rate
+        self.timer = timer
+        self.streams = set()
+        self.lock = threading.Lock()
+
+    def open(self, limit=None, user=None, user_limit=None):
+        """
+        Returns a new stream, limited to `limit` bytes per second, and to
+        `user_limit` along with the rest of the streams of `user`.
+        """
+
+        stream = Stream(self, limit, user, user_limit)
+        with self.lock:
+            self.streams.add(stream)
+            self.allocate()
+
+        return stream
+
+    def close(self, stream):
+        with self.lock:
+            self.streams.discard(stream)
+            self.allocate()
+
+    def allocate(self):
+        users = {}
+        for stream in self.streams:
+            users[stream.user] = users.get(stream.user, 0) + 1
+
+        # The limit of each user is split evenly among its streams.
+        limits = {}
+        for stream in self.streams:
+            limit = stream.limit
+            if stream.user_limit is not None:
+                user_share = float(stream.user_limit) / users[stream.user]
+                limit = min(limit, user_share) if limit is not None \
+                    else user_share
+            limits[stream] = limit
+
+        if self.rate is not None:
+            limits = get_fair_shares(self.rate, limits)
+
+        for stream, rate in limits.iteritems():
+            stream.set_rate(rate)
+
+
+def get_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='stream')
+
+
+def get_stream_token(path, bitrate=None):
+    """
+    Returns the signed limits of a file sent to the current user, for its URL,
+    or None if there are none. `path` is the one of the file in the file
+    server, and `bitrate` the one of the track, in kbps.
+    """
+
+    multiplier = app.config.get('STREAM_BITRATE_MULTIPLIER')
+    user_limits = app.config.get('USER_RATE_LIMITS') or {}
+    user_limit = app.config.get('USER_RATE_LIMIT')
+
+    limit = None
+    if multiplier and bitrate:
+        limit = int(bitrate * 1000 / 8 * multiplier)
+
+    user_pk = None
+    user = getattr(g, 'user', None)
+    if user is not None:
+        user_pk = str(user.pk)
+        user_limit = user_limits.get(user.email, user_limit)
+
+    if limit is None and user_limit is None:
+        return None
+
+    return get_serializer().dumps([path, limit, user_pk, user_limit])
+
+
+def load_stream_token(token, path):
+    """
+    Returns the (limit, user, user_limit) signed by `get_stream_token()` for
+    the file in `path`, or None if the token is missing, expired, not valid or
+    given for another file.
+    """
+
+    if not token:
+        return None
+
+    try:
+        signed_path, limit, user, user_limit = get_serializer().loads(
+            token, max_age=app.config.get('STREAM_TOKEN_MAX_AGE', 86400))
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+    if signed_path != path:
+        return None
+
+    return limit, user, user_limit
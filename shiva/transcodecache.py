@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of converted tracks.
+
+Unless the TRANSCODE_CACHE_DIR setting is empty, converted tracks are kept in
+that directory, instead of next to the originals, and served from there by the
+file server. Every time a track is asked for in a format, the time it was last
+used is kept as the access time of its file, also when the filesystem is
+mounted with `noatime`. Once the cache takes more than TRANSCODE_CACHE_SIZE
+bytes, the files used least recently are removed, to be converted again if
+needed.
+
+The files are shared by all the processes of the API, which look at the
+directory every time they add a file. Files being written (see
+`shiva.converter.Converter.convert()`) are not taken into account.
+"""
+from collections import OrderedDict
+from time import time
+import hashlib
+import os
+import threading
+
+from flask import current_app as app, has_app_context
+
+from shiva import metrics
+from shiva.utils import get_logger, ignored
+
+log = get_logger()
+
+
+class TranscodeCache(object):
+    """
+    Converted tracks in the `root` directory, up to `quota` bytes (None for no
+    limit). Keeps the count of the lookups found in it, and not found.
+    """
+
+    def __init__(self, root, quota=None, timer=time):
+        self.root = root
+        self.quota = quota
+        self.timer = timer
+        self.lock = threading.Lock()
+        # Size of each file, least recently used first. Loaded on first use.
+        self.files = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.lock:
+            self.load()
+
+            return len(self.files)
+
+    def get_path(self, track_path, extension):
+        """
+        Returns the path of the track in `track_path` converted to the format
+        of `extension`. Named after the path, as different tracks may have the
+        same name.
+        """
+
+        directory = os.path.join(self.root, extension)
+        if not os.path.exists(directory):
+            with ignored(OSError):
+                os.makedirs(directory)
+
+        if isinstance(track_path, unicode):
+            track_path = track_path.encode('utf-8')
+        filename = '%s.%s' % (hashlib.sha1(track_path).hexdigest(), extension)
+
+        return os.path.join(directory, filename)
+
+    def load(self):
+        if self.files is None:
+            self.scan()
+
+    def scan(self):
+        """Finds the files in the cache, and when they were last used."""
+
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed meanwhile.
+                    continue
+                found.append((stat.st_atime, path, stat.st_size))
+
+        found.sort()
+        self.files = OrderedDict((path, size) for _, path, size in found)
+        self.bytes = sum(self.files.itervalues())
+        metrics.TRANSCODE_CACHE_BYTES.set(self.bytes)
+
+    def touch(self, path):
+        """Sets the access time of the file, without changing its mtime."""
+
+        with ignored(OSError):
+            os.utime(path, (self.timer(), os.stat(path).st_mtime))
+
+    def lookup(self, path):
+        """Tells whether the file is in the cache, and marks it as used."""
+
+        with self.lock:
+            self.load()
+            size = self.files.pop(path, None)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.misses += 1
+                if size is not None:
+                    self.bytes -= size
+                    metrics.TRANSCODE_CACHE_BYTES.set(self.bytes)
+
+                return False
+
+            self.hits += 1
+            self.touch(path)
+            if size is None:
+                # Added by another process.
+                self.bytes += stat.st_size
+                metrics.TRANSCODE_CACHE_BYTES.set(self.bytes)
+            self.files[path] = stat.st_size
+
+            return True
+
+    def add(self, path):
+        """
+        Takes a new file into account, and removes the ones used least
+        recently if the cache takes more than its quota.
+        """
+
+        with self.lock:
+            self.touch(path)
+            self.scan()
+            self.evict(keep=path)
+
+    def evict(self, keep=None):
+        if self.quota is None:
+            return None
+
+        for path, size in self.files.items():
+            if self.bytes <= self.quota:
+                break
+            if path == keep:
+                continue
+
+            with ignored(OSError):
+                os.unlink(path)
+            del self.files[path]
+            self.bytes -= size
+            log.debug('Removed %s from the transcode cache' % path)
+
+        metrics.TRANSCODE_CACHE_BYTES.set(self.bytes)
+
+
+# Caches by directory and quota, so they follow changes in the settings.
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the cache in the TRANSCODE_CACHE_DIR setting, or None if there's
+    none.
+    """
+
+    root = app.config.get('TRANSCODE_CACHE_DIR')
+    if not root:
+        return None
+
+    key = (root, app.config.get('TRANSCODE_CACHE_SIZE'))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = TranscodeCache(*key)
+
+        return _caches[key]
+
+
+metrics.watch_cache('transcodes',
+                    lambda: get_cache() if has_app_context() else None)
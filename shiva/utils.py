@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 from contextlib import contextmanager
 import datetime
 import logging
 import logging.config
 import os
+import Queue
 import random
 import re
 import string
+import threading
+import time
 import traceback
 
 from flask.ext.restful.utils import unpack as _unpack
@@ -44,13 +48,107 @@ def get_shiva_path():
     return os.path.dirname(os.path.abspath(shiva.__file__))
 
 
+_logging_lock = threading.Lock()
+_logging_configured = False
+
+
+def configure_logging():
+    """
+    Reads Shiva's logging.conf. Only the first call does anything, so it's
+    safe to call it from anywhere.
+    """
+
+    global _logging_configured
+
+    if _logging_configured:
+        return None
+
+    with _logging_lock:
+        if not _logging_configured:
+            logging_conf = os.path.join(get_shiva_path(), 'logging.conf')
+            logging.config.fileConfig(logging_conf,
+                                      disable_existing_loggers=False)
+            _logging_configured = True
+
+
 def get_logger():
-    logging_conf = os.path.join(get_shiva_path(), 'logging.conf')
-    logging.config.fileConfig(logging_conf)
+    configure_logging()
 
     return logging.getLogger('shiva')
 
 
+class QueueHandler(logging.Handler):
+    """
+    Hands the records over to a background thread, which passes them on to
+    `handlers`. Whoever logs never waits for the output to be written. A
+    simpler version of Python 3's QueueHandler and QueueListener.
+    """
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+
+        self.handlers = handlers
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.listen,
+                                       name='shiva-logging')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        # Formatted now, as the arguments may change before it's written.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Only the traceback, the handlers add the message.
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def listen(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        """Writes whatever is left in the queue and stops the thread."""
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        logging.Handler.close(self)
+
+
+def queue_logging(logger=None):
+    """
+    Moves the handlers of `logger`, Shiva's logger by default, behind a
+    `QueueHandler`.
+    """
+
+    logger = logger or get_logger()
+    if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        return None
+
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    logger.addHandler(QueueHandler(handlers))
+
+
 def randstr(length=32):
     """
     Generates a random string of the given length. Defaults to 32 characters.
@@ -88,12 +186,91 @@ def ignored(*exceptions, **kwargs):
     """Context manager that ignores all of the specified exceptions. This will
     be in the standard library starting with Python 3.4."""
 
-    log = get_logger()
     try:
         yield
     except exceptions:
         if kwargs.get('print_traceback'):
-            log.debug(traceback.format_exc())
+            log = get_logger()
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(traceback.format_exc())
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache holding up to `size` items. When full, the least
+    recently used item is dropped to make room for new ones. If a `ttl` is
+    given, items also expire that many seconds after being set.
+    """
+
+    def __init__(self, size, ttl=None, timer=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        """Unlike `get()`, neither counted nor taken as a use of the item."""
+
+        with self.lock:
+            expires, value = self.items.get(key, (None, self))
+            if expires is not None and expires <= self.timer():
+                return False
+
+            return value is not self
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self.timer():
+                self.misses += 1
+                return default
+
+            # Moves it to the end, the most recently used.
+            self.items[key] = (expires, value)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        expires = self.timer() + self.ttl if self.ttl else None
+
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, value)
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            expires, value = self.items.pop(key, (None, default))
+            if expires is not None and expires <= self.timer():
+                return default
+
+            return value
+
+    def discard(self, predicate):
+        """Removes the items whose value satisfies `predicate`."""
+
+        with self.lock:
+            for key, (expires, value) in self.items.items():
+                if predicate(value):
+                    del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
 
 
 class MetadataManager(object):
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
 import tempfile
+import time
 import unittest
 
+from mock import patch
 from nose import tools as nose
 from flask import json
+from sqlalchemy import event
 
-from shiva import app as shiva
+from shiva import admin, app as shiva
+from shiva.auth.cache import increment_users_version, token_cache
 from shiva.models import Artist, Album, User
 
 
@@ -62,3 +66,91 @@ class AuthTestCase(unittest.TestCase):
         })
         rv = self.app.post('/users/login/', data=payload)
         nose.eq_(rv.status_code, 401)
+
+
+class TokenCacheTestCase(AuthTestCase):
+
+    def setUp(self):
+        super(TokenCacheTestCase, self).setUp()
+
+        rv = self.app.post('/users/login/', data=self.get_payload())
+        self.token = json.loads(rv.data)['token']
+        self.queries = []
+        # Only looked at again when the tests say so, however slow they run.
+        self.check_interval = patch('shiva.auth.cache.VERSION_CHECK_INTERVAL',
+                                    60)
+        self.check_interval.start()
+
+    def tearDown(self):
+        self.check_interval.stop()
+        token_cache.configure(1024, 60)
+
+        super(TokenCacheTestCase, self).tearDown()
+
+    def count(self, *args):
+        self.queries.append(args)
+
+    def get_me(self):
+        event.listen(shiva.db.engine, 'before_cursor_execute', self.count)
+        rv = self.app.get('/users/me/?token=%s' % self.token)
+        event.remove(shiva.db.engine, 'before_cursor_execute', self.count)
+
+        return rv
+
+    def test_token_is_cached(self):
+        nose.eq_(self.get_me().status_code, 200)
+        queries = len(self.queries)
+
+        nose.eq_(self.get_me().status_code, 200)
+        nose.eq_(len(self.queries), queries)
+
+    def test_cache_disabled(self):
+        token_cache.configure(1024, 0)
+
+        self.get_me()
+        self.get_me()
+        nose.eq_(len(self.queries), 2)
+
+    def test_invalidation(self):
+        self.get_me()
+        queries = len(self.queries)
+        admin.deactivate_user(self.user.email)
+        self.get_me()
+
+        nose.eq_(len(self.queries), queries + 1)
+
+    def test_deleted_user(self):
+        self.get_me()
+        admin.delete_user('derp@mail.com')
+
+        nose.eq_(self.get_me().status_code, 401)
+
+    def test_changes_made_by_other_processes(self):
+        nose.eq_(self.get_me().status_code, 200)
+
+        # Deleted by another process, which can't reach this cache.
+        User.query.filter_by(email='derp@mail.com').delete()
+        increment_users_version()
+
+        later = time.time() + 60
+        with patch('time.time', return_value=later):
+            nose.eq_(self.get_me().status_code, 401)
+
+    def test_version_is_checked_once_in_a_while(self):
+        self.get_me()
+        self.queries = []
+
+        self.get_me()
+        nose.eq_(self.queries, [])
+
+        later = time.time() + 60
+        with patch('time.time', return_value=later):
+            self.get_me()
+        nose.eq_(len(self.queries), 1)
+
+    def test_expired_tokens_are_rejected(self):
+        nose.eq_(self.get_me().status_code, 200)
+
+        later = time.time() + shiva.app.config['AUTH_EXPIRATION_TIME'] + 1
+        with patch('time.time', return_value=later):
+            nose.eq_(self.get_me().status_code, 401)
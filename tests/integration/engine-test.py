@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+from sqlalchemy import create_engine
+import os
+import tempfile
+import unittest
+
+from shiva import app as shiva, engine
+
+
+class SQLitePragmasTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pragmas = engine.get_sqlite_pragmas()
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        self.engines = []
+
+    def tearDown(self):
+        engine.set_sqlite_pragmas(dict(self.pragmas))
+        for _engine in self.engines:
+            _engine.dispose()
+
+        os.close(self.db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.unlink(self.db_path + suffix)
+
+    def get_engine(self):
+        _engine = create_engine('sqlite:///%s' % self.db_path)
+        self.engines.append(_engine)
+
+        return _engine
+
+    def test_pragmas_are_applied(self):
+        engine.set_sqlite_pragmas({'journal_mode': 'WAL',
+                                   'synchronous': 'NORMAL',
+                                   'cache_size': -1024})
+        connection = self.get_engine().connect()
+
+        nose.eq_(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+        nose.eq_(connection.execute('PRAGMA synchronous').scalar(), 1)
+        nose.eq_(connection.execute('PRAGMA cache_size').scalar(), -1024)
+
+    def test_default_pragmas(self):
+        nose.eq_(dict(self.pragmas),
+                 shiva.app.config['SQLITE_PRAGMAS'])
+
+    def test_invalid_pragmas(self):
+        for pragmas in ({'journal_mode; DROP TABLE tracks': 'WAL'},
+                        {'journal_mode': 'WAL; DROP TABLE tracks'}):
+            with nose.assert_raises(ValueError):
+                engine.set_sqlite_pragmas(pragmas)
+
+    def test_readers_do_not_wait_for_writers(self):
+        engine.set_sqlite_pragmas({'journal_mode': 'WAL', 'busy_timeout': 0})
+        writer = self.get_engine().connect()
+        writer.execute('CREATE TABLE tracks (title VARCHAR)')
+        writer.execute("INSERT INTO tracks VALUES ('Falling down')")
+
+        transaction = writer.begin()
+        writer.execute('BEGIN EXCLUSIVE')
+        writer.execute("INSERT INTO tracks VALUES ('Eterna')")
+
+        reader = self.get_engine().connect()
+        nose.eq_(reader.execute('SELECT COUNT(*) FROM tracks').scalar(), 1)
+
+        transaction.rollback()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from nose import tools as nose
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from urlparse import urlparse
+
+from shiva import app as shiva  # noqa
+from shiva import jobs, metrics
+from shiva.converter import Converter
+from shiva.exceptions import ConversionError
+from shiva.media import MediaDir
+from shiva.models import ConversionJob, Track
+from tests.integration.resource import ResourceTestCase
+
+# Stands for ffmpeg: copies the input to the output, and logs every call. If
+# told to, it waits for a `release` file after writing the first 4 bytes.
+ENCODER = """#!%(python)s
+import os, sys, time
+root = %(root)r
+with open(os.path.join(root, 'calls'), 'a') as f:
+    f.write('call\\n')
+with open(sys.argv[2], 'rb') as f:
+    data = f.read()
+output = sys.stdout if sys.argv[-1] == 'pipe:1' else open(sys.argv[-1], 'wb')
+output.write(data[:4])
+output.flush()
+if os.path.exists(os.path.join(root, 'wait')):
+    while not os.path.exists(os.path.join(root, 'release')):
+        time.sleep(0.01)
+sys.exit(%(status)s) if %(status)s else None
+output.write(data[4:])
+"""
+
+
+class JobsTestCase(ResourceTestCase):
+
+    def setUp(self):
+        super(JobsTestCase, self).setUp()
+
+        self.root = tempfile.mkdtemp()
+        self.track_path = os.path.join(self.root, 'track.flac')
+        with open(self.track_path, 'wb') as f:
+            f.write('fLaC and then some audio')
+
+        track = Track.query.get(self.track_pk)
+        track.path = unicode(self.track_path)
+        self._db.session.commit()
+
+        self.set_encoder()
+        self.config = dict(self._app.config)
+        self._app.config['CONVERTER_CLASS'] = Converter
+        self._app.config['MEDIA_DIRS'] = [
+            MediaDir(self.root, url='http://127.0.0.1:8001')]
+        self.url = '/tracks/%s/convert/?mimetype=audio/ogg' % self.track_pk
+        self.ogg_path = os.path.join(self.root, 'ogg', 'track.ogg')
+
+    def tearDown(self):
+        self.release_encoder()
+        jobs.job_queue.stop()
+        self._app.config.clear()
+        self._app.config.update(self.config)
+        shutil.rmtree(self.root)
+
+        super(JobsTestCase, self).tearDown()
+
+    def set_encoder(self, status=0):
+        path = os.path.join(self.root, 'ffmpeg')
+        with open(path, 'w') as f:
+            f.write(ENCODER % {'python': sys.executable, 'root': self.root,
+                               'status': status})
+        os.chmod(path, stat.S_IRWXU)
+        self._app.config['FFMPEG_PATH'] = path
+
+    def hold_encoder(self):
+        open(os.path.join(self.root, 'wait'), 'w').close()
+
+    def release_encoder(self):
+        open(os.path.join(self.root, 'release'), 'w').close()
+
+    def get_calls(self):
+        with open(os.path.join(self.root, 'calls')) as f:
+            return len(f.readlines())
+
+    def test_conversion(self):
+        resp = self.get(self.url)
+
+        nose.eq_(resp.status_code, 202)
+        nose.eq_(urlparse(resp.headers['Location']).path,
+                 '/tracks/%s/convert/' % self.track_pk)
+        nose.eq_(resp.headers['Retry-After'], '2')
+        nose.ok_(resp.json['status'] in ('pending', 'running'))
+
+        jobs.job_queue.join()
+        resp = self.get(self.url)
+        nose.eq_(resp.status_code, 301)
+        nose.eq_(resp.headers['Location'],
+                 'http://127.0.0.1:8001/ogg/track.ogg')
+
+        with open(self.ogg_path) as f:
+            nose.eq_(f.read(), 'fLaC and then some audio')
+        nose.ok_(not os.path.exists(self.ogg_path + '.part'))
+
+    def test_concurrent_requests_share_the_job(self):
+        self.hold_encoder()
+
+        ids = set(self.get(self.url).json['id'] for _ in xrange(3))
+        nose.eq_(len(ids), 1)
+        nose.eq_(ConversionJob.query.count(), 1)
+
+        self.release_encoder()
+        jobs.job_queue.join()
+        nose.eq_(self.get_calls(), 1)
+
+    def test_queue_depth(self):
+        self.hold_encoder()
+        depth = metrics.CONVERSION_QUEUE.get()
+
+        self.get(self.url)
+        nose.eq_(metrics.CONVERSION_QUEUE.get(), depth + 1)
+
+        self.release_encoder()
+        jobs.job_queue.join()
+        nose.eq_(metrics.CONVERSION_QUEUE.get(), depth)
+
+    def test_failure(self):
+        self.set_encoder(status=1)
+
+        self.get(self.url)
+        jobs.job_queue.join()
+
+        resp = self.get(self.url)
+        nose.eq_(resp.status_code, 500)
+
+        job = ConversionJob.query.one()
+        nose.eq_(job.status, ConversionJob.FAILED)
+        nose.ok_('exited with status 1' in job.error)
+        nose.ok_(not os.path.exists(self.ogg_path + '.part'))
+
+        # Not tried again until TRANSCODING_RETRY_DELAY seconds later.
+        nose.eq_(self.get_calls(), 1)
+
+    def test_failed_jobs_are_retried(self):
+        self.set_encoder(status=1)
+        self.get(self.url)
+        jobs.job_queue.join()
+
+        self.set_encoder()
+        self._app.config['TRANSCODING_RETRY_DELAY'] = 0
+        self._db.session.remove()
+        resp = self.get(self.url)
+        nose.eq_(resp.status_code, 202)
+
+        jobs.job_queue.join()
+        nose.eq_(self.get(self.url).status_code, 301)
+
+    def test_timeout(self):
+        self.hold_encoder()
+        self._app.config['TRANSCODING_TIMEOUT'] = 0.1
+
+        self.get(self.url)
+        jobs.job_queue.join()
+
+        job = ConversionJob.query.one()
+        nose.eq_(job.status, ConversionJob.FAILED)
+        nose.ok_('took more than' in job.error)
+
+    def test_unfinished_jobs_are_run_on_start(self):
+        self._db.session.add(ConversionJob(track_pk=self.track_pk,
+                                           mimetype='audio/ogg'))
+        self._db.session.commit()
+
+        jobs.job_queue.start(self._app)
+        jobs.job_queue.join()
+
+        nose.ok_(os.path.exists(self.ogg_path))
+
+    def test_abandoned_jobs_are_run_again(self):
+        # Abandoned after the pool of this process started.
+        jobs.job_queue.start(self._app)
+        started = datetime.utcnow() - timedelta(hours=2)
+        self._db.session.add(ConversionJob(
+            track_pk=self.track_pk, mimetype='audio/ogg',
+            status=ConversionJob.RUNNING, started=started))
+        self._db.session.commit()
+        self._db.session.remove()
+
+        resp = self.get(self.url)
+        nose.eq_(resp.status_code, 202)
+
+        jobs.job_queue.join()
+        nose.eq_(self.get(self.url).status_code, 301)
+        nose.eq_(self.get_calls(), 1)
+
+    def test_running_jobs_are_not_run_again(self):
+        self._db.session.add(ConversionJob(
+            track_pk=self.track_pk, mimetype='audio/ogg',
+            status=ConversionJob.RUNNING, started=datetime.utcnow()))
+        self._db.session.commit()
+        self._db.session.remove()
+
+        resp = self.get(self.url)
+        nose.eq_(resp.status_code, 202)
+        nose.eq_(resp.json['status'], 'running')
+
+        jobs.job_queue.join()
+        nose.ok_(not os.path.exists(os.path.join(self.root, 'calls')))
+
+    def test_jobs_running_for_the_timeout_are_not_abandoned(self):
+        jobs.job_queue.start(self._app)
+        # ffmpeg was just stopped, the job is about to record its failure.
+        started = datetime.utcnow() - timedelta(
+            seconds=self._app.config['TRANSCODING_TIMEOUT'] + 1)
+        self._db.session.add(ConversionJob(
+            track_pk=self.track_pk, mimetype='audio/ogg',
+            status=ConversionJob.RUNNING, started=started))
+        self._db.session.commit()
+        self._db.session.remove()
+
+        nose.eq_(self.get(self.url).json['status'], 'running')
+        jobs.job_queue.join()
+        nose.ok_(not os.path.exists(os.path.join(self.root, 'calls')))
+
+    def test_jobs_run_again_meanwhile_are_not_overwritten(self):
+        self.hold_encoder()
+        self.get(self.url)
+        while self.get(self.url).json['status'] != 'running':
+            time.sleep(0.01)
+
+        # Taken as abandoned, and started again by another process.
+        started = datetime.utcnow() + timedelta(hours=1)
+        ConversionJob.query.update({'started': started})
+        self._db.session.commit()
+
+        self.release_encoder()
+        jobs.job_queue.join()
+        self._db.session.remove()
+
+        job = ConversionJob.query.one()
+        nose.eq_(job.status, ConversionJob.RUNNING)
+        nose.eq_(job.started, started)
+        nose.eq_(job.finished, None)
+
+    def test_deleting_the_track_deletes_its_jobs(self):
+        self.hold_encoder()
+        self.get(self.url)
+
+        self._db.session.delete(Track.query.get(self.track_pk))
+        self._db.session.commit()
+
+        nose.eq_(ConversionJob.query.count(), 0)
+
+    def test_progressive_conversion(self):
+        self._app.config['TRANSCODING_PROGRESSIVE'] = True
+        self.hold_encoder()
+        url = '%s&token=%s' % (self.url, self.authenticate())
+
+        first = self.app.get(url)
+        nose.eq_(first.status_code, 200)
+        nose.eq_(first.mimetype, 'audio/ogg')
+        first_chunks = iter(first.response)
+        nose.eq_(next(first_chunks), 'fLaC')
+
+        # Later listeners get what was converted so far.
+        second = self.app.get(url)
+        second_chunks = iter(second.response)
+        nose.eq_(next(second_chunks), 'fLaC')
+
+        self.release_encoder()
+        nose.eq_(''.join(first_chunks), ' and then some audio')
+        nose.eq_(''.join(second_chunks), ' and then some audio')
+        first.close()
+        second.close()
+
+        jobs.job_queue.join()
+        nose.eq_(self.get_calls(), 1)
+        with open(self.ogg_path) as f:
+            nose.eq_(f.read(), 'fLaC and then some audio')
+        nose.eq_(self.get(self.url).status_code, 301)
+
+    def test_progressive_conversion_failure(self):
+        self._app.config['TRANSCODING_PROGRESSIVE'] = True
+        self.set_encoder(status=1)
+        self.hold_encoder()
+
+        resp = self.app.get('%s&token=%s' % (self.url, self.authenticate()))
+        chunks = iter(resp.response)
+        nose.eq_(next(chunks), 'fLaC')
+
+        self.release_encoder()
+        with nose.assert_raises(ConversionError):
+            ''.join(chunks)
+        resp.close()
+
+        jobs.job_queue.join()
+        nose.eq_(self.get(self.url).status_code, 500)
+
+    def test_progressive_conversion_ignores_stale_files(self):
+        self._app.config['TRANSCODING_PROGRESSIVE'] = True
+        # Left by a process that stopped while converting.
+        os.makedirs(os.path.dirname(self.ogg_path))
+        with open(self.ogg_path + '.part', 'wb') as f:
+            f.write('stale')
+        os.utime(self.ogg_path + '.part', (0, 0))
+        self.hold_encoder()
+        url = '%s&token=%s' % (self.url, self.authenticate())
+
+        resp = self.app.get(url)
+        chunks = iter(resp.response)
+        nose.eq_(next(chunks), 'fLaC')
+
+        self.release_encoder()
+        nose.eq_(''.join(chunks), ' and then some audio')
+        resp.close()
+        jobs.job_queue.join()
+
+    def test_cache(self):
+        cache_dir = os.path.join(self.root, 'cache')
+        self._app.config['TRANSCODE_CACHE_DIR'] = cache_dir
+        self._app.config['TRANSCODE_CACHE_SIZE'] = 1
+
+        self.get(self.url)
+        jobs.job_queue.join()
+        resp = self.get(self.url)
+
+        nose.eq_(resp.status_code, 301)
+        nose.ok_('/ogg/' in resp.headers['Location'])
+        nose.eq_(os.listdir(os.path.join(cache_dir, 'ogg')),
+                 [resp.headers['Location'].rsplit('/', 1)[1]])
+        nose.ok_(not os.path.exists(self.ogg_path))
+
+        # Always linked through the API, as it may be removed.
+        track = self.get('/tracks/%s/' % self.track_pk).json
+        nose.ok_('/convert' in track['files']['audio/ogg'])
+
+    def test_evicted_tracks_are_converted_again(self):
+        self._app.config['TRANSCODE_CACHE_DIR'] = os.path.join(self.root,
+                                                               'cache')
+        self.get(self.url)
+        jobs.job_queue.join()
+
+        track = Track.query.get(self.track_pk)
+        path = Converter(track, 'audio/ogg').get_dest_fullpath()
+        os.unlink(path)
+        self._db.session.remove()
+
+        nose.eq_(self.get(self.url).status_code, 202)
+        jobs.job_queue.join()
+        nose.ok_(os.path.exists(path))
+        nose.eq_(self.get_calls(), 2)
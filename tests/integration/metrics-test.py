@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from flask import g
+from nose import tools as nose
+from sqlalchemy.exc import OperationalError
+
+from shiva import metrics, profiling
+from tests.integration.resource import ResourceTestCase
+
+
+class MetricsTestCase(ResourceTestCase):
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+
+        self._app.config['METRICS_ENABLED'] = True
+        self._app.config['METRICS_ALLOWED_IPS'] = ('127.0.0.1', '::1')
+
+    def tearDown(self):
+        self._app.config['METRICS_ENABLED'] = False
+
+        super(MetricsTestCase, self).tearDown()
+
+    def get_metrics(self):
+        return self.app.get('/metrics',
+                            environ_base={'REMOTE_ADDR': '127.0.0.1'})
+
+    def test_requests_are_measured(self):
+        labels = {'endpoint': 'artists', 'method': 'GET'}
+        count = metrics.REQUEST_DURATION.get(**labels)
+        queries = metrics.DB_QUERIES.get()
+
+        self.get('/artists/')
+
+        nose.eq_(metrics.REQUEST_DURATION.get(**labels), count + 1)
+        nose.ok_(metrics.DB_QUERIES.get() > queries)
+
+    def test_metrics_endpoint(self):
+        self.get('/artists/')
+        resp = self.get_metrics()
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.headers['Content-Type'], metrics.CONTENT_TYPE)
+        nose.ok_('shiva_request_duration_seconds_bucket{endpoint="artists",'
+                 'method="GET",le="+Inf"}' in resp.data)
+        nose.ok_('shiva_cache_hits_total{cache="auth_tokens"}' in resp.data)
+
+    def test_allowed_ips(self):
+        self._app.config['METRICS_ALLOWED_IPS'] = ('10.0.0.1',)
+
+        nose.eq_(self.get_metrics().status_code, 403)
+
+    def test_disabled(self):
+        self._app.config['METRICS_ENABLED'] = False
+
+        nose.eq_(self.get_metrics().status_code, 404)
+
+    def test_streamed_responses_are_measured_until_sent(self):
+        labels = {'endpoint': 'artists', 'method': 'GET'}
+        self.authenticate()
+        count = metrics.REQUEST_DURATION.get(**labels)
+
+        resp = self.get('/artists/%s/?fulltree=1' % self.artist_pk)
+        nose.eq_(metrics.REQUEST_DURATION.get(**labels), count)
+
+        resp.close()
+        nose.eq_(metrics.REQUEST_DURATION.get(**labels), count + 1)
+
+    def test_failed_statements(self):
+        g.metrics_start = 0
+        conn = self._db.engine.connect()
+        try:
+            with nose.assert_raises(OperationalError):
+                conn.execute('SELECT * FROM nowhere')
+
+            nose.eq_(conn.info['query_start'], [])
+        finally:
+            conn.close()
+            g.metrics_start = None
+
+    def test_statements_are_timed_once(self):
+        g.metrics_start = 0
+        g.profile = profiling.RequestProfile()
+        seconds = metrics.DB_QUERY_SECONDS.get()
+        try:
+            self._db.engine.execute('SELECT 1')
+
+            nose.eq_(len(g.profile.queries), 1)
+            nose.assert_almost_equal(
+                metrics.DB_QUERY_SECONDS.get() - seconds, g.profile.db_time)
+        finally:
+            g.metrics_start = None
+            g.profile = None
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+from sqlalchemy import create_engine, inspect
+import os
+import tempfile
+import unittest
+
+from shiva import app as shiva, dbtypes, migrations
+from shiva.models import Artist, Track, track_artist
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        db_uri = 'sqlite:///%s' % self.db_path
+        shiva.app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+        shiva.app.config['TESTING'] = True
+
+        self.ctx = shiva.app.test_request_context()
+        self.ctx.push()
+
+        shiva.db.create_all()
+        self.connection = shiva.db.session.connection()
+
+    def tearDown(self):
+        shiva.db.session.remove()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+
+class MigrationsTestCase(DatabaseTestCase):
+
+    def get_indexes(self, table):
+        return set(index['name'] for index
+                   in inspect(self.connection).get_indexes(table.name))
+
+    def make_old(self):
+        """Turns the database into one created before the migrations."""
+
+        for table in (Track.__table__, track_artist):
+            for index in table.indexes:
+                index.drop(bind=self.connection)
+
+        migrations.schema_version.drop(bind=self.connection)
+        shiva.db.session.commit()
+        self.connection = shiva.db.session.connection()
+
+    def test_new_database_is_up_to_date(self):
+        nose.eq_(migrations.get_version(self.connection),
+                 migrations.get_latest_version())
+        nose.eq_(migrations.get_pending(self.connection), [])
+        nose.ok_('ix_tracks_slug' in self.get_indexes(Track.__table__))
+
+    def test_upgrade(self):
+        self.make_old()
+        nose.eq_(migrations.get_version(self.connection), 0)
+        nose.eq_(self.get_indexes(track_artist), set())
+
+        nose.eq_(migrations.upgrade(), len(migrations.MIGRATIONS))
+        self.connection = shiva.db.session.connection()
+
+        nose.eq_(migrations.get_version(self.connection),
+                 migrations.get_latest_version())
+        nose.ok_('ix_tracks_hash' in self.get_indexes(Track.__table__))
+        nose.ok_('ix_trackartist_artist_pk_track_pk' in
+                 self.get_indexes(track_artist))
+
+        nose.eq_(migrations.upgrade(), 0)
+
+    def test_create_all_on_old_database(self):
+        self.make_old()
+        shiva.db.create_all()
+
+        connection = shiva.db.session.connection()
+        nose.eq_(migrations.get_version(connection), 0)
+
+    def test_newer_database(self):
+        migrations.set_version(self.connection, 999)
+
+        with nose.assert_raises(migrations.DowngradeError):
+            migrations.get_pending(self.connection)
+
+
+class GUIDConversionTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(GUIDConversionTestCase, self).setUp()
+
+        self.track = Track(title='Falling down', path='/music/01.mp3',
+                           hash_file=False, no_metadata=True)
+        self.track.artists.append(Artist(name='4no1'))
+        shiva.db.session.add(self.track)
+        shiva.db.session.commit()
+        self.track_pk = self.track.pk
+
+    def tearDown(self):
+        dbtypes.GUID.binary = False
+
+        super(GUIDConversionTestCase, self).tearDown()
+
+    def get_artist_pks(self):
+        """Reads the artists of the track with a new engine."""
+
+        engine = create_engine(shiva.app.config['SQLALCHEMY_DATABASE_URI'])
+        query = track_artist.select().where(
+            track_artist.c.track_pk == self.track_pk)
+
+        return [row.artist_pk for row in engine.execute(query)]
+
+    def test_convert(self):
+        connection = shiva.db.session.connection()
+        nose.eq_(migrations.get_guid_storage(connection), 'hex')
+        nose.ok_(migrations.is_guid_storage_consistent(connection))
+
+        artist_pks = self.get_artist_pks()
+        nose.ok_(migrations.convert_guids(binary=True))
+
+        connection = shiva.db.session.connection()
+        nose.eq_(migrations.get_guid_storage(connection), 'binary')
+        nose.ok_(not migrations.is_guid_storage_consistent(connection))
+
+        dbtypes.GUID.binary = True
+        nose.eq_(self.get_artist_pks(), artist_pks)
+
+        migrations.convert_guids(binary=False)
+        dbtypes.GUID.binary = False
+        nose.eq_(self.get_artist_pks(), artist_pks)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from nose import tools as nose
+import re
+
+from flask import g
+from sqlalchemy.exc import OperationalError
+
+from shiva import profiling
+from tests.integration.resource import ResourceTestCase
+
+SERVER_TIMING_RE = re.compile(r'^db;dur=[\d.]+;desc="(\d+) queries", '
+                              r'marshal;dur=[\d.]+, total;dur=[\d.]+$')
+
+
+class ProfilingTestCase(ResourceTestCase):
+
+    def setUp(self):
+        super(ProfilingTestCase, self).setUp()
+
+        self._app.config['PROFILE_REQUESTS'] = True
+        self._app.config['SLOW_REQUEST_MS'] = 500
+        self._app.config['SLOW_REQUEST_QUERIES'] = 50
+        self.authenticate()
+
+    def tearDown(self):
+        self._app.config['PROFILE_REQUESTS'] = False
+
+        super(ProfilingTestCase, self).tearDown()
+
+    def test_server_timing(self):
+        resp = self.get('/artists/%s/' % self.artist_pk)
+        match = SERVER_TIMING_RE.match(resp.headers['Server-Timing'])
+
+        nose.ok_(match)
+        nose.ok_(int(match.group(1)) > 0)
+
+    def test_disabled(self):
+        self._app.config['PROFILE_REQUESTS'] = False
+        resp = self.get('/artists/%s/' % self.artist_pk)
+
+        nose.ok_('Server-Timing' not in resp.headers)
+
+    def test_slow_requests_are_logged(self):
+        with patch.object(profiling.log, 'warning') as warning:
+            self.get('/artists/')
+            nose.eq_(warning.call_count, 0)
+
+            self._app.config['SLOW_REQUEST_QUERIES'] = 1
+            self.get('/artists/')
+
+        nose.eq_(warning.call_count, 1)
+        message = warning.call_args[0][0]
+        nose.ok_(message.startswith('Slow request: GET /artists/?token='))
+        nose.ok_('SELECT' in message)
+
+    def test_streamed_responses(self):
+        self._app.config['STREAM_RESPONSES'] = True
+        self._app.config['SLOW_REQUEST_QUERIES'] = 1
+        with patch.object(profiling.log, 'warning') as warning:
+            resp = self.get('/artists/%s/?fulltree=1' % self.artist_pk)
+            nose.eq_(warning.call_count, 0)
+            resp.close()
+
+        nose.ok_('Server-Timing' not in resp.headers)
+        nose.eq_(warning.call_count, 1)
+        nose.ok_('%d bytes' % len(resp.data) in warning.call_args[0][0])
+
+    def test_failed_statements(self):
+        g.profile = profiling.RequestProfile()
+        conn = self._db.engine.connect()
+        try:
+            with nose.assert_raises(OperationalError):
+                conn.execute('SELECT * FROM nowhere')
+
+            nose.eq_(conn.info['query_start'], [])
+        finally:
+            conn.close()
+            g.profile = None
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from nose import tools as nose
 
+from shiva import app as shiva  # noqa
+from shiva.models import Artist
 from tests.integration.resource import ResourceTestCase
 
 
@@ -74,6 +76,49 @@ class AlbumResourceTestCase(ResourceTestCase):
         resp = self.get('/albums/%s/?fulltree=1' % self.album_pk)
         nose.eq_(resp.status_code, 200)
 
+    def test_fulltree_with_fields(self):
+        resp = self.get('/albums/%s/?fulltree=1&fields=id' % self.album_pk)
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/albums/%s/?fulltree=1&embed=tracks' % self.album_pk)
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/albums/%s/?fulltree=0&fields=id' % self.album_pk)
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.json.keys(), ['id'])
+
+    def test_fulltree_content(self):
+        track = self.mk_track()
+        track.ordinal = 1
+        track.albums.append(self.album)
+        self.track.ordinal = 2
+        self._db.session.commit()
+
+        resp = self.get('/albums/%s/?fulltree=1' % self.album_pk)
+        album = resp.json
+
+        nose.eq_(album['artists'][0]['id'], str(self.artist_pk))
+        nose.eq_([t['id'] for t in album['tracks']],
+                 [str(track.pk), str(self.track_pk)])
+        nose.eq_(album['tracks'][0]['artists'], [])
+        nose.eq_(album['tracks'][1]['artists'][0]['name'], self.artist.name)
+        nose.eq_(album['tracks'][1]['albums'][0]['artists'][0]['id'],
+                 str(self.artist_pk))
+
+    def test_artists_are_sorted(self):
+        for name in ('Zeta', 'Alpha'):
+            track = self.mk_track()
+            track.artists.append(Artist(name=name))
+            track.albums.append(self.album)
+        self._db.session.commit()
+
+        resp = self.get('/albums/%s/' % self.album_pk)
+        expected = [str(artist.pk) for artist in
+                    sorted(self.album.artists, key=lambda a: a.name)]
+
+        nose.eq_([artist['id'] for artist in resp.json['artists']], expected)
+        nose.eq_(len(expected), 3)
+
     def test_album_creation(self):
         resp = self.post('/albums/', data=self.get_payload())
         nose.eq_(resp.status_code, 201)
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+from mock import patch
 from nose import tools as nose
+from sqlalchemy import event
 
+from shiva import app as shiva, dbtypes, migrations
+from shiva.models import Album
 from tests.integration.resource import ResourceTestCase
 
 
@@ -80,6 +84,74 @@ class ArtistResourceTestCase(ResourceTestCase):
         nose.eq_(resp.status_code, 200)
         nose.ok_(resp.json.has_key('albums'))
 
+        album = resp.json['albums'][0]
+        nose.eq_(album['id'], str(self.album.pk))
+        nose.eq_(album['tracks'][0]['id'], str(self.track.pk))
+
+    def test_artist_fulltree_queries(self):
+        """
+        Neither the number of queries nor their parameters depend on the size
+        of the tree.
+        """
+
+        def count_queries():
+            queries = []
+
+            def count(conn, cursor, statement, parameters, *args):
+                queries.append(len(parameters))
+
+            self.authenticate()
+            event.listen(self._db.engine, 'before_cursor_execute', count)
+            resp = self.get('/artists/%s/?fulltree=1' % self.artist_pk)
+            event.remove(self._db.engine, 'before_cursor_execute', count)
+            nose.eq_(resp.status_code, 200)
+
+            return len(queries), max(queries)
+
+        # The token is verified once, cached from then on, and the version of
+        # the users isn't looked at again meanwhile.
+        with patch('shiva.auth.cache.VERSION_CHECK_INTERVAL', 3600):
+            self.get('/artists/')
+            expected = count_queries()
+
+            for index in range(5):
+                album = Album(name='Album %s' % index)
+                for _ in range(3):
+                    track = self.mk_track()
+                    track.artists.append(self.artist)
+                    track.albums.append(album)
+                self.mk_track().artists.append(self.artist)
+            self._db.session.commit()
+
+            nose.eq_(count_queries(), expected)
+
+    def test_albums_are_sorted(self):
+        for name, year in (('Later', 2001), ('Earlier', 1999)):
+            track = self.mk_track()
+            track.artists.append(self.artist)
+            track.albums.append(Album(name=name, year=year))
+        self._db.session.commit()
+
+        resp = self.get('/artists/%s/?fulltree=1' % self.artist_pk)
+        names = [album['name'] for album in resp.json['albums']]
+
+        nose.ok_(names.index('Earlier') < names.index('Later'))
+
+    def test_artist_fulltree_not_streamed(self):
+        self._app.config['STREAM_RESPONSES'] = False
+        resp = self.get('/artists/%s/?fulltree=1' % self.artist.pk)
+        self._app.config['STREAM_RESPONSES'] = True
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.json['albums'][0]['id'], str(self.album.pk))
+
+    def test_artist_streamed_list(self):
+        resp = self.get('/artists/?page_size=100')
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.json['item_count'], 1)
+        nose.eq_(resp.json['items'][0]['id'], str(self.artist.pk))
+
     def test_artist_creation(self):
         resp = self.post('/artists/', data=self.get_payload())
         nose.eq_(resp.status_code, 201)
@@ -124,3 +196,21 @@ class ArtistResourceTestCase(ResourceTestCase):
 
         resp = self.delete(artist_url)
         nose.eq_(resp.status_code, 404)
+
+
+class BinaryGUIDArtistResourceTestCase(ArtistResourceTestCase):
+    """Same tests, storing keys as raw bytes."""
+
+    def setUp(self):
+        dbtypes.GUID.binary = True
+
+        super(BinaryGUIDArtistResourceTestCase, self).setUp()
+
+    def tearDown(self):
+        dbtypes.GUID.binary = False
+
+        super(BinaryGUIDArtistResourceTestCase, self).tearDown()
+
+    def test_storage(self):
+        connection = self._db.session.connection()
+        nose.eq_(migrations.get_guid_storage(connection), 'binary')
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+
+from shiva import app as shiva, search
+from shiva.models import Album, LyricsCache
+from tests.integration.resource import ResourceTestCase
+
+
+class SearchResourceTestCase(ResourceTestCase):
+    """
+    GET /search/ q=<str> [type=<str>] [limit=<int>]
+        200 OK
+        400 Bad Request
+        401 Unauthorized
+    """
+
+    def ids(self, resp, name):
+        nose.eq_(resp.status_code, 200)
+
+        return [item['id'] for item in resp.json[name]]
+
+    def test_unauthorized_access(self):
+        resp = self.get('/search/?q=falling', authenticate=False)
+        nose.eq_(resp.status_code, 401)
+
+    def test_search(self):
+        resp = self.get('/search/?q=fall')
+
+        nose.eq_(self.ids(resp, 'artists'), [])
+        nose.eq_(self.ids(resp, 'albums'), [str(self.album_pk)])
+        nose.eq_(self.ids(resp, 'tracks'), [str(self.track_pk)])
+        nose.eq_(resp.json['tracks'][0]['artists'][0]['id'],
+                 str(self.artist_pk))
+
+    def test_search_all_terms(self):
+        resp = self.get('/search/?q=falling%20up')
+        nose.eq_(self.ids(resp, 'albums'), [])
+
+        resp = self.get('/search/?q=DOWN%20falling')
+        nose.eq_(self.ids(resp, 'albums'), [str(self.album_pk)])
+
+    def test_search_type(self):
+        resp = self.get('/search/?q=4no1&type=artists')
+
+        nose.eq_(resp.json.keys(), ['artists'])
+        nose.eq_(self.ids(resp, 'artists'), [str(self.artist_pk)])
+
+    def test_search_limit(self):
+        for index in range(3):
+            self._db.session.add(Album(name='Falling %s' % index))
+        self._db.session.commit()
+
+        resp = self.get('/search/?q=falling&type=albums&limit=2')
+        nose.eq_(len(self.ids(resp, 'albums')), 2)
+
+    def test_search_lyrics(self):
+        self._db.session.add(LyricsCache(track_pk=self.track_pk,
+                                         text='Make up your mind'))
+        self._db.session.commit()
+
+        resp = self.get('/search/?q=mind&type=tracks')
+        nose.eq_(self.ids(resp, 'tracks'), [str(self.track_pk)])
+
+    def test_search_updates(self):
+        self.artist.name = 'Eterna'
+        self._db.session.commit()
+
+        resp = self.get('/search/?q=4no1&type=artists')
+        nose.eq_(self.ids(resp, 'artists'), [])
+
+        resp = self.get('/search/?q=etern&type=artists')
+        nose.eq_(self.ids(resp, 'artists'), [str(self.artist_pk)])
+
+        self._db.session.delete(self.artist)
+        self._db.session.commit()
+
+        resp = self.get('/search/?q=eterna&type=artists')
+        nose.eq_(self.ids(resp, 'artists'), [])
+
+    def test_search_rebuild(self):
+        with search.suspended():
+            self._db.session.add(Album(name='Pirexia'))
+            self._db.session.commit()
+
+        resp = self.get('/search/?q=pirexia&type=albums')
+        nose.eq_(self.ids(resp, 'albums'), [])
+
+        search.rebuild()
+
+        resp = self.get('/search/?q=pirexia&type=albums')
+        nose.eq_(len(self.ids(resp, 'albums')), 1)
+
+    def test_search_errors(self):
+        resp = self.get('/search/')
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/search/?q=%20*%22')
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/search/?q=falling&type=lyrics')
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/search/?q=falling&limit=all')
+        nose.eq_(resp.status_code, 400)
+
+
+class LikeSearchResourceTestCase(SearchResourceTestCase):
+    """Same tests, for databases without a full-text search engine."""
+
+    def setUp(self):
+        self.backends = search.BACKENDS
+        search.BACKENDS = {}
+
+        super(LikeSearchResourceTestCase, self).setUp()
+
+    def tearDown(self):
+        search.BACKENDS = self.backends
+
+        super(LikeSearchResourceTestCase, self).tearDown()
+
+    def test_backend(self):
+        connection = self._db.session.connection()
+        nose.ok_(isinstance(search.get_backend(connection),
+                            search.LikeBackend))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+
+from tests.integration.resource import ResourceTestCase
+
+
+class SuggestResourceTestCase(ResourceTestCase):
+    """
+    GET /suggest/ q=<str> [type=<str>] [limit=<int>]
+        200 OK
+        400 Bad Request
+        401 Unauthorized
+        404 Not Found
+    """
+
+    def names(self, query):
+        resp = self.get('/suggest/?q=%s' % query)
+        nose.eq_(resp.status_code, 200)
+
+        return [item['name'] for item in resp.json]
+
+    def test_unauthorized_access(self):
+        resp = self.get('/suggest/?q=fall', authenticate=False)
+        nose.eq_(resp.status_code, 401)
+
+    def test_suggest(self):
+        resp = self.get('/suggest/?q=4no&type=artists,albums')
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.json, [{
+            'id': str(self.artist_pk),
+            'type': 'artists',
+            'name': '4no1',
+            'uri': '/artists/%s' % self.artist_pk,
+        }])
+
+        nose.eq_(len(self.names('fallin')), 2)
+        nose.eq_(len(self.names('fallnig')), 2)
+
+    def test_suggest_updates(self):
+        nose.eq_(self.names('eterna'), [])
+
+        self.artist.name = 'Eterna'
+        self._db.session.commit()
+
+        nose.eq_(self.names('eterna'), ['Eterna'])
+        nose.eq_(self.names('4no1'), [])
+
+        self.artist.name = 'Pirexia'
+        self._db.session.flush()
+        self._db.session.rollback()
+
+        nose.eq_(self.names('pirexia'), [])
+
+        self._db.session.delete(self.track)
+        self._db.session.commit()
+
+        nose.eq_(self.names('falling'), ['Falling down'])
+
+    def test_suggest_errors(self):
+        resp = self.get('/suggest/')
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/suggest/?q=fall&type=users')
+        nose.eq_(resp.status_code, 400)
+
+        self._app.config['SUGGEST_ENABLED'] = False
+        resp = self.get('/suggest/?q=fall')
+        self._app.config['SUGGEST_ENABLED'] = True
+        nose.eq_(resp.status_code, 404)
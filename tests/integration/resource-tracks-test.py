@@ -8,8 +8,9 @@ from tests.integration.resource import ResourceTestCase
 
 class TrackResourceTestCase(ResourceTestCase):
     """
-    GET /tracks/ [album=<id>] [artist=<id>]
+    GET /tracks/ [album=<id>] [artist=<id>] [ids=<str>]
         200 OK
+        400 Bad Request
         401 Unauthorized
     POST /tracks/ track=<file> [title=<str>] [ordinal=<int>] [artist=<int>]
                  [album=<int>]
@@ -17,7 +18,8 @@ class TrackResourceTestCase(ResourceTestCase):
         400 Bad Request
         401 Unauthorized
         409 Conflict
-    GET /tracks/<id>/ [artist=<int>] [album=<int>]
+    GET /tracks/<id>/ [artist=<int>] [album=<int>] [fields=<str>]
+                      [embed=<str>]
         200 OK
         401 Unauthorized
         404 Not Found
@@ -77,6 +79,58 @@ class TrackResourceTestCase(ResourceTestCase):
         resp = self.get('/tracks/%s/' % self.track.pk)
         nose.eq_(resp.status_code, 200)
 
+    def test_track_sparse_fields(self):
+        resp = self.get('/tracks/%s/?fields=id,title' % self.track.pk)
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(sorted(resp.json.keys()), ['id', 'title'])
+
+        resp = self.get('/tracks/?fields=id,title,length')
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(sorted(resp.json['items'][0].keys()),
+                 ['id', 'length', 'title'])
+
+    def test_track_invalid_sparse_fields(self):
+        resp = self.get('/tracks/%s/?fields=id,lyrics' % self.track.pk)
+        nose.eq_(resp.status_code, 400)
+
+        resp = self.get('/tracks/?embed=playlists')
+        nose.eq_(resp.status_code, 400)
+
+    def test_track_embed(self):
+        resp = self.get('/tracks/%s/' % self.track.pk)
+        nose.ok_('name' not in resp.json['artists'][0])
+
+        resp = self.get('/tracks/%s/?embed=artists' % self.track.pk)
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.json['artists'][0]['name'], self.artist.name)
+        nose.ok_('name' not in resp.json['albums'][0])
+
+        resp = self.get('/tracks/?fields=id&embed=albums')
+        nose.eq_(sorted(resp.json['items'][0].keys()), ['albums', 'id'])
+        nose.eq_(resp.json['items'][0]['albums'][0]['name'], self.album.name)
+
+    def test_track_multiget(self):
+        track = self.mk_track()
+        missing = '00000000000000000000000000000000'
+        ids = (track.pk, missing, self.track.pk, 'bogus', track.pk)
+
+        resp = self.get('/tracks/?fields=id&ids=%s' % ','.join(map(str, ids)))
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.json['items'], [{'id': str(track.pk)},
+                                      {'id': str(self.track.pk)}])
+        nose.eq_(resp.json['missing'], [missing, 'bogus'])
+
+    def test_track_multiget_error(self):
+        resp = self.get('/tracks/?ids=,')
+        nose.eq_(resp.status_code, 400)
+
+        self._app.config['MAX_IDS_PER_REQUEST'] = 1
+        resp = self.get('/tracks/?ids=%s,%s' % (self.track.pk, self.track.pk))
+        self._app.config['MAX_IDS_PER_REQUEST'] = 500
+        nose.eq_(resp.status_code, 400)
+
     def test_nonexistent_track(self):
         resp = self.get('/tracks/123/')
         nose.eq_(resp.status_code, 404)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from shiva import app as shiva  # noqa
+from shiva.models import Artist
+from tests.integration.resource import ResourceTestCase
+
+
+class RoutingTestCase(ResourceTestCase):
+    """
+    Two SQLite files stand in for a primary database and its replica, which is
+    a copy of the primary taken when the test starts.
+    """
+
+    def setUp(self):
+        super(RoutingTestCase, self).setUp()
+
+        self._db.session.connection().execute(
+            'PRAGMA wal_checkpoint(TRUNCATE)')
+        self._db.session.commit()
+
+        self.replica_fd, self.replica_path = tempfile.mkstemp()
+        shutil.copyfile(self.db_path, self.replica_path)
+
+        self._app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///%s' % self.replica_path,
+        }
+        self._app.config['SQLALCHEMY_READ_BINDS'] = ('replica',)
+
+    def tearDown(self):
+        self._app.config['SQLALCHEMY_BINDS'] = None
+        self._app.config['SQLALCHEMY_READ_BINDS'] = ()
+
+        super(RoutingTestCase, self).tearDown()
+
+        os.close(self.replica_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.replica_path + suffix):
+                os.unlink(self.replica_path + suffix)
+
+    def rename_in_replica(self, name):
+        connection = sqlite3.connect(self.replica_path)
+        connection.execute('UPDATE artists SET name = ?', (name,))
+        connection.commit()
+        connection.close()
+
+    def get_name(self):
+        resp = self.get('/artists/%s/' % self.artist_pk)
+        nose.eq_(resp.status_code, 200)
+
+        return resp.json['name']
+
+    def test_reads_go_to_the_replica(self):
+        self.rename_in_replica('Eterna')
+
+        nose.eq_(self.get_name(), 'Eterna')
+
+    def test_writes_go_to_the_primary(self):
+        resp = self.put('/artists/%s/' % self.artist_pk,
+                        data={'name': 'Pirexia'})
+        nose.eq_(resp.status_code, 204)
+
+        # Not replicated yet.
+        nose.eq_(self.get_name(), '4no1')
+
+        # Sessions are removed at the end of every request, but not in tests.
+        self._db.session.remove()
+        self._app.config['SQLALCHEMY_READ_BINDS'] = ()
+        nose.eq_(self.get_name(), 'Pirexia')
+
+    def test_read_your_writes(self):
+        session = self._db.session()
+        session.use_replica()
+
+        session.add(Artist(name='Eterna'))
+        session.flush()
+
+        nose.eq_(session.read_bind, None)
+        nose.eq_(Artist.query.filter_by(name='Eterna').count(), 1)
+
+    def test_schema_is_not_created_on_replicas(self):
+        self._db.session.remove()
+        os.unlink(self.replica_path)
+
+        self._db.create_all()
+
+        connection = sqlite3.connect(self.replica_path)
+        query = 'SELECT name FROM sqlite_master'
+        nose.eq_(connection.execute(query).fetchall(), [])
+        connection.close()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from time import sleep, time
+import unittest
+
+from shiva import asyncfileserver, fileserver, metrics
+from shiva.media import MediaDir
+from shiva.utils import LRUCache
+
+
+class AsyncFileServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = ''.join(chr(i % 256) for i in xrange(300000))
+        with open(os.path.join(self.root, 'track.flac'), 'wb') as f:
+            f.write(self.data)
+
+        self.media_dirs = fileserver.app.config.get('MEDIA_DIRS')
+        fileserver.app.config['MEDIA_DIRS'] = [MediaDir(self.root)]
+        self.path_cache = fileserver.path_cache
+        fileserver.path_cache = LRUCache(16, ttl=60)
+
+        self.server = asyncfileserver.FileServer('127.0.0.1', 0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
+        fileserver.path_cache = self.path_cache
+        fileserver.app.config['MEDIA_DIRS'] = self.media_dirs
+        shutil.rmtree(self.root)
+
+    def get_connection(self):
+        return httplib.HTTPConnection('127.0.0.1', self.server.port,
+                                      timeout=5)
+
+    def get(self, path='/track.flac', range_header=None, method='GET',
+            connection=None):
+        connection = connection or self.get_connection()
+        headers = {'Range': range_header} if range_header else {}
+        connection.request(method, path, headers=headers)
+        resp = connection.getresponse()
+
+        return resp, resp.read()
+
+    def test_whole_file(self):
+        resp, body = self.get()
+
+        nose.eq_(resp.status, 200)
+        nose.eq_(resp.getheader('Content-Length'), '300000')
+        nose.eq_(body, self.data)
+
+    def test_range(self):
+        resp, body = self.get(range_header='bytes=1000-1999')
+
+        nose.eq_(resp.status, 206)
+        nose.eq_(resp.getheader('Content-Range'), 'bytes 1000-1999/300000')
+        nose.eq_(body, self.data[1000:2000])
+
+    def test_multiple_ranges(self):
+        resp, body = self.get(range_header='bytes=0-9,100-109')
+
+        nose.eq_(resp.status, 206)
+        nose.ok_(resp.getheader('Content-Type').startswith(
+            'multipart/byteranges'))
+        nose.ok_(self.data[0:10] in body)
+        nose.ok_(self.data[100:110] in body)
+
+    def test_head(self):
+        resp, body = self.get(method='HEAD')
+
+        nose.eq_(resp.status, 200)
+        nose.eq_(resp.getheader('Content-Length'), '300000')
+        nose.eq_(body, '')
+
+    def test_not_found(self):
+        resp, body = self.get('/missing.flac')
+
+        nose.eq_(resp.status, 404)
+
+    def test_keep_alive(self):
+        connection = self.get_connection()
+
+        resp, body = self.get(range_header='bytes=0-99',
+                              connection=connection)
+        nose.eq_(body, self.data[:100])
+        resp, body = self.get(range_header='bytes=100-199',
+                              connection=connection)
+        nose.eq_(body, self.data[100:200])
+
+    def test_pipelined_requests(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port), 5)
+        request = ('GET /track.flac HTTP/1.1\r\nHost: localhost\r\n'
+                   'Range: bytes=%s\r\n%s\r\n')
+        sock.sendall(request % ('0-4', '') +
+                     request % ('5-9', 'Connection: close\r\n'))
+
+        data = ''.join(iter(lambda: sock.recv(8192), ''))
+        sock.close()
+
+        responses = data.split('HTTP/1.1 ')[1:]
+        nose.eq_(len(responses), 2)
+        nose.ok_(responses[0].endswith('\r\n\r\n' + self.data[0:5]))
+        nose.ok_(responses[1].endswith('\r\n\r\n' + self.data[5:10]))
+
+    def test_bad_request(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port), 5)
+        sock.sendall('nonsense\r\n\r\n')
+
+        nose.ok_(sock.recv(1024).startswith('HTTP/1.1 400 '))
+        sock.close()
+
+    def test_streams_are_closed(self):
+        streams = metrics.FILESERVER_STREAMS.get()
+
+        for range_header in (None, 'bytes=10-19', 'bytes=299990-'):
+            connection = self.get_connection()
+            self.get(range_header=range_header, connection=connection)
+            connection.close()
+
+            # The response may be closed right after its last byte is read.
+            deadline = time() + 5
+            while metrics.FILESERVER_STREAMS.get() != streams and \
+                    time() < deadline:
+                sleep(0.01)
+            nose.eq_(metrics.FILESERVER_STREAMS.get(), streams)
+
+    def test_many_connections(self):
+        connections = [self.get_connection() for _ in xrange(50)]
+        for connection in connections:
+            connection.request('GET', '/track.flac')
+
+        for connection in connections:
+            nose.eq_(connection.getresponse().read(), self.data)
+
+    def test_sendfile(self):
+        calls = []
+
+        def sendfile(out_fd, in_fd, offset, count):
+            """Like pysendfile's, doesn't move the position of `in_fd`."""
+
+            calls.append((offset, count))
+            position = os.lseek(in_fd, 0, os.SEEK_CUR)
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            try:
+                return os.write(out_fd, os.read(in_fd, min(count, 65536)))
+            finally:
+                os.lseek(in_fd, position, os.SEEK_SET)
+
+        original = asyncfileserver.sendfile
+        asyncfileserver.sendfile = sendfile
+        try:
+            resp, body = self.get(range_header='bytes=1000-')
+        finally:
+            asyncfileserver.sendfile = original
+
+        nose.eq_(body, self.data[1000:])
+        nose.eq_(calls[0], (1000, 299000))
+
+    def test_throttled_stream(self):
+        fileserver.app.config['STREAM_RATE_LIMIT'] = 100000
+        try:
+            start = time()
+            resp, body = self.get(range_header='bytes=0-149999')
+            elapsed = time() - start
+        finally:
+            fileserver.app.config['STREAM_RATE_LIMIT'] = None
+
+        nose.eq_(body, self.data[:150000])
+        # A second worth of burst, and the rest at the rate of the stream.
+        nose.ok_(elapsed >= 0.4)
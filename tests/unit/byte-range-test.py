@@ -5,7 +5,7 @@ except ImportError:
     import unittest
 from nose import tools as nose
 
-from shiva.fileserver import get_range_bytes
+from shiva.fileserver import get_range_bytes, parse_range_header
 
 
 class ByteRangeTestCase(unittest.TestCase):
@@ -23,3 +23,33 @@ class ByteRangeTestCase(unittest.TestCase):
 
     def test_valid_range(self):
         nose.eq_(get_range_bytes('range=0-100'), (0, 100))
+
+
+class ParseRangeHeaderTestCase(unittest.TestCase):
+    def test_single_range(self):
+        nose.eq_(parse_range_header('bytes=0-99', 1000), [(0, 99)])
+        nose.eq_(parse_range_header('bytes=900-', 1000), [(900, 999)])
+        nose.eq_(parse_range_header('bytes=900-5000', 1000), [(900, 999)])
+
+    def test_suffix_range(self):
+        nose.eq_(parse_range_header('bytes=-100', 1000), [(900, 999)])
+        nose.eq_(parse_range_header('bytes=-5000', 1000), [(0, 999)])
+
+    def test_multiple_ranges(self):
+        nose.eq_(parse_range_header('bytes=0-9, 500-599', 1000),
+                 [(0, 9), (500, 599)])
+
+    def test_overlapping_ranges_are_merged(self):
+        nose.eq_(parse_range_header('bytes=500-599,0-9,10-19,550-700', 1000),
+                 [(0, 19), (500, 700)])
+
+    def test_unsatisfiable_ranges(self):
+        nose.eq_(parse_range_header('bytes=1000-', 1000), [])
+        nose.eq_(parse_range_header('bytes=-0', 1000), [])
+        nose.eq_(parse_range_header('bytes=0-', 0), [])
+        nose.eq_(parse_range_header('bytes=2000-2999,0-9', 1000), [(0, 9)])
+
+    def test_invalid_headers(self):
+        for header in ('', 'bytes=', 'bytes=-', 'bytes=9-0', 'items=0-9',
+                       'bytes=a-b', 'bytes=0-9,x'):
+            nose.eq_(parse_range_header(header, 1000), None)
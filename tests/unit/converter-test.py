@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from mock import Mock
+from nose import tools as nose
+import unittest
+
+from shiva.app import app
+from shiva import throttle
+from shiva.converter import Converter
+from shiva.media import MediaDir, MimeType
+
+
+class ConverterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mimetype = MimeType(type='audio', subtype='ogg', extension='ogg',
+                                 acodec='libvorbis')
+        self.media_dirs = app.config.get('MEDIA_DIRS')
+        app.config['MEDIA_DIRS'] = [
+            MediaDir('/srv', dirs=('music',), url='http://music.example.com'),
+            MediaDir('/srv', dirs=('podcasts',),
+                     url='http://podcasts.example.com'),
+        ]
+
+    def tearDown(self):
+        app.config['MEDIA_DIRS'] = self.media_dirs
+
+    def test_file_uri_uses_the_media_dir_of_the_track(self):
+        track = Mock(path='/srv/podcasts/show/episode.ogg')
+        with app.app_context():
+            converter = Converter(track, self.mimetype)
+
+            nose.eq_(converter.get_file_uri(),
+                     'http://podcasts.example.com/show/episode.ogg')
+
+    def test_file_uri_includes_the_limits(self):
+        track = Mock(path='/srv/music/track.ogg', bitrate=320)
+        app.config['STREAM_BITRATE_MULTIPLIER'] = 2
+        try:
+            with app.test_request_context():
+                uri = Converter(track, self.mimetype).get_file_uri()
+                base, token = uri.split('?stream=')
+
+                nose.eq_(base, 'http://music.example.com/track.ogg')
+                nose.eq_(throttle.load_stream_token(token, 'track.ogg'),
+                         (80000, None, None))
+        finally:
+            app.config['STREAM_BITRATE_MULTIPLIER'] = None
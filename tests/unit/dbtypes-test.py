@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+from sqlalchemy.dialects import postgresql, sqlite
+import unittest
+import uuid
+
+from shiva.dbtypes import GUID
+
+
+class GUIDTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.uuid = uuid.UUID('0f9b2c2e-5e4b-4a8e-9d3c-2b1a7e6f5d4c')
+        self.dialect = sqlite.dialect()
+        self.dialect.dbapi = sqlite.dialect.dbapi()
+
+    def get_processors(self, binary=False, dialect=None):
+        guid = GUID()
+        guid.binary = binary
+        dialect = dialect or self.dialect
+
+        return (guid.bind_processor(dialect),
+                guid.result_processor(dialect, None))
+
+    def test_hex(self):
+        bind, result = self.get_processors()
+
+        nose.eq_(bind(self.uuid), self.uuid.hex)
+        nose.eq_(bind(str(self.uuid)), self.uuid.hex)
+        nose.eq_(result(self.uuid.hex), self.uuid)
+
+    def test_binary(self):
+        bind, result = self.get_processors(binary=True)
+
+        nose.eq_(str(bind(self.uuid)), self.uuid.bytes)
+        nose.eq_(str(bind(self.uuid.hex)), self.uuid.bytes)
+        nose.eq_(result(bind(self.uuid)), self.uuid)
+
+    def test_postgresql(self):
+        bind, result = self.get_processors(dialect=postgresql.dialect())
+
+        nose.eq_(bind(self.uuid), str(self.uuid))
+        nose.eq_(result(str(self.uuid)), self.uuid)
+
+    def test_results_are_uuids(self):
+        for binary in (False, True):
+            bind, result = self.get_processors(binary=binary)
+            value = result(bind(self.uuid))
+
+            nose.ok_(isinstance(value, uuid.UUID))
+            nose.eq_(hash(value), hash(self.uuid))
+            nose.eq_(str(value), str(self.uuid))
+
+    def test_none(self):
+        for binary in (False, True):
+            bind, result = self.get_processors(binary=binary)
+
+            nose.assert_is_none(bind(None))
+            nose.assert_is_none(result(None))
+
+    def test_invalid(self):
+        bind, result = self.get_processors()
+
+        with nose.assert_raises(ValueError):
+            bind('not-a-uuid')
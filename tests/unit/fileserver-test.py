@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from nose import tools as nose
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+from werkzeug.http import http_date
+
+from shiva import fileserver, metrics, throttle
+from shiva.media import MediaDir
+from shiva.utils import LRUCache
+
+
+class FileWrapper(object):
+    """Stands for the `wsgi.file_wrapper` of a server."""
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), '')
+
+    def close(self):
+        self.filelike.close()
+
+
+class FileServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = ''.join(chr(i % 256) for i in xrange(200000))
+        with open(os.path.join(self.root, 'track.flac'), 'wb') as f:
+            f.write(self.data)
+
+        self.media_dirs = fileserver.app.config.get('MEDIA_DIRS')
+        fileserver.app.config['MEDIA_DIRS'] = [MediaDir(self.root)]
+        self.client = fileserver.app.test_client()
+
+        self.now = 0
+        self.path_cache = fileserver.path_cache
+        fileserver.path_cache = LRUCache(16, ttl=60, timer=lambda: self.now)
+        self.scheduler = fileserver.scheduler
+        fileserver.scheduler = throttle.Scheduler()
+
+    def tearDown(self):
+        fileserver.scheduler = self.scheduler
+        fileserver.path_cache = self.path_cache
+        fileserver.app.config['MEDIA_DIRS'] = self.media_dirs
+        shutil.rmtree(self.root)
+
+    def get(self, range_header=None, **kwargs):
+        headers = {'Range': range_header} if range_header else {}
+
+        return self.client.get('/track.flac', headers=headers, **kwargs)
+
+    def test_whole_file(self):
+        resp = self.get()
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.headers['Content-Length'], '200000')
+        nose.eq_(resp.data, self.data)
+
+    def test_range(self):
+        resp = self.get('bytes=100-199')
+
+        nose.eq_(resp.status_code, 206)
+        nose.eq_(resp.headers['Content-Length'], '100')
+        nose.eq_(resp.headers['Content-Range'], 'bytes 100-199/200000')
+        nose.eq_(resp.data, self.data[100:200])
+
+    def test_open_ended_range(self):
+        resp = self.get('bytes=150000-')
+
+        nose.eq_(resp.headers['Content-Length'], '50000')
+        nose.eq_(resp.headers['Content-Range'], 'bytes 150000-199999/200000')
+        nose.eq_(resp.data, self.data[150000:])
+
+    def test_unsatisfiable_range(self):
+        resp = self.get('bytes=300000-')
+
+        nose.eq_(resp.status_code, 416)
+        nose.eq_(resp.headers['Content-Range'], 'bytes */200000')
+
+    def test_file_wrapper(self):
+        streams = metrics.FILESERVER_STREAMS.get()
+        environ = {'wsgi.file_wrapper': FileWrapper}
+        resp = self.get('bytes=0-', environ_base=environ, buffered=False)
+
+        wrapper = resp.response
+        nose.ok_(isinstance(wrapper, FileWrapper))
+        nose.eq_(wrapper.blksize, fileserver.CHUNK_SIZE)
+        nose.ok_(hasattr(wrapper.filelike, 'fileno'))
+        nose.eq_(metrics.FILESERVER_STREAMS.get(), streams + 1)
+
+        resp.close()
+        nose.eq_(metrics.FILESERVER_STREAMS.get(), streams)
+
+    def test_bytes_sent(self):
+        sent = metrics.FILESERVER_BYTES.get()
+        environ = {'wsgi.file_wrapper': FileWrapper}
+        resp = self.get('bytes=0-99999', environ_base=environ,
+                        buffered=False)
+
+        # Dropped after the first chunk, as players do when seeking.
+        next(iter(resp.response))
+        resp.close()
+
+        nose.eq_(metrics.FILESERVER_BYTES.get(), sent + fileserver.CHUNK_SIZE)
+
+    def test_bytes_sent_from_the_file(self):
+        sent = metrics.FILESERVER_BYTES.get()
+        environ = {'wsgi.file_wrapper': FileWrapper}
+        resp = self.get('bytes=1000-', environ_base=environ, buffered=False)
+
+        # The way servers using sendfile() leave the file.
+        resp.response.filelike.file.seek(5000)
+        resp.close()
+
+        nose.eq_(metrics.FILESERVER_BYTES.get(), sent + 4000)
+
+    def test_partial_ranges_are_read(self):
+        environ = {'wsgi.file_wrapper': FileWrapper}
+        resp = self.get('bytes=0-99', environ_base=environ, buffered=False)
+
+        nose.ok_(not hasattr(resp.response.filelike, 'fileno'))
+        nose.eq_(''.join(resp.response), self.data[:100])
+        resp.close()
+
+    def test_suffix_range(self):
+        resp = self.get('bytes=-100')
+
+        nose.eq_(resp.status_code, 206)
+        nose.eq_(resp.headers['Content-Range'], 'bytes 199900-199999/200000')
+        nose.eq_(resp.data, self.data[-100:])
+
+    def test_multiple_ranges(self):
+        streams = metrics.FILESERVER_STREAMS.get()
+        sent = metrics.FILESERVER_BYTES.get()
+        resp = self.get('bytes=0-9,-10')
+
+        nose.eq_(resp.status_code, 206)
+        boundary = re.match(r'^multipart/byteranges; boundary=(\w+)$',
+                            resp.headers['Content-Type']).group(1)
+        nose.eq_(int(resp.headers['Content-Length']), len(resp.data))
+        expected = (
+            '\r\n--%(b)s\r\nContent-Type: audio/flac\r\n'
+            'Content-Range: bytes 0-9/200000\r\n\r\n%(first)s'
+            '\r\n--%(b)s\r\nContent-Type: audio/flac\r\n'
+            'Content-Range: bytes 199990-199999/200000\r\n\r\n%(last)s'
+            '\r\n--%(b)s--\r\n')
+        nose.eq_(resp.data, expected % {'b': boundary,
+                                        'first': self.data[:10],
+                                        'last': self.data[-10:]})
+
+        resp.close()
+        nose.eq_(metrics.FILESERVER_STREAMS.get(), streams)
+        nose.eq_(metrics.FILESERVER_BYTES.get(), sent + 20)
+
+    def test_invalid_range_is_ignored(self):
+        resp = self.get('bytes=9-0')
+
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.data, self.data)
+
+    def test_head(self):
+        resp = self.client.head('/track.flac', headers={'Range': 'bytes=-10'})
+
+        nose.eq_(resp.status_code, 206)
+        nose.eq_(resp.headers['Content-Length'], '10')
+        nose.eq_(resp.data, '')
+
+    def test_validators(self):
+        resp = self.get()
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        stat = os.stat(os.path.join(self.root, 'track.flac'))
+        nose.eq_(last_modified, http_date(int(stat.st_mtime)))
+
+        for headers in ({'If-None-Match': etag},
+                        {'If-Modified-Since': last_modified}):
+            resp = self.client.get('/track.flac', headers=headers)
+            nose.eq_(resp.status_code, 304)
+            nose.eq_(resp.data, '')
+
+    def test_if_range(self):
+        etag = self.get().headers['ETag']
+
+        resp = self.client.get('/track.flac', headers={
+            'Range': 'bytes=0-9', 'If-Range': etag})
+        nose.eq_(resp.status_code, 206)
+
+        resp = self.client.get('/track.flac', headers={
+            'Range': 'bytes=0-9', 'If-Range': '"outdated"'})
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(len(resp.data), len(self.data))
+
+    def test_x_accel_redirect(self):
+        fileserver.app.config['SENDFILE'] = 'x-accel-redirect'
+        fileserver.app.config['SENDFILE_PREFIX'] = '/_files/'
+        try:
+            resp = self.get('bytes=100-')
+        finally:
+            fileserver.app.config['SENDFILE'] = None
+
+        path = os.path.join(self.root, 'track.flac')
+        nose.eq_(resp.status_code, 200)
+        nose.eq_(resp.headers['X-Accel-Redirect'], '/_files' + path)
+        nose.eq_(resp.headers['Content-Type'], 'audio/flac')
+        nose.eq_(resp.data, '')
+
+    def test_x_sendfile(self):
+        fileserver.app.config['SENDFILE'] = 'x-sendfile'
+        try:
+            resp = self.get()
+        finally:
+            fileserver.app.config['SENDFILE'] = None
+
+        nose.eq_(resp.headers['X-Sendfile'],
+                 os.path.join(self.root, 'track.flac'))
+
+    def test_sendfile_needs_an_existing_file(self):
+        fileserver.app.config['SENDFILE'] = 'x-sendfile'
+        try:
+            resp = self.client.get('/../../etc/passwd')
+        finally:
+            fileserver.app.config['SENDFILE'] = None
+
+        nose.eq_(resp.status_code, 404)
+
+    def test_sibling_directories_are_not_served(self):
+        sibling = self.root + '-private'
+        os.mkdir(sibling)
+        try:
+            with open(os.path.join(sibling, 'secret.txt'), 'wb') as f:
+                f.write('secret')
+
+            name = os.path.basename(sibling)
+            for url in ('/../%s/secret.txt' % name,
+                        '/%%2e%%2e/%s/secret.txt' % name):
+                nose.eq_(self.client.get(url).status_code, 404)
+        finally:
+            shutil.rmtree(sibling)
+
+    def test_excluded_dirs(self):
+        for name in ('private', 'privateer'):
+            os.mkdir(os.path.join(self.root, name))
+            with open(os.path.join(self.root, name, 'track.flac'), 'wb') as f:
+                f.write('fLaC')
+        fileserver.app.config['MEDIA_DIRS'] = [
+            MediaDir(self.root, exclude='private')]
+
+        nose.eq_(self.client.get('/private/track.flac').status_code, 404)
+        nose.eq_(self.client.get('/privateer/track.flac').status_code, 200)
+
+    def test_converted_tracks_cache(self):
+        cache_dir = os.path.join(self.root, 'cache')
+        os.makedirs(os.path.join(cache_dir, 'ogg'))
+        with open(os.path.join(cache_dir, 'ogg', 'track.ogg'), 'wb') as f:
+            f.write('OggS')
+
+        fileserver.app.config['TRANSCODE_CACHE_DIR'] = cache_dir
+        try:
+            resp = self.client.get('/ogg/track.ogg')
+            outside = self.client.get('/ogg/../../track.flac')
+        finally:
+            fileserver.app.config['TRANSCODE_CACHE_DIR'] = None
+
+        nose.eq_(resp.data, 'OggS')
+        nose.eq_(outside.status_code, 404)
+
+    def test_paths_are_cached(self):
+        path = os.path.join(self.root, 'track.flac')
+        nose.eq_(fileserver.resolve_path('track.flac')[0], path)
+
+        fileserver.app.config['MEDIA_DIRS'] = []
+        nose.eq_(fileserver.resolve_path('track.flac')[0], path)
+        nose.eq_(fileserver.path_cache.hits, 1)
+
+    def test_moved_files_are_looked_for_again(self):
+        for name in ('mp3', 'flac'):
+            os.mkdir(os.path.join(self.root, name))
+        fileserver.app.config['MEDIA_DIRS'] = [
+            MediaDir(os.path.join(self.root, 'mp3')),
+            MediaDir(os.path.join(self.root, 'flac'))]
+        os.rename(os.path.join(self.root, 'track.flac'),
+                  os.path.join(self.root, 'mp3', 'track.flac'))
+        fileserver.resolve_path('track.flac')
+
+        os.rename(os.path.join(self.root, 'mp3', 'track.flac'),
+                  os.path.join(self.root, 'flac', 'track.flac'))
+        path, stat = fileserver.resolve_path('track.flac')
+
+        nose.eq_(path, os.path.join(self.root, 'flac', 'track.flac'))
+        nose.eq_(stat.st_size, len(self.data))
+
+    def test_missing_files_expire(self):
+        nose.eq_(fileserver.resolve_path('new.flac'), (None, None))
+        with open(os.path.join(self.root, 'new.flac'), 'wb') as f:
+            f.write('fLaC')
+
+        nose.eq_(fileserver.resolve_path('new.flac'), (None, None))
+        self.now = 60
+        nose.ok_(fileserver.resolve_path('new.flac')[0])
+
+    def test_disabled(self):
+        fileserver.path_cache = None
+
+        nose.ok_(fileserver.resolve_path('track.flac')[0])
+        nose.eq_(fileserver.resolve_path('new.flac'), (None, None))
+
+    def get_throttled(self, url='/track.flac', limit=40000):
+        fileserver.app.config['STREAM_RATE_LIMIT'] = limit
+        try:
+            return self.client.get(url, buffered=False, environ_base={
+                'wsgi.file_wrapper': FileWrapper,
+                'REMOTE_ADDR': '10.0.0.1'})
+        finally:
+            fileserver.app.config['STREAM_RATE_LIMIT'] = None
+
+    def test_throttled_streams(self):
+        resp = self.get_throttled()
+        wrapper = resp.response
+
+        nose.eq_(wrapper.blksize, fileserver.THROTTLED_CHUNK_SIZE)
+        nose.ok_(not hasattr(wrapper.filelike, 'fileno'))
+
+        stream = wrapper.filelike.stream
+        nose.eq_((stream.limit, stream.user, stream.user_limit),
+                 (40000, '10.0.0.1', None))
+        nose.eq_(fileserver.scheduler.streams, set([stream]))
+
+        resp.close()
+        nose.eq_(fileserver.scheduler.streams, set())
+
+    def get_signed(self, path='track.flac', url='/track.flac'):
+        with fileserver.app.test_request_context():
+            token = throttle.get_serializer().dumps(
+                [path, 80000, 'user', 200000])
+
+        resp = self.get_throttled('%s?stream=%s' % (url, token))
+        stream = resp.response.filelike.stream
+        resp.close()
+
+        return stream
+
+    def test_signed_limits(self):
+        stream = self.get_signed()
+
+        nose.eq_((stream.limit, stream.user, stream.user_limit),
+                 (80000, 'user', 200000))
+
+    def test_limits_of_other_files_are_ignored(self):
+        stream = self.get_signed(path='other.flac')
+
+        nose.eq_((stream.limit, stream.user), (40000, '10.0.0.1'))
+
+    def test_expired_limits_are_ignored(self):
+        max_age = fileserver.app.config['STREAM_TOKEN_MAX_AGE']
+        with patch('time.time', return_value=time.time() - max_age - 1):
+            with fileserver.app.test_request_context():
+                token = throttle.get_serializer().dumps(
+                    ['track.flac', 80000, 'user', 200000])
+
+        resp = self.get_throttled('/track.flac?stream=%s' % token)
+        stream = resp.response.filelike.stream
+        resp.close()
+
+        nose.eq_((stream.limit, stream.user), (40000, '10.0.0.1'))
+
+    def test_forged_limits_are_ignored(self):
+        resp = self.get_throttled('/track.flac?stream=WzAsbnVsbCwwXQ.forged')
+        stream = resp.response.filelike.stream
+        resp.close()
+
+        nose.eq_(stream.limit, 40000)
+
+    def test_throttled_reads_wait(self):
+        resp = self.get_throttled(limit=1000)
+        filelike = resp.response.filelike
+        filelike.stream.bucket = throttle.TokenBucket(
+            1000, timer=lambda: self.now)
+
+        filelike.read(1000)
+        nose.eq_(filelike.stream.reserve(0), 0)
+        filelike.read(500, wait=False)
+        nose.eq_(filelike.stream.reserve(0), 0)
+        resp.close()
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from nose import tools as nose
+import json
 import unittest
+import zlib
+
+from flask import Flask, g
 
 from shiva import http
 from shiva.app import app
@@ -12,3 +16,93 @@ class HTTPTestCase(unittest.TestCase):
         with app.app_context():
             resource = http.Resource()
             nose.assert_true(isinstance(resource.options(), http.JSONResponse))
+
+
+class StreamingTestCase(unittest.TestCase):
+
+    def test_iterencode(self):
+        data = {
+            'count': 2,
+            'items': (item for item in [{'id': 1}, {'id': 2, 'tags': []}]),
+            'nested': {'albums': iter([{'tracks': iter([1, 2])}])},
+        }
+        expected = {
+            'count': 2,
+            'items': [{'id': 1}, {'id': 2, 'tags': []}],
+            'nested': {'albums': [{'tracks': [1, 2]}]},
+        }
+
+        nose.eq_(json.loads(''.join(http.iterencode(data))), expected)
+
+    def test_buffered(self):
+        chunks = list(http.buffered(['a'] * 10, size=4))
+
+        nose.eq_(chunks, ['aaaa', 'aaaa', 'aa'])
+
+    def test_gzip_chunks(self):
+        data = ['{"items": [', '1, ' * 1000, '2]}']
+        compressed = ''.join(http.gzip_chunks(iter(data)))
+
+        nose.eq_(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                 ''.join(data))
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class ItemResource(http.Resource):
+            calls = []
+            method_decorators = []
+
+            def get(self):
+                return {'calls': len(self.calls)}
+
+            def delete(self):
+                return self.Response('')
+
+        self.resource = ItemResource
+        self.app = Flask(__name__)
+        self.api = http.Api(self.app)
+        self.api.add_resource(ItemResource, '/items/')
+        self.client = self.app.test_client()
+
+    def test_decorators_do_not_pile_up(self):
+        self.resource.method_decorators.append(self.count)
+        self.resource.build_pipeline()
+
+        for _ in range(3):
+            nose.eq_(self.client.get('/items/').status_code, 200)
+
+        nose.eq_(len(self.resource.calls), 3)
+        nose.eq_(len(self.resource.method_decorators), 1)
+        nose.eq_(http.Resource.method_decorators, [])
+
+    def test_head_uses_get(self):
+        nose.eq_(self.client.head('/items/').status_code, 200)
+
+    def test_allow_method(self):
+        nose.eq_(self.client.delete('/items/').status_code, 405)
+
+        self.app.config['ALLOW_DELETE'] = True
+        nose.eq_(self.client.delete('/items/').status_code, 204)
+
+    def test_cors(self):
+        self.app.config['CORS_ALLOWED_ORIGINS'] = '*'
+        headers = {'Origin': 'http://example.com'}
+
+        with self.app.test_request_context(headers=headers):
+            self.resource().dispatch_request()
+            nose.ok_(not hasattr(g, 'cors'))
+
+        self.resource.build_pipeline(cors_enabled=True)
+        with self.app.test_request_context(headers=headers):
+            self.resource().dispatch_request()
+            nose.eq_(g.cors, '*')
+
+    def count(self, func):
+        def decorated(*args, **kwargs):
+            self.resource.calls.append(func)
+
+            return func(*args, **kwargs)
+
+        return decorated
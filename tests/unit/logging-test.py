@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from nose import tools as nose
+import logging
+import threading
+import unittest
+
+from shiva import utils
+
+
+class Handler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+class GetLoggerTestCase(unittest.TestCase):
+
+    def test_configured_once(self):
+        utils.get_logger()
+
+        with patch('logging.config.fileConfig') as fileConfig:
+            for _ in range(3):
+                log = utils.get_logger()
+
+        nose.eq_(fileConfig.call_count, 0)
+        nose.eq_(log.name, 'shiva')
+
+
+class QueueHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = Handler()
+        self.log = logging.getLogger('shiva.tests.queue')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+        self.log.addHandler(self.handler)
+
+    def tearDown(self):
+        for handler in self.log.handlers[:]:
+            self.log.removeHandler(handler)
+            handler.close()
+
+    def test_records_are_written_by_another_thread(self):
+        utils.queue_logging(self.log)
+        queue_handler = self.log.handlers[0]
+
+        items = ['Eterna']
+        self.log.info('Found: %s', items)
+        items.append('Pirexia')
+        queue_handler.close()
+
+        nose.eq_(self.handler.records, ["Found: ['Eterna']"])
+        nose.eq_(self.handler.threads, set(['shiva-logging']))
+
+    def test_queue_logging_is_idempotent(self):
+        utils.queue_logging(self.log)
+        utils.queue_logging(self.log)
+
+        nose.eq_(len(self.log.handlers), 1)
+        nose.ok_(isinstance(self.log.handlers[0], utils.QueueHandler))
+
+    def test_handler_levels_are_respected(self):
+        self.handler.setLevel(logging.WARNING)
+        utils.queue_logging(self.log)
+
+        self.log.info('Skipped')
+        self.log.warning('Written')
+        self.log.handlers[0].close()
+
+        nose.eq_(self.handler.records, ['Written'])
+
+    def test_exceptions(self):
+        self.handler.setFormatter(
+            logging.Formatter('%(levelname)s %(message)s'))
+        utils.queue_logging(self.log)
+
+        try:
+            raise ValueError('Nope')
+        except ValueError:
+            self.log.exception('Boom happened')
+        self.log.handlers[0].close()
+
+        record = self.handler.records[0]
+        nose.ok_(record.startswith('ERROR Boom happened\nTraceback'))
+        nose.eq_(record.count('Boom happened'), 1)
+        nose.ok_(record.endswith('ValueError: Nope'))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+import unittest
+
+from shiva.utils import LRUCache
+
+
+class Timer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = Timer()
+        self.cache = LRUCache(2, ttl=10, timer=self.timer)
+
+    def test_get_and_set(self):
+        nose.assert_is_none(self.cache.get('a'))
+        nose.eq_(self.cache.get('a', 0), 0)
+
+        self.cache.set('a', 1)
+        nose.eq_(self.cache.get('a'), 1)
+        nose.eq_((self.cache.hits, self.cache.misses), (1, 2))
+        nose.ok_('a' in self.cache)
+
+    def test_least_recently_used_is_dropped(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        nose.eq_(len(self.cache), 2)
+        nose.ok_('b' not in self.cache)
+        nose.ok_('a' in self.cache)
+
+    def test_membership_is_not_a_use(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+
+        nose.ok_('a' in self.cache)
+        nose.ok_('c' not in self.cache)
+        nose.eq_((self.cache.hits, self.cache.misses), (0, 0))
+
+        # Still the least recently used.
+        self.cache.set('c', 3)
+        nose.ok_('a' not in self.cache)
+
+        self.timer.now = 10
+        nose.ok_('b' not in self.cache)
+
+    def test_expiration(self):
+        self.cache.set('a', 1)
+        self.timer.now = 9
+        nose.eq_(self.cache.get('a'), 1)
+
+        self.timer.now = 10
+        nose.assert_is_none(self.cache.get('a'))
+        nose.assert_is_none(self.cache.pop('a'))
+
+    def test_no_ttl(self):
+        cache = LRUCache(2, timer=self.timer)
+        cache.set('a', 1)
+        self.timer.now = 10 ** 6
+
+        nose.eq_(cache.get('a'), 1)
+
+    def test_pop_and_discard(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+
+        nose.eq_(self.cache.pop('a'), 1)
+        nose.ok_('a' not in self.cache)
+
+        self.cache.discard(lambda value: value == 2)
+        nose.eq_(len(self.cache), 0)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+import unittest
+
+from shiva import metrics
+from shiva.utils import LRUCache
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = metrics.Counter('shiva_plays_total', 'Tracks played.',
+                                  ('format',), registry=self.registry)
+        counter.inc(format='mp3')
+        counter.inc(2, format='ogg "vorbis"')
+
+        nose.eq_(self.registry.render(),
+                 '# HELP shiva_plays_total Tracks played.\n'
+                 '# TYPE shiva_plays_total counter\n'
+                 'shiva_plays_total{format="mp3"} 1.0\n'
+                 'shiva_plays_total{format="ogg \\"vorbis\\""} 2.0\n')
+
+    def test_unlabeled_metrics_start_at_zero(self):
+        metrics.Gauge('shiva_streams', 'Streams.', registry=self.registry)
+
+        nose.ok_(self.registry.render().endswith('\nshiva_streams 0.0\n'))
+
+    def test_labels_are_required(self):
+        counter = metrics.Counter('shiva_plays_total', 'Tracks played.',
+                                  ('format',), registry=self.registry)
+
+        with nose.assert_raises(ValueError):
+            counter.inc()
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('shiva_streams', 'Streams.',
+                              registry=self.registry)
+
+        with gauge.track():
+            nose.eq_(gauge.get(), 1)
+        nose.eq_(gauge.get(), 0)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('shiva_latency_seconds', 'Latency.',
+                                      buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        lines = self.registry.render().splitlines()[2:]
+        nose.eq_(lines, [
+            'shiva_latency_seconds_bucket{le="0.1"} 2.0',
+            'shiva_latency_seconds_bucket{le="1.0"} 3.0',
+            'shiva_latency_seconds_bucket{le="+Inf"} 4.0',
+            'shiva_latency_seconds_sum 3.65',
+            'shiva_latency_seconds_count 4.0',
+        ])
+
+    def test_watched_caches(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        metrics.watch_cache('test', lambda: cache)
+
+        output = metrics.REGISTRY.render()
+        nose.ok_('shiva_cache_hit_ratio{cache="test"} 0.5\n' in output)
+        nose.ok_('shiva_cache_size{cache="test"} 1.0\n' in output)
+
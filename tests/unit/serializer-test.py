@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from flask.ext.restful import fields, marshal
+from nose import tools as nose
+import unittest
+
+from shiva.app import app
+from shiva.resources import ArtistResource, TrackResource
+from shiva.resources.fields import InstanceURI
+from shiva.serializer import compile_fields
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fields = {
+            'id': fields.String(attribute='pk'),
+            'name': fields.String,
+            'year': fields.Integer,
+            'image': fields.String(default='default.jpg'),
+            'nested': {
+                'id': fields.String(attribute='pk'),
+            },
+        }
+        self.row = Row(pk=1, name=u'Flip', year=None, image=None)
+
+    def test_same_output_as_marshal(self):
+        serialize = compile_fields(self.fields)
+
+        nose.eq_(serialize(self.row), dict(marshal(self.row, self.fields)))
+
+    def test_defaults(self):
+        result = compile_fields(self.fields)(self.row)
+
+        nose.eq_(result['year'], 0)
+        nose.eq_(result['image'], 'default.jpg')
+
+    def test_lists(self):
+        serialize = compile_fields(self.fields)
+        rows = [self.row, Row(pk=2, name=u'Eterna', year=2002, image='x')]
+
+        nose.eq_(serialize(rows), [dict(marshal(r, self.fields))
+                                   for r in rows])
+
+    def test_dicts(self):
+        serialize = compile_fields(self.fields)
+        row = {'pk': 3, 'name': u'Pirexia'}
+
+        nose.eq_(serialize(row), dict(marshal(row, self.fields)))
+
+
+class ResourceFieldsTestCase(unittest.TestCase):
+
+    def test_fields_are_built_once_per_class(self):
+        with app.app_context():
+            nose.assert_is(ArtistResource.get_fields(),
+                           ArtistResource.get_fields())
+            nose.assert_is(ArtistResource.get_serializer(),
+                           ArtistResource.get_serializer())
+            nose.assert_is_not(ArtistResource.get_fields(),
+                               TrackResource.get_fields())
+
+    def test_server_uri_is_read_once(self):
+        uri = InstanceURI('artists')
+        server_uri = app.config.get('SERVER_URI')
+        try:
+            with app.app_context():
+                app.config['SERVER_URI'] = 'http://example.com'
+                nose.eq_(uri.output('uri', Row(pk=1)),
+                         'http://example.com/artists/1')
+
+                app.config['SERVER_URI'] = 'http://other.example.com'
+                nose.eq_(uri.output('uri', Row(pk=2)),
+                         'http://example.com/artists/2')
+        finally:
+            app.config['SERVER_URI'] = server_uri
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from nose import tools as nose
+import unittest
+
+from shiva.app import app
+from shiva.suggest import prefix_distance, SuggestIndex, tokenize
+
+
+class SuggestIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SuggestIndex()
+        self.index.load([
+            ('artist', 1, 'Flip'),
+            ('artist', 2, u'Björk'),
+            ('album', 3, 'Falling Down'),
+            ('track', 4, 'Dinosaurs Will Die'),
+            ('track', 5, 'Dinosaurs'),
+            ('track', 6, None),
+        ])
+
+    def names(self, query, **kwargs):
+        return [s.name for s in self.index.suggest(query, **kwargs)]
+
+    def test_tokenize(self):
+        nose.eq_(tokenize(u'Björk - Jóga'), [u'bjork', u'joga'])
+        nose.eq_(tokenize('Bj\xc3\xb6rk'), [u'bjork'])
+
+    def test_prefix_distance(self):
+        nose.eq_(prefix_distance(u'dino', u'dinosaurs', 1), 0)
+        nose.eq_(prefix_distance(u'dimo', u'dinosaurs', 1), 1)
+        nose.eq_(prefix_distance(u'dnos', u'dinosaurs', 1), 1)
+        nose.eq_(prefix_distance(u'dxxo', u'dinosaurs', 1), None)
+
+    def test_prefix(self):
+        nose.eq_(self.names('fl'), ['Flip'])
+        nose.eq_(self.names('bjork'), [u'Björk'])
+        nose.eq_(self.names('DOWN'), ['Falling Down'])
+
+    def test_all_words(self):
+        nose.eq_(self.names('die dino'), ['Dinosaurs Will Die'])
+        nose.eq_(self.names('die flip'), [])
+
+    def test_ranking(self):
+        nose.eq_(self.names('dino'), ['Dinosaurs', 'Dinosaurs Will Die'])
+        nose.eq_(self.names('dino', limit=1), ['Dinosaurs'])
+
+    def test_kinds(self):
+        nose.eq_(self.names('f', kinds=('album',)), ['Falling Down'])
+
+    def test_typos(self):
+        nose.eq_(self.names('dinisaur'), ['Dinosaurs', 'Dinosaurs Will Die'])
+        nose.eq_(self.names('fallnig'), ['Falling Down'])
+        # Too short to be corrected
+        nose.eq_(self.names('fp'), [])
+
+    def test_updates(self):
+        self.index.add('artist', 1, 'Eterna')
+        nose.eq_(self.names('flip'), [])
+        nose.eq_(self.names('eter'), ['Eterna'])
+
+        self.index.remove('artist', 1)
+        nose.eq_(self.names('eter'), [])
+        nose.ok_('eterna' not in self.index.sorted_words)
+        nose.eq_(len(self.index), 4)
+
+    def test_removed_objects_are_replaced(self):
+        for name in ('Eterna', 'Flip', 'Eterna'):
+            self.index.add('artist', 1, name)
+        self.index.remove('track', 5)
+        self.index.add('track', 7, 'Tiny Dinosaurs')
+
+        nose.eq_(len(self.index.pks), 5)
+        nose.eq_(self.names('dino'), ['Dinosaurs Will Die', 'Tiny Dinosaurs'])
+
+
+class SuggestCandidatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SuggestIndex()
+        self.index.load(
+            [('track', pk, 'Other %d' % pk) for pk in xrange(20)] +
+            [('artist', 20, 'The Others'), ('album', 21, 'Others')])
+
+    def names(self, query, **kwargs):
+        with patch('shiva.suggest.MAX_CANDIDATES', 5):
+            return [s.name for s in self.index.suggest(query, **kwargs)]
+
+    def test_kinds_are_filtered_before_the_limit(self):
+        nose.eq_(self.names('oth', kinds=('artist',)), ['The Others'])
+
+    def test_names_starting_with_the_query_are_kept(self):
+        nose.eq_(self.names('others', limit=1), ['Others'])
+        nose.eq_(self.names('oth', limit=1, kinds=('album', 'artist')),
+                 ['Others'])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+import unittest
+
+from shiva.throttle import get_fair_shares, Scheduler, TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.bucket = TokenBucket(1000, timer=lambda: self.now)
+
+    def test_burst(self):
+        nose.eq_(self.bucket.reserve(1000), 0)
+        nose.eq_(self.bucket.reserve(500), 0.5)
+
+    def test_refill(self):
+        self.bucket.reserve(1000)
+        self.now = 0.25
+
+        nose.eq_(self.bucket.reserve(250), 0)
+        nose.eq_(self.bucket.reserve(250), 0.25)
+
+    def test_refill_is_capped_by_the_burst(self):
+        self.now = 60
+
+        nose.eq_(self.bucket.reserve(1000), 0)
+        nose.eq_(self.bucket.reserve(1000), 1)
+
+    def test_reservations_in_advance_are_paid(self):
+        nose.eq_(self.bucket.reserve(3000), 2)
+        nose.eq_(self.bucket.reserve(1000), 3)
+
+    def test_set_rate(self):
+        self.bucket.reserve(1000)
+        self.bucket.set_rate(2000)
+
+        nose.eq_(self.bucket.reserve(1000), 0.5)
+
+
+class FairSharesTestCase(unittest.TestCase):
+
+    def test_even_split(self):
+        nose.eq_(get_fair_shares(300, {'a': None, 'b': None, 'c': None}),
+                 {'a': 100, 'b': 100, 'c': 100})
+
+    def test_streams_below_their_share_get_their_limit(self):
+        shares = get_fair_shares(1000, {'play': 40, 'a': None, 'b': None})
+
+        nose.eq_(shares, {'play': 40, 'a': 480, 'b': 480})
+
+    def test_limits_above_the_share(self):
+        shares = get_fair_shares(900, {'a': 200, 'b': 500, 'c': 1000})
+
+        nose.eq_(shares, {'a': 200, 'b': 350, 'c': 350})
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def test_unlimited(self):
+        stream = Scheduler().open()
+
+        nose.eq_(stream.rate, None)
+        nose.eq_(stream.reserve(10 ** 9), 0)
+
+    def test_stream_limit(self):
+        stream = Scheduler().open(limit=1000)
+
+        nose.eq_(stream.rate, 1000)
+
+    def test_user_limit_is_shared_by_its_streams(self):
+        scheduler = Scheduler()
+        first = scheduler.open(user='a', user_limit=1000)
+        nose.eq_(first.rate, 1000)
+
+        second = scheduler.open(limit=200, user='a', user_limit=1000)
+        other = scheduler.open(user='b', user_limit=1000)
+        nose.eq_((first.rate, second.rate, other.rate), (500, 200, 1000))
+
+        second.close()
+        nose.eq_(first.rate, 1000)
+
+    def test_egress_is_shared_fairly(self):
+        scheduler = Scheduler(1000)
+        playback = scheduler.open(limit=40)
+        downloads = [scheduler.open(), scheduler.open()]
+
+        nose.eq_(playback.rate, 40)
+        nose.eq_([stream.rate for stream in downloads], [480, 480])
+
+        downloads[0].close()
+        nose.eq_(downloads[1].rate, 960)
+
+    def test_close_twice(self):
+        scheduler = Scheduler()
+        stream = scheduler.open(limit=1000)
+
+        stream.close()
+        stream.close()
+        nose.eq_(scheduler.streams, set())
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from nose import tools as nose
+import os
+import shutil
+import tempfile
+import unittest
+
+from shiva import metrics
+from shiva.transcodecache import TranscodeCache
+
+
+class TranscodeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.now = 1000
+        self.cache = TranscodeCache(self.root, quota=250,
+                                    timer=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def mk_file(self, track_path, size=100, atime=None):
+        path = self.cache.get_path(track_path, 'ogg')
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        if atime is not None:
+            os.utime(path, (atime, atime))
+
+        return path
+
+    def test_path(self):
+        path = self.cache.get_path(u'/music/track.flac', 'ogg')
+
+        nose.eq_(os.path.dirname(path), os.path.join(self.root, 'ogg'))
+        nose.ok_(path.endswith('.ogg'))
+        nose.ok_(os.path.isdir(os.path.dirname(path)))
+        nose.ok_(path != self.cache.get_path(u'/podcasts/track.flac', 'ogg'))
+
+    def test_scan(self):
+        self.mk_file('/a', size=100)
+        self.mk_file('/b', size=50)
+        # Being written.
+        with open(os.path.join(self.root, 'ogg', 'c.ogg.part'), 'wb') as f:
+            f.write('x' * 500)
+
+        nose.eq_(len(self.cache), 2)
+        nose.eq_(self.cache.bytes, 150)
+        nose.eq_(metrics.TRANSCODE_CACHE_BYTES.get(), 150)
+
+    def test_lookup(self):
+        path = self.mk_file('/a', atime=10)
+
+        nose.ok_(self.cache.lookup(path))
+        nose.ok_(not self.cache.lookup(self.cache.get_path('/b', 'ogg')))
+        nose.eq_((self.cache.hits, self.cache.misses), (1, 1))
+        nose.eq_(os.stat(path).st_atime, 1000)
+        # The mtime, the version of the file, is kept.
+        nose.eq_(os.stat(path).st_mtime, 10)
+
+    def test_least_recently_used_are_evicted(self):
+        first = self.mk_file('/a', atime=10)
+        second = self.mk_file('/b', atime=20)
+        self.cache.lookup(first)
+
+        self.cache.add(self.mk_file('/c'))
+
+        nose.ok_(os.path.exists(first))
+        nose.ok_(not os.path.exists(second))
+        nose.eq_(self.cache.bytes, 200)
+
+    def test_the_file_added_is_kept(self):
+        path = self.mk_file('/a', size=300)
+
+        self.cache.add(path)
+
+        nose.ok_(os.path.exists(path))
+
+    def test_no_quota(self):
+        self.cache.quota = None
+        paths = [self.mk_file(name) for name in ('/a', '/b', '/c')]
+
+        self.cache.add(paths[-1])
+
+        nose.ok_(all(os.path.exists(path) for path in paths))
+        nose.eq_(self.cache.bytes, 300)